@@ -0,0 +1,101 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures bulk trajectory ingestion. By default only parsing and validation of
+JSON lines and packed uploads is timed. With --datastore, trajectories are
+also stored in the Datastore of the project in config.py, one per request
+through /books/upload_drawn_path and then in bulk through
+/books/upload_trajectories, and the throughput of each is printed.
+
+    $ python benchmarks/ingestion_benchmark.py [--datastore]
+"""
+
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bookshelf import ingestion, trajectory_encoding  # noqa
+
+NUM_TRAJECTORIES = 2000
+POINTS_PER_TRAJECTORY = 30
+NUM_SINGLE_UPLOADS = 50
+
+
+def random_trajectories(rand, num_trajectories):
+    out = []
+    for _ in range(num_trajectories):
+        lat, lng = rand.uniform(37.7, 37.8), rand.uniform(-122.5, -122.4)
+        traj = []
+        for _ in range(POINTS_PER_TRAJECTORY):
+            lat += rand.uniform(-0.0005, 0.0005)
+            lng += rand.uniform(-0.0005, 0.0005)
+            traj.append({'lat': lat, 'lng': lng})
+        out.append(traj)
+    return out
+
+
+def timed(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+
+def report(name, num_trajectories, seconds):
+    print("{:<28} {:>10.0f} trajectories/s".format(
+        name, num_trajectories / seconds))
+
+
+def benchmark_parsing(trajectories):
+    json_lines = '\n'.join(json.dumps(traj) for traj in trajectories)
+    packed = trajectory_encoding.encode(trajectories, 2)
+    print("upload size: {} bytes as JSON lines, {} bytes packed".format(
+        len(json_lines), len(packed)))
+    report("parse JSON lines", len(trajectories),
+           timed(lambda: ingestion.parse_json_lines(json_lines)))
+    report("parse packed", len(trajectories),
+           timed(lambda: ingestion.parse_packed(packed)))
+    return json_lines
+
+
+def benchmark_datastore(trajectories, json_lines):
+    import bookshelf
+    import config
+
+    app = bookshelf.create_app(config)
+    client = app.test_client()
+
+    def single_uploads():
+        for traj in trajectories[:NUM_SINGLE_UPLOADS]:
+            client.post('/books/upload_drawn_path',
+                        data={'path': json.dumps(traj)})
+    report("one per request", NUM_SINGLE_UPLOADS, timed(single_uploads))
+    report("bulk upload", len(trajectories),
+           timed(lambda: client.post('/books/upload_trajectories',
+                                     data=json_lines)))
+
+
+def main():
+    trajectories = random_trajectories(random.Random(0), NUM_TRAJECTORIES)
+    json_lines = benchmark_parsing(trajectories)
+    if '--datastore' in sys.argv[1:]:
+        benchmark_datastore(trajectories, json_lines)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compares the route search /books/build_graph_and_find_path used to run, a
+Dijkstra search from every point near the start to every point near the end,
+with the A* search in bookshelf.routing and queries of a contraction hierarchy
+from bookshelf.contraction, on synthetic city street grids. The time to build
+each hierarchy is shown too, since the worker pays it once per set of filtered
+trajectories.
+
+    $ python benchmarks/routing_benchmark.py
+"""
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bookshelf.contraction import build_contraction_hierarchy  # noqa
+from bookshelf.routing import astar, CompactGraph  # noqa
+from bookshelf.spatial import PointGridIndex, \
+    get_grid_nearby_neighbors_func  # noqa
+from traclus_impl.geometry import Point  # noqa
+from traclus_impl.processed_trajectory_connecting import \
+    build_point_graph, compute_graph_component_ids, compute_shortest_path, \
+    FilteredTrajectory  # noqa
+
+EXTENT = 0.1
+POINT_SPACING = 0.0005
+CONNECT_DISTANCE = 0.0003
+SNAP_DISTANCE = 0.0004
+NUM_QUERIES = 20
+
+
+def city_grid(num_streets, rand):
+    """Straight, slightly wobbly streets running both ways across EXTENT."""
+    trajectories = []
+    num_points = int(EXTENT / POINT_SPACING) + 1
+    for street in range(num_streets):
+        # Streets sit on the point spacing so that crossing streets share
+        # points that get connected.
+        offset = round((street + 0.5) * EXTENT / num_streets /
+                       POINT_SPACING) * POINT_SPACING
+        for horizontal in (True, False):
+            traj = []
+            for i in range(num_points):
+                along = i * POINT_SPACING
+                across = offset + rand.uniform(-0.00002, 0.00002)
+                traj.append(Point(along, across) if horizontal
+                            else Point(across, along))
+            trajectories.append(FilteredTrajectory(traj, len(trajectories)))
+    pt_index = PointGridIndex(CONNECT_DISTANCE)
+    pt_graph = build_point_graph(
+        trajectories, get_grid_nearby_neighbors_func(pt_index,
+                                                     CONNECT_DISTANCE))
+    compute_graph_component_ids(pt_graph, lambda pt_node, pt_graph: [])
+    return pt_graph, pt_index
+
+
+def squared_distance(a, b, pt_graph):
+    pt_a, pt_b = pt_graph[a].point, pt_graph[b].point
+    return (pt_a.x - pt_b.x) ** 2 + (pt_a.y - pt_b.y) ** 2
+
+
+def pairwise_dijkstra(pt_graph, sources, targets):
+    best = None
+    for s in sources:
+        for t in targets:
+            path, dist = compute_shortest_path(s, t, pt_graph,
+                                               squared_distance)
+            if path is not None and (best is None or dist < best[1]):
+                best = (path, dist)
+    return best
+
+
+def main():
+    rand = random.Random(0)
+    print("{:>8} {:>10} {:>18} {:>12} {:>12} {:>12} {:>8}".format(
+        "streets", "points", "pairwise (ms/q)", "A* (ms/q)", "CH (ms/q)",
+        "CH build (s)", "found"))
+    for num_streets in (10, 20, 40):
+        pt_graph, pt_index = city_grid(num_streets, rand)
+        graph = CompactGraph.from_point_graph(pt_graph)
+        build_start = timeit.default_timer()
+        hierarchy = build_contraction_hierarchy(graph)
+        build_s = timeit.default_timer() - build_start
+        queries = []
+        while len(queries) < NUM_QUERIES:
+            start = pt_graph[rand.randrange(len(pt_graph))].point
+            end = pt_graph[rand.randrange(len(pt_graph))].point
+            queries.append((
+                pt_index.query_radius(start.x, start.y, SNAP_DISTANCE, True),
+                pt_index.query_radius(end.x, end.y, SNAP_DISTANCE, True)))
+
+        def pairwise():
+            for sources, targets in queries:
+                pairwise_dijkstra(pt_graph, sources, targets)
+
+        def a_star():
+            for sources, targets in queries:
+                astar(graph, sources, targets)
+
+        def contraction():
+            for sources, targets in queries:
+                hierarchy.query(sources, targets)
+        num_found = sum(1 for sources, targets in queries
+                        if astar(graph, sources, targets)[0] is not None)
+
+        pairwise_ms = timeit.timeit(pairwise, number=1) * 1000.0 / NUM_QUERIES
+        astar_ms = timeit.timeit(a_star, number=1) * 1000.0 / NUM_QUERIES
+        ch_ms = timeit.timeit(contraction, number=1) * 1000.0 / NUM_QUERIES
+        row = "{:>8} {:>10} {:>18.2f} {:>12.2f} {:>12.2f} {:>12.1f} {:>8}"
+        print(row.format(
+            num_streets, len(pt_graph), pairwise_ms, astar_ms, ch_ms, build_s,
+            num_found))
+
+
+if __name__ == '__main__':
+    main()
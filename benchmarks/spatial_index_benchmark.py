@@ -0,0 +1,80 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compares snapping a query point onto the point graph with a full scan (what
+find_shortest_connection does) against the grid index, for growing graphs.
+
+    $ python benchmarks/spatial_index_benchmark.py
+"""
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bookshelf.spatial import index_point_graph  # noqa
+from traclus_impl.geometry import Point  # noqa
+from traclus_impl.processed_trajectory_connecting import \
+    build_point_graph, FilteredTrajectory, find_nearest_points_to_point  # noqa
+
+# Roughly a city's worth of degrees, and the radii /books/get_directions uses.
+EXTENT = 0.2
+CELL_SIZE = 0.001
+SNAP_DISTANCE = 0.0001
+NUM_QUERIES = 200
+
+
+def random_graph(num_points, rand, points_per_traj=50):
+    trajectories = []
+    for traj_id in range(num_points // points_per_traj):
+        x, y = rand.uniform(0, EXTENT), rand.uniform(0, EXTENT)
+        traj = []
+        for _ in range(points_per_traj):
+            x += rand.uniform(-0.0005, 0.0005)
+            y += rand.uniform(-0.0005, 0.0005)
+            traj.append(Point(x, y))
+        trajectories.append(FilteredTrajectory(traj, traj_id))
+    return build_point_graph(trajectories)
+
+
+def main():
+    rand = random.Random(0)
+    print("{:>10} {:>14} {:>14}".format(
+        "points", "scan (ms/q)", "grid (ms/q)"))
+    for num_points in (1000, 10000, 50000, 100000):
+        pt_graph = random_graph(num_points, rand)
+        pt_index = index_point_graph(pt_graph, CELL_SIZE)
+        queries = [Point(rand.uniform(0, EXTENT), rand.uniform(0, EXTENT))
+                   for _ in range(NUM_QUERIES)]
+
+        def scan():
+            for q in queries:
+                find_nearest_points_to_point(
+                    q, pt_graph, lambda a, b: a.distance_to(b), SNAP_DISTANCE)
+
+        def grid():
+            for q in queries:
+                pt_index.query_radius(q.x, q.y, SNAP_DISTANCE, strict=True)
+
+        scan_ms = timeit.timeit(scan, number=1) * 1000.0 / NUM_QUERIES
+        grid_ms = timeit.timeit(grid, number=1) * 1000.0 / NUM_QUERIES
+        print("{:>10} {:>14.4f} {:>14.4f}".format(
+            len(pt_graph), scan_ms, grid_ms))
+
+
+if __name__ == '__main__':
+    main()
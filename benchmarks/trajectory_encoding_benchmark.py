@@ -0,0 +1,69 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compares the size and decode time of stored filtered trajectories as JSON
+and in the packed binary encoding.
+
+    $ python benchmarks/trajectory_encoding_benchmark.py
+"""
+
+import json
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bookshelf import trajectory_encoding  # noqa
+
+NUM_TRAJECTORIES = 1000
+POINTS_PER_TRAJECTORY = 50
+REPEATS = 5
+
+
+def random_trajectories(rand):
+    out = []
+    for _ in range(NUM_TRAJECTORIES):
+        lat, lng = rand.uniform(37.7, 37.8), rand.uniform(-122.5, -122.4)
+        traj = []
+        for _ in range(POINTS_PER_TRAJECTORY):
+            lat += rand.uniform(-0.0005, 0.0005)
+            lng += rand.uniform(-0.0005, 0.0005)
+            traj.append({'lat': lat, 'lng': lng})
+        out.append(traj)
+    return out
+
+
+def main():
+    trajectories = random_trajectories(random.Random(0))
+    payloads = [
+        ('json', json.dumps(trajectories)),
+        ('packed', trajectory_encoding.encode(trajectories, 2,
+                                              compress=False)),
+        ('packed+zlib', trajectory_encoding.encode(trajectories, 2)),
+    ]
+
+    print("{} trajectories of {} points".format(NUM_TRAJECTORIES,
+                                                POINTS_PER_TRAJECTORY))
+    print("{:>12} {:>12} {:>14}".format("encoding", "bytes", "decode (ms)"))
+    for name, data in payloads:
+        decode_ms = timeit.timeit(lambda: trajectory_encoding.decode(data),
+                                  number=REPEATS) * 1000.0 / REPEATS
+        print("{:>12} {:>12} {:>14.1f}".format(name, len(data), decode_ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Contraction hierarchies over a routing.CompactGraph.
+
+Nodes are removed ("contracted") one at a time, least important first, and
+whenever removing a node would lengthen the shortest path between two of its
+neighbors, a shortcut edge is added between them. Every shortest path then
+has a version that only goes up in the contraction order and then back down,
+so a query only searches upwards from both ends, which visits a tiny part of
+the graph. Building the hierarchy is slow, so the worker does it once per set
+of filtered trajectories.
+"""
+
+from array import array
+from heapq import heappop, heappush
+
+from bookshelf.routing import prune_to_shared_components
+
+INFINITY = float('inf')
+
+
+class ContractionHierarchy(object):
+    """
+    The contraction order of each node, and the edges from each node to the
+    nodes contracted after it, as CSR arrays like CompactGraph's. middles
+    holds the node a shortcut skips over, or -1 for an edge of the original
+    graph.
+    """
+
+    def __init__(self, ranks, components, offsets, neighbors, weights,
+                 middles):
+        self.ranks = ranks
+        self.components = components
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.weights = weights
+        self.middles = middles
+
+    def __len__(self):
+        return len(self.ranks)
+
+    def to_items(self):
+        """Returns the hierarchy as a JSON serializable list, one item per
+        node, for storing as a sharded result."""
+        items = []
+        for u in range(len(self)):
+            start, end = self.offsets[u], self.offsets[u + 1]
+            items.append([self.ranks[u], self.components[u],
+                          self.neighbors[start:end].tolist(),
+                          self.weights[start:end].tolist(),
+                          self.middles[start:end].tolist()])
+        return items
+
+    @classmethod
+    def from_items(cls, items):
+        ranks, components = array('i'), array('i')
+        offsets = array('i', [0])
+        neighbors, weights, middles = array('i'), array('d'), array('i')
+        for rank, component, node_neighbors, node_weights, node_middles \
+                in items:
+            ranks.append(rank)
+            components.append(component)
+            neighbors.extend(node_neighbors)
+            weights.extend(node_weights)
+            middles.extend(node_middles)
+            offsets.append(len(neighbors))
+        return cls(ranks, components, offsets, neighbors, weights, middles)
+
+    def _upward_search_step(self, heap, distances, back_edges):
+        dist, u = heappop(heap)
+        if dist > distances[u]:
+            return None, None
+        for k in range(self.offsets[u], self.offsets[u + 1]):
+            v = self.neighbors[k]
+            new_dist = dist + self.weights[k]
+            if new_dist < distances.get(v, INFINITY):
+                distances[v] = new_dist
+                back_edges[v] = u
+                heappush(heap, (new_dist, v))
+        return dist, u
+
+    def query(self, sources, targets):
+        """
+        Returns (path as a list of node indices, length) of the shortest path
+        from any of the sources to any of the targets, or (None, None).
+        """
+        sources, targets = prune_to_shared_components(self, sources, targets)
+        if not sources or not targets:
+            return None, None
+
+        searches = []
+        for starts in (sources, targets):
+            distances = dict((s, 0.0) for s in starts)
+            back_edges = dict((s, -1) for s in starts)
+            searches.append(([(0.0, s) for s in starts], distances,
+                             back_edges))
+
+        best, meeting_node = INFINITY, None
+        while True:
+            # Step whichever search is behind, until neither can still find
+            # anything shorter than the best meeting found so far.
+            open_searches = [i for i in (0, 1)
+                             if searches[i][0] and searches[i][0][0][0] < best]
+            if not open_searches:
+                break
+            i = min(open_searches, key=lambda j: searches[j][0][0][0])
+            heap, distances, back_edges = searches[i]
+            dist, u = self._upward_search_step(heap, distances, back_edges)
+            if u is None:
+                continue
+            other_dist = searches[1 - i][1].get(u)
+            if other_dist is not None and dist + other_dist < best:
+                best, meeting_node = dist + other_dist, u
+
+        if meeting_node is None:
+            return None, None
+        up_path = _walk_back(searches[0][2], meeting_node)
+        down_path = _walk_back(searches[1][2], meeting_node)
+        return self.unpack(up_path[::-1] + down_path[1:]), best
+
+    def _middle(self, a, b):
+        lower, higher = (a, b) if self.ranks[a] < self.ranks[b] else (b, a)
+        for k in range(self.offsets[lower], self.offsets[lower + 1]):
+            if self.neighbors[k] == higher:
+                return self.middles[k]
+        raise ValueError("no edge between {} and {}".format(a, b))
+
+    def unpack(self, path):
+        """Replaces the shortcuts in a path with the original edges."""
+        out = [path[0]]
+        stack = [(a, b) for a, b in reversed(list(zip(path, path[1:])))]
+        while stack:
+            a, b = stack.pop()
+            middle = self._middle(a, b)
+            if middle == -1:
+                out.append(b)
+            else:
+                stack.append((middle, b))
+                stack.append((a, middle))
+        return out
+
+
+def _walk_back(back_edges, node):
+    path = [node]
+    while back_edges[path[-1]] != -1:
+        path.append(back_edges[path[-1]])
+    return path
+
+
+def _witness_distances(adjacency, start, skipped, targets, max_dist,
+                       max_settled):
+    """
+    Dijkstra from start in what's left of the graph, ignoring skipped, until
+    every target is settled, the search passes max_dist or it has settled
+    max_settled nodes.
+    """
+    distances = {start: 0.0}
+    heap = [(0.0, start)]
+    num_settled = 0
+    targets_left = len(targets)
+    while heap and num_settled < max_settled:
+        dist, u = heappop(heap)
+        if dist > distances[u]:
+            continue
+        if dist > max_dist:
+            break
+        num_settled += 1
+        if u in targets:
+            targets_left -= 1
+            if targets_left == 0:
+                break
+        for v, (weight, _) in adjacency[u].items():
+            if v == skipped:
+                continue
+            new_dist = dist + weight
+            if new_dist < distances.get(v, INFINITY):
+                distances[v] = new_dist
+                heappush(heap, (new_dist, v))
+    return distances
+
+
+def _shortcuts_needed(adjacency, v, max_settled):
+    """Returns (a, b, length) for each shortcut contracting v would need."""
+    neighbors = list(adjacency[v].items())
+    shortcuts = []
+    for i, (a, (weight_a, _)) in enumerate(neighbors[:-1]):
+        # Neighbors of v are often neighbors of each other too, in which
+        # case the direct edge is usually witness enough without a search.
+        pending = {}
+        for b, (weight_b, _) in neighbors[i + 1:]:
+            via_v = weight_a + weight_b
+            if adjacency[a].get(b, (INFINITY,))[0] > via_v:
+                pending[b] = via_v
+        if not pending:
+            continue
+        witnesses = _witness_distances(adjacency, a, v, pending,
+                                       max(pending.values()), max_settled)
+        for b, via_v in pending.items():
+            if witnesses.get(b, INFINITY) > via_v:
+                shortcuts.append((a, b, via_v))
+    return shortcuts
+
+
+def build_contraction_hierarchy(graph, max_settled=50,
+                                estimate_max_settled=5):
+    """
+    Contracts every node of a CompactGraph. max_settled bounds the searches
+    for paths that make a shortcut unnecessary: giving up early only adds
+    shortcuts that weren't needed, never leaves out one that was. The initial
+    contraction order is estimated with even shorter searches.
+    """
+    num_nodes = len(graph)
+    adjacency = [{} for _ in range(num_nodes)]
+    for u in range(num_nodes):
+        for k in range(graph.offsets[u], graph.offsets[u + 1]):
+            v, weight = graph.neighbors[k], graph.weights[k]
+            if v != u and weight < adjacency[u].get(v, (INFINITY,))[0]:
+                adjacency[u][v] = (weight, -1)
+                adjacency[v][u] = (weight, -1)
+
+    num_contracted_neighbors = [0] * num_nodes
+    depths = [0] * num_nodes
+
+    def priority(v, shortcuts):
+        # Prefer nodes whose removal adds few edges, and spread contraction
+        # out over the graph rather than eating into one area.
+        return len(shortcuts) - len(adjacency[v]) + \
+            num_contracted_neighbors[v] + depths[v]
+
+    heap = [(priority(node, _shortcuts_needed(adjacency, node,
+                                              estimate_max_settled)), node)
+            for node in range(num_nodes)]
+    heap.sort()
+    ranks = array('i', [0] * num_nodes)
+    upward = [None] * num_nodes
+    next_rank = 0
+    while heap:
+        _, v = heappop(heap)
+        # Priorities go stale as neighbors are contracted, so they're only
+        # recomputed when a node comes up.
+        shortcuts = _shortcuts_needed(adjacency, v, max_settled)
+        new_priority = priority(v, shortcuts)
+        if heap and new_priority > heap[0][0]:
+            heappush(heap, (new_priority, v))
+            continue
+
+        upward[v] = adjacency[v]
+        ranks[v] = next_rank
+        next_rank += 1
+        for u in adjacency[v]:
+            del adjacency[u][v]
+            num_contracted_neighbors[u] += 1
+            depths[u] = max(depths[u], depths[v] + 1)
+        adjacency[v] = {}
+        for a, b, length in shortcuts:
+            if length < adjacency[a].get(b, (INFINITY,))[0]:
+                adjacency[a][b] = (length, v)
+                adjacency[b][a] = (length, v)
+
+    offsets = array('i', [0])
+    neighbors, weights, middles = array('i'), array('d'), array('i')
+    for v in range(num_nodes):
+        for u in sorted(upward[v]):
+            weight, middle = upward[v][u]
+            neighbors.append(u)
+            weights.append(weight)
+            middles.append(middle)
+        offsets.append(len(neighbors))
+    return ContractionHierarchy(ranks, array('i', graph.components), offsets,
+                                neighbors, weights, middles)
@@ -12,15 +12,50 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from bookshelf import get_model, oauth2, storage, tasks, model_datastore
+from bookshelf import get_model, oauth2, storage, tasks, model_datastore, \
+    ingestion, simplification, viewport
+from bookshelf.caching import LRUCache
+from bookshelf.spatial import tile_bounds, tile_pixel_size
 from flask import Blueprint, current_app, redirect, render_template, request, \
-    session, url_for, jsonify
+    session, url_for, jsonify, stream_with_context
+import hashlib
 import json
 from polypaths_planar_override import Point
 
 
 crud = Blueprint('crud', __name__)
 
+# Stored results only change when TRACLUS runs or trajectories are uploaded,
+# so their serialized responses are kept per result version. Versions are
+# re-read from Datastore at most every RESULT_VERSION_TTL_SECONDS, which is
+# how stale a response can be. Responses are streamed as they're built, and
+# only kept if they turn out no bigger than RESPONSE_CACHE_MAX_BODY_BYTES.
+RESULT_VERSION_TTL_SECONDS = 5
+RESPONSE_CACHE_MAX_ENTRIES = 64
+RESPONSE_CACHE_MAX_BODY_BYTES = 4 * 1024 * 1024
+# Cached in place of None for results that have no version, so that looking
+# them up doesn't go to Datastore every time either.
+_NO_VERSION = 'none'
+_result_version_cache = LRUCache(max_entries=32, ttl=RESULT_VERSION_TTL_SECONDS)
+_response_cache = LRUCache(max_entries=RESPONSE_CACHE_MAX_ENTRIES)
+
+# Bounding box and tile queries run against a grid index over the segments of
+# the stored result, built once per result version.
+SEGMENT_INDEX_CELL_SIZE = 0.01
+SEGMENT_INDEX_CACHE_MAX_ENTRIES = 4
+_segment_index_cache = LRUCache(max_entries=SEGMENT_INDEX_CACHE_MAX_ENTRIES)
+
+MAX_PAGE_SIZE = 1000
+
+# Most start or end points a single /route_matrix request can ask about.
+MAX_ROUTE_MATRIX_POINTS = 100
+# Farthest a route's ends can be snapped to the graph. Every graph point
+# within it is a possible start or end.
+MAX_DIST_TO_EXISTING_PT = 0.01
+
+# Items are written to streamed responses this many at a time.
+STREAM_CHUNK_ITEMS = 100
+
 
 def upload_image_file(file):
     """
@@ -42,6 +77,225 @@ def upload_image_file(file):
     return public_url
 
 
+def get_result_version(table_name, key_id):
+    cache_key = (table_name, key_id)
+    version = _result_version_cache.get(cache_key)
+    if version == None:
+        version = model_datastore.get_result_version(table_name, key_id)
+        _result_version_cache.set(cache_key, version if version != None else _NO_VERSION)
+    return version if version != _NO_VERSION else None
+
+
+def _cache_while_streaming(chunks, cache_key):
+    parts, size = [], 0
+    for chunk in chunks:
+        if parts != None:
+            size += len(chunk)
+            if size <= RESPONSE_CACHE_MAX_BODY_BYTES:
+                parts.append(chunk)
+            else:
+                parts = None
+        yield chunk
+    if parts != None:
+        _response_cache.set(cache_key, ''.join(parts))
+
+
+def versioned_response(table_name, key_id, iter_body, variant='', \
+                       mimetype='application/json'):
+    """
+    Streams the chunks of iter_body(), tagged with an ETag for the current
+    version of the stored result. Clients that already have that version get
+    a 304, and otherwise the body is reused for as long as the version stays
+    the same. Results that predate versioning are always rebuilt. variant
+    tells apart different views of the same result.
+    """
+    version = get_result_version(table_name, key_id)
+    if version == None:
+        return current_app.response_class(stream_with_context(iter_body()), \
+                                          mimetype=mimetype)
+
+    etag = '{}-{}-{}'.format(table_name, key_id, version)
+    if variant:
+        etag += '-' + hashlib.sha1(variant).hexdigest()
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
+    cache_key = (table_name, key_id, version, variant)
+    body = _response_cache.get(cache_key)
+    if body == None:
+        body = stream_with_context(_cache_while_streaming(iter_body(), cache_key))
+    response = current_app.response_class(body, mimetype=mimetype)
+    response.set_etag(etag)
+    return response
+
+
+def versioned_json_response(table_name, key_id, build_payload, variant=''):
+    """Like versioned_response, for a payload built all at once."""
+    return versioned_response(table_name, key_id, \
+                              lambda: [json.dumps(build_payload())], \
+                              variant=variant)
+
+
+def in_chunks(items, chunk_size=STREAM_CHUNK_ITEMS):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def wants_ndjson():
+    return request.args.get('format', 'json') == 'ndjson'
+
+
+def iter_json_chunks(name, item_chunks, ndjson=False):
+    """
+    Serializes lists of items one list at a time, either as {name: [items]}
+    or, with ndjson set, as one JSON item per line.
+    """
+    if ndjson:
+        for items in item_chunks:
+            if items:
+                yield ''.join(json.dumps(item) + '\n' for item in items)
+        return
+    
+    yield '{' + json.dumps(name) + ': ['
+    first = True
+    for items in item_chunks:
+        if items:
+            yield ('' if first else ', ') + ', '.join(map(json.dumps, items))
+            first = False
+    yield ']}'
+
+
+def iter_sharded_result_chunks(table_name, key_id, legacy_attr_name, to_chunks):
+    """
+    Yields to_chunks(shard items) for a stored result, holding the chunks
+    back until the whole result or RESPONSE_CACHE_MAX_BODY_BYTES of it has
+    been read. A result replaced before then is read again from the start,
+    instead of answering with part of one generation, or parts of two. Once
+    chunks have been sent there's no taking them back, so a replacement after
+    that raises ResultReplacedError, which cuts the response off unfinished.
+    """
+    for attempt in range(2):
+        held, size = [], 0
+        try:
+            shards = model_datastore.iter_sharded_result(table_name, key_id, legacy_attr_name)
+            for chunk in to_chunks(items for items, version in shards):
+                if held == None:
+                    yield chunk
+                    continue
+                held.append(chunk)
+                size += len(chunk)
+                if size > RESPONSE_CACHE_MAX_BODY_BYTES:
+                    for held_chunk in held:
+                        yield held_chunk
+                    held = None
+        except model_datastore.ResultReplacedError:
+            if held == None or attempt > 0:
+                raise
+            continue
+        for held_chunk in held or []:
+            yield held_chunk
+        return
+
+
+def sharded_result_response(table_name, key_id, legacy_attr_name, name):
+    """Streams a sharded result a shard at a time, as JSON or, with
+    format=ndjson, as one item per line."""
+    ndjson = wants_ndjson()
+    
+    def iter_body():
+        return iter_sharded_result_chunks(table_name, key_id, legacy_attr_name, \
+                                          lambda item_lists: iter_json_chunks(name, item_lists, \
+                                                                              ndjson=ndjson))
+    return versioned_response(table_name, key_id, iter_body, \
+                              variant='ndjson' if ndjson else '', \
+                              mimetype='application/x-ndjson' if ndjson else 'application/json')
+
+
+def get_indexed_result(table_name, key_id, legacy_attr_name, build_index):
+    """
+    Returns (items, segment index) for a stored result, reusing the index
+    built for its current version.
+    """
+    version = get_result_version(table_name, key_id)
+    cached = _segment_index_cache.get((table_name, key_id, version))
+    if cached != None and version != None:
+        return cached
+
+    items, version = model_datastore.get_sharded_result(table_name, key_id, \
+                                                        legacy_attr_name)
+    cached = (items, build_index(items, SEGMENT_INDEX_CELL_SIZE))
+    if version != None:
+        _segment_index_cache.set((table_name, key_id, version), cached)
+    return cached
+
+
+def get_bbox_args():
+    """Returns the box a request asks for, raising ValueError if it's missing
+    or malformed."""
+    try:
+        return (float(request.args['min_lat']), float(request.args['min_lng']), \
+                float(request.args['max_lat']), float(request.args['max_lng']))
+    except KeyError as e:
+        raise ValueError("missing " + str(e))
+
+
+def get_tile_tolerance(z):
+    if request.args.get('simplify', 'false').lower() == 'true':
+        return tile_pixel_size(z)
+    return None
+
+
+def filtered_in_box_response(box, tolerance):
+    def build_payload():
+        trajectories, index = get_indexed_result(model_datastore.RESULTS_TABLE_NAME, \
+                                                 model_datastore.RESULTS_DEFAULT_ID, \
+                                                 model_datastore.RESULTS_ATTR_NAME, \
+                                                 viewport.index_trajectory_segments)
+        return {'trajectories': viewport.trajectories_in_box(trajectories, index, \
+                                                             box, tolerance)}
+    return versioned_json_response(model_datastore.RESULTS_TABLE_NAME, \
+                                   model_datastore.RESULTS_DEFAULT_ID, \
+                                   build_payload, \
+                                   variant=repr((box, tolerance)))
+
+
+def clusters_in_box_response(box, tolerance):
+    def build_payload():
+        clusters, index = get_indexed_result(model_datastore.CLUSTERS_TABLE, \
+                                             model_datastore.CLUSTERS_DEFAULT_ID, \
+                                             model_datastore.CLUSTERS_ATTR_NAME, \
+                                             viewport.index_cluster_segments)
+        return {'clusters': viewport.clusters_in_box(clusters, index, \
+                                                     box, tolerance)}
+    return versioned_json_response(model_datastore.CLUSTERS_TABLE, \
+                                   model_datastore.CLUSTERS_DEFAULT_ID, \
+                                   build_payload, \
+                                   variant=repr((box, tolerance)))
+
+
+def get_page_args(default_page_size):
+    """Returns (page size, page token), or None if the request isn't for a
+    single page. Raises ValueError if the page size isn't a whole number from
+    1 to MAX_PAGE_SIZE."""
+    if 'page_size' not in request.args and 'page_token' not in request.args:
+        return None
+    try:
+        page_size = int(request.args.get('page_size', default_page_size))
+    except ValueError:
+        raise ValueError("page size must be a whole number")
+    if page_size < 1 or page_size > MAX_PAGE_SIZE:
+        raise ValueError("page size must be between 1 and " + str(MAX_PAGE_SIZE))
+    return page_size, request.args.get('page_token', None)
+
+
 @crud.route("/")
 def list():
     token = request.args.get('page_token', None)
@@ -95,31 +349,124 @@ def upload_drawn_path():
                                                 drawn_by_hand=True)
     return "just uploaded new trajectory"
 
+@crud.route("/upload_trajectories", methods=['POST'])
+def upload_trajectories():
+    """
+    Stores many trajectories at once, sent as JSON lines or, with a
+    Content-Type of application/octet-stream, in the packed encoding. The
+    drawn argument sets whether trajectories without their own drawn flag
+    were drawn by hand. Uploads sent with an upload_id argument can be sent
+    again whole with the same id if they fail part way; trajectories that
+    were already stored aren't stored twice.
+    """
+    drawn_by_hand = request.args.get('drawn', 'false').lower() == 'true'
+    upload_id = request.args.get('upload_id')
+    try:
+        if upload_id != None:
+            ingestion.validate_upload_id(upload_id)
+        if request.mimetype == 'application/octet-stream':
+            trajectories = ingestion.parse_packed(request.get_data(), drawn_by_hand)
+        else:
+            trajectories = ingestion.parse_json_lines(request.get_data(), drawn_by_hand)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    model_datastore.store_new_trajectory_updates(trajectories, upload_id=upload_id)
+    return jsonify({'num_trajectories': len(trajectories)})
+
 @crud.route("/raw_trajectories")
 def get_raw_trajectories():
-    raw_traj = model_datastore.get_raw_trajectories()
-    return jsonify({'trajectories': raw_traj})
+    try:
+        page_args = get_page_args(model_datastore.RAW_TRAJECTORY_PAGE_SIZE)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if page_args != None:
+        trajectories, next_page_token = \
+        model_datastore.get_raw_trajectories_page(page_size=page_args[0], \
+                                                  cursor=page_args[1])
+        return jsonify({'trajectories': trajectories, \
+                        'next_page_token': next_page_token})
+    ndjson = wants_ndjson()
+    return versioned_response(model_datastore.RAW_TRAJECTORY_TABLE, \
+                              model_datastore.RAW_TRAHECTORY_DEFAULT_ID, \
+                              lambda: iter_json_chunks('trajectories', \
+                                                       in_chunks(model_datastore.iter_raw_trajectories()), \
+                                                       ndjson=ndjson), \
+                              variant='ndjson' if ndjson else '', \
+                              mimetype='application/x-ndjson' if ndjson else 'application/json')
 
 @crud.route("/locations")
 def get_location_updates():
-    unfiltered = model_datastore.get_all_location_updates()
+    try:
+        page_args = get_page_args(model_datastore.LOCATION_UPDATE_PAGE_SIZE)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if page_args != None:
+        locations, next_page_token = \
+        model_datastore.get_location_updates_page(page_size=page_args[0], \
+                                                  cursor=page_args[1])
+        return jsonify({'locations': locations, \
+                        'next_page_token': next_page_token})
     #tasks.upload_clusters()
     #tasks.upload_partitioned_trajectories()
     #task_queue = tasks.get_trajectory_filter_queue()
     #task_queue.enqueue(tasks.filter_trajectories)
-    print "Just enqueued a task to filter trajectories BEEF."
-    return jsonify(unfiltered)
+    ndjson = wants_ndjson()
+    
+    # Streams {source id: [[updates]]} one source at a time, or with
+    # format=ndjson a {'source_id': ..., 'updates': [[...]]} line per source.
+    def iter_body():
+        first = True
+        if not ndjson:
+            yield '{'
+        for sources in in_chunks(model_datastore.iter_location_updates_by_source()):
+            if ndjson:
+                yield ''.join(json.dumps({'source_id': source_id, 'updates': [updates]}) + '\n' \
+                              for source_id, updates in sources)
+                continue
+            yield ('' if first else ', ') + \
+                ', '.join(json.dumps(str(source_id)) + ': ' + json.dumps([updates]) \
+                          for source_id, updates in sources)
+            first = False
+        if not ndjson:
+            yield '}'
+    return current_app.response_class(stream_with_context(iter_body()), \
+                                      mimetype='application/x-ndjson' if ndjson else 'application/json')
+
+def get_bounded_int_arg(name, default, max_value):
+    """Returns an integer argument, raising ValueError unless it's a whole
+    number from 1 to max_value."""
+    try:
+        value = int(request.args.get(name, default))
+    except ValueError:
+        raise ValueError(name + " must be a whole number")
+    if value < 1 or value > max_value:
+        raise ValueError(name + " must be between 1 and " + str(max_value))
+    return value
 
 @crud.route("/simulated_annealing")
 def simulated_annealing_for_epsilon():
-    epsilon = float(request.args.get('epsilon'))
-    num_steps = int(request.args.get('num_steps'))
-    max_epsilon_jump = float(request.args.get('max_epsilon_jump'))
+    try:
+        epsilon = float(request.args.get('epsilon'))
+        num_steps = int(request.args.get('num_steps'))
+        max_epsilon_jump = float(request.args.get('max_epsilon_jump'))
+        num_chains = get_bounded_int_arg('num_chains', 1, \
+                                         current_app.config.get('MAX_ANNEALING_CHAINS', 8))
+        num_rounds = get_bounded_int_arg('num_rounds', 1, \
+                                         current_app.config.get('MAX_ANNEALING_ROUNDS', 10))
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': str(e)}), 400
+    share_best = request.args.get('share_best', 'false').lower() == 'true'
     
-    best_epsilon = tasks.run_simulated_annealing_for_epsilon(initial_epsilon=epsilon, \
-                                              num_steps=num_steps, \
-                                              max_epsilon_jump=max_epsilon_jump)
-    return jsonify({"best_epsilon": best_epsilon})
+    q = tasks.get_trajectory_filter_queue()
+    job = q.enqueue(tasks.run_simulated_annealing_for_epsilon, \
+                    initial_epsilon=epsilon, \
+                    num_steps=num_steps, \
+                    max_epsilon_jump=max_epsilon_jump, \
+                    num_chains=num_chains, \
+                    num_rounds=num_rounds, \
+                    share_best=share_best)
+    return jsonify({'job_id': job.task_id})
 
 @crud.route("/run_traclus")
 def run_traclus():
@@ -129,27 +476,91 @@ def run_traclus():
     min_vertical_lines = int(request.args.get('min_vertical_lines'))
     min_prev_dist = float(request.args.get('min_prev_dist'))
     
-    tasks.run_the_whole_enchilada(epsilon=epsilon, \
-                                  min_neighbors=min_neighbors, \
-                                  min_num_trajectories_in_cluster=min_num_trajectories_in_cluster, \
-                                  min_vertical_lines=min_vertical_lines, \
-                                  min_prev_dist=min_prev_dist)
-    return "Just ran traclus"
+    q = tasks.get_trajectory_filter_queue()
+    job = q.enqueue(tasks.run_the_whole_enchilada, \
+                    epsilon=epsilon, \
+                    min_neighbors=min_neighbors, \
+                    min_num_trajectories_in_cluster=min_num_trajectories_in_cluster, \
+                    min_vertical_lines=min_vertical_lines, \
+                    min_prev_dist=min_prev_dist)
+    return jsonify({'job_id': job.task_id})
+
+@crud.route("/jobs/<job_id>")
+def get_job_status(job_id):
+    return jsonify(tasks.get_job_status(job_id))
+
+@crud.route("/stats")
+def show_stats():
+    """Hit rates and sizes of this process's caches, and how its Datastore
+    clients and write buffer are doing, for keeping an eye on them."""
+    return jsonify({'route_cache': tasks.get_route_cache_stats(), \
+                    'response_cache': _response_cache.stats(), \
+                    'result_version_cache': _result_version_cache.stats(), \
+                    'segment_index_cache': _segment_index_cache.stats(), \
+                    'client_pool': model_datastore.get_client_pool_stats(), \
+                    'write_buffer': model_datastore.get_write_buffer_stats()})
 
 @crud.route("/filtered")
 def get_filtered_trajectories():
-    filtered = model_datastore.get_filtered_trajectories()
-    return jsonify({'trajectories':filtered})
+    try:
+        level = int(request.args.get('level', 0))
+        if level < 0 or level >= simplification.num_levels():
+            raise ValueError("level must be between 0 and " + \
+                             str(simplification.num_levels() - 1))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    key_id = model_datastore.filtered_trajectories_key_id(level)
+    # Results from before simplification was added only have full detail.
+    if level > 0 and get_result_version(model_datastore.RESULTS_TABLE_NAME, key_id) == None:
+        key_id = model_datastore.RESULTS_DEFAULT_ID
+    return sharded_result_response(model_datastore.RESULTS_TABLE_NAME, key_id, \
+                                   model_datastore.RESULTS_ATTR_NAME, 'trajectories')
+
+@crud.route("/filtered/bbox")
+def get_filtered_trajectories_in_bbox():
+    try:
+        box = get_bbox_args()
+        tolerance = float(request.args.get('tolerance') or 0) or None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return filtered_in_box_response(box, tolerance)
+
+@crud.route("/filtered/tiles/<int:z>/<int:x>/<int:y>")
+def get_filtered_trajectories_in_tile(z, x, y):
+    try:
+        box = tile_bounds(z, x, y)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 404
+    return filtered_in_box_response(box, get_tile_tolerance(z))
 
 @crud.route("/partitioned")
 def show_partitioned_trajectories():
-    traj = model_datastore.get_partitioned_trajectories()
-    return jsonify({'trajectories': traj})
+    return sharded_result_response(model_datastore.PARTITIONED_TRAJ_TABLE, \
+                                   model_datastore.PARTITION_TRAJ_DEFAULT_ID, \
+                                   model_datastore.PARTITION_TRAJ_ATTR_NAME, 'trajectories')
 
 @crud.route("/clusters")
 def show_clusters():
-    clusters = model_datastore.get_clusters()
-    return jsonify({'clusters': clusters})
+    return sharded_result_response(model_datastore.CLUSTERS_TABLE, \
+                                   model_datastore.CLUSTERS_DEFAULT_ID, \
+                                   model_datastore.CLUSTERS_ATTR_NAME, 'clusters')
+
+@crud.route("/clusters/bbox")
+def show_clusters_in_bbox():
+    try:
+        box = get_bbox_args()
+        tolerance = float(request.args.get('tolerance') or 0) or None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return clusters_in_box_response(box, tolerance)
+
+@crud.route("/clusters/tiles/<int:z>/<int:x>/<int:y>")
+def show_clusters_in_tile(z, x, y):
+    try:
+        box = tile_bounds(z, x, y)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 404
+    return clusters_in_box_response(box, get_tile_tolerance(z))
 
 @crud.route("/mine")
 @oauth2.required
@@ -165,23 +576,42 @@ def list_mine():
         books=books,
         next_page_token=next_page_token)
     
+def check_route_args(max_inter_traj_distance, max_dist_to_existing_pt):
+    """
+    Raises ValueError unless max_inter_traj_distance is one of the app's
+    ROUTE_MAX_INTER_TRAJ_DISTANCES, since each one needs its own graph, and
+    max_dist_to_existing_pt is positive and at most MAX_DIST_TO_EXISTING_PT.
+    """
+    allowed_distances = current_app.config.get('ROUTE_MAX_INTER_TRAJ_DISTANCES', [0.001])
+    if max_inter_traj_distance not in allowed_distances:
+        raise ValueError("max inter traj distance must be one of " + \
+                         ", ".join(map(str, allowed_distances)))
+    if not 0.0 < max_dist_to_existing_pt <= MAX_DIST_TO_EXISTING_PT:
+        raise ValueError("max dist to existing pt must be more than 0 and at most " + \
+                         str(MAX_DIST_TO_EXISTING_PT))
+
 @crud.route("/build_graph_and_find_path")
 def build_graph_and_find_path():
     start_pt_dict = json.loads(request.args.get('start_pt'))
     end_pt_dict = json.loads(request.args.get('end_pt'))
-    max_inter_traj_distance = float(request.args.get('max_inter_traj_distance'))
-    max_dist_to_existing_pt = float(request.args.get('max_dist_to_existing_pt'))
+    try:
+        max_inter_traj_distance = float(request.args.get('max_inter_traj_distance'))
+        max_dist_to_existing_pt = float(request.args.get('max_dist_to_existing_pt'))
+        check_route_args(max_inter_traj_distance, max_dist_to_existing_pt)
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': str(e)}), 400
     
     start_pt = Point(start_pt_dict['lat'], start_pt_dict['lng'])
     end_pt = Point(end_pt_dict['lat'], end_pt_dict['lng'])
     
-    filtered_trajectories = model_datastore.get_filtered_trajectories()
-    pt_graph = tasks.construct_graph_from_processed_trajectories(filtered_trajectories, \
-                                                                 max_inter_traj_distance)
-    shortest_path, shortest_dist = tasks.compute_shortest_path_between_points(pt_graph=pt_graph, \
-                                                               start_pt=start_pt, \
-                                                               end_pt=end_pt, \
-                                                               max_dist_to_existing_pt=max_dist_to_existing_pt)
+    route_graph, pt_index = tasks.get_route_graph(max_inter_traj_distance)
+    hierarchy = tasks.get_routing_hierarchy(route_graph, max_inter_traj_distance)
+    shortest_path, shortest_dist = tasks.find_route_between_points(route_graph=route_graph, \
+                                                                   pt_index=pt_index, \
+                                                                   start_pt=start_pt, \
+                                                                   end_pt=end_pt, \
+                                                                   max_dist_to_existing_pt=max_dist_to_existing_pt, \
+                                                                   hierarchy=hierarchy)
     if shortest_path == None:
         return jsonify({'path_found': False})
     else:
@@ -247,3 +677,41 @@ def edit(id):
 def delete(id):
     get_model().delete(id)
     return redirect(url_for('.list'))
+
+@crud.route("/route_matrix", methods=['POST'])
+def route_matrix():
+    """
+    Shortest route distances, and with "with_paths" the routes themselves,
+    from every one of a JSON body's "start_pts" to every one of its
+    "end_pts", using the same graph and snapping arguments as
+    build_graph_and_find_path. distances[i][j] is the distance from start
+    point i to end point j, or null if there's no route.
+    """
+    try:
+        body = json.loads(request.get_data())
+        start_pts = map(lambda pt: Point(float(pt['lat']), float(pt['lng'])), body['start_pts'])
+        end_pts = map(lambda pt: Point(float(pt['lat']), float(pt['lng'])), body['end_pts'])
+        max_inter_traj_distance = float(body['max_inter_traj_distance'])
+        max_dist_to_existing_pt = float(body['max_dist_to_existing_pt'])
+    except (ValueError, KeyError, TypeError) as e:
+        return jsonify({'error': "bad route matrix request: " + repr(e)}), 400
+    if len(start_pts) > MAX_ROUTE_MATRIX_POINTS or len(end_pts) > MAX_ROUTE_MATRIX_POINTS:
+        return jsonify({'error': "at most " + str(MAX_ROUTE_MATRIX_POINTS) + \
+                        " start and end points are allowed"}), 400
+    try:
+        check_route_args(max_inter_traj_distance, max_dist_to_existing_pt)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    with_paths = bool(body.get('with_paths', False))
+    
+    route_graph, pt_index = tasks.get_route_graph(max_inter_traj_distance)
+    distances, paths = tasks.find_route_matrix(route_graph=route_graph, \
+                                               pt_index=pt_index, \
+                                               start_pts=start_pts, \
+                                               end_pts=end_pts, \
+                                               max_dist_to_existing_pt=max_dist_to_existing_pt, \
+                                               with_paths=with_paths)
+    result = {'distances': distances}
+    if with_paths:
+        result['paths'] = paths
+    return jsonify(result)
@@ -0,0 +1,215 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Flat files holding a routing.CompactGraph and a grid index over its points,
+which processes map into memory instead of building and holding their own
+copies. Every process on a machine that maps the same file shares one copy
+of it through the page cache.
+
+A file is MAGIC, the length of a JSON header, the header, and then the
+arrays one after the other, each starting on an 8 byte boundary, in the
+byte order of the machine that wrote them. Files are written under a
+temporary name and renamed into place, so processes that still have an
+older file mapped keep reading it undisturbed.
+"""
+
+import bisect
+import contextlib
+import ctypes
+import fcntl
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+from bookshelf.routing import CompactGraph
+
+MAGIC = b'DRG1'
+
+_PREFIX = struct.Struct('<4sI')
+_ALIGNMENT = 8
+_CTYPES = {'d': ctypes.c_double, 'i': ctypes.c_int32, 'q': ctypes.c_int64}
+
+
+def _cell_key(cx, cy):
+    # Orders cells by x and then y, as one number that bisect can search.
+    return cx * (1 << 32) + cy + (1 << 31)
+
+
+class MappedPointIndex(object):
+    """
+    PointGridIndex.query_radius over the cells stored in a graph file: the
+    sorted keys of the non empty cells, and the node indices in cell i at
+    cell_items[cell_offsets[i]:cell_offsets[i + 1]].
+    """
+
+    def __init__(self, cell_size, cell_keys, cell_offsets, cell_items, xs,
+                 ys):
+        self.cell_size = cell_size
+        self.cell_keys = cell_keys
+        self.cell_offsets = cell_offsets
+        self.cell_items = cell_items
+        self.xs = xs
+        self.ys = ys
+
+    def __len__(self):
+        return len(self.xs)
+
+    def cell_of(self, x, y):
+        return (int(math.floor(x / self.cell_size)),
+                int(math.floor(y / self.cell_size)))
+
+    def _items_in_cell(self, cx, cy):
+        key = _cell_key(cx, cy)
+        i = bisect.bisect_left(self.cell_keys, key)
+        if i == len(self.cell_keys) or self.cell_keys[i] != key:
+            return ()
+        return self.cell_items[self.cell_offsets[i]:self.cell_offsets[i + 1]]
+
+    def query_radius(self, x, y, radius, strict=False):
+        min_cx, min_cy = self.cell_of(x - radius, y - radius)
+        max_cx, max_cy = self.cell_of(x + radius, y + radius)
+        num_cells = (max_cx - min_cx + 1) * (max_cy - min_cy + 1)
+        if num_cells > len(self.cell_keys):
+            candidates = self.cell_items
+        else:
+            candidates = [item for cx in range(min_cx, max_cx + 1)
+                          for cy in range(min_cy, max_cy + 1)
+                          for item in self._items_in_cell(cx, cy)]
+
+        out = []
+        for item in candidates:
+            dist = math.sqrt((self.xs[item] - x) ** 2 +
+                             (self.ys[item] - y) ** 2)
+            if dist < radius or (not strict and dist == radius):
+                out.append(item)
+        return out
+
+
+def _padding(length):
+    return b'\0' * (-length % _ALIGNMENT)
+
+
+def write_graph_file(path, graph, pt_index, header):
+    """
+    Writes a CompactGraph and the PointGridIndex over its node indices to
+    path. header is a JSON serializable dict, such as the version of the
+    trajectories the graph was built from, returned again by
+    open_graph_file.
+    """
+    cells = sorted(pt_index.cells.items(),
+                   key=lambda cell: _cell_key(*cell[0]))
+    cell_keys = [_cell_key(cx, cy) for (cx, cy), _ in cells]
+    cell_offsets = [0]
+    cell_items = []
+    for _, items in cells:
+        cell_items.extend(items)
+        cell_offsets.append(len(cell_items))
+
+    header = dict(header)
+    header.update({'byteorder': sys.byteorder,
+                   'num_nodes': len(graph),
+                   'num_edges': len(graph.neighbors),
+                   'num_cells': len(cell_keys),
+                   'cell_size': pt_index.cell_size})
+    header_bytes = json.dumps(header).encode('utf-8')
+    chunks = [_PREFIX.pack(MAGIC, len(header_bytes)), header_bytes]
+    chunks.append(_padding(_PREFIX.size + len(header_bytes)))
+    for typecode, values in (('d', graph.xs), ('d', graph.ys),
+                             ('i', graph.components), ('i', graph.offsets),
+                             ('i', graph.neighbors), ('d', graph.weights),
+                             ('q', cell_keys), ('i', cell_offsets),
+                             ('i', cell_items)):
+        data = struct.pack('=' + str(len(values)) + typecode, *values)
+        chunks.append(data)
+        chunks.append(_padding(len(data)))
+
+    directory = os.path.dirname(path) or '.'
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+            # mkstemp makes files only their owner can read, but processes
+            # running as other users map them too.
+            os.fchmod(f.fileno(), 0o644)
+        os.rename(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Holds an exclusive lock on the file at path, creating it if need be, for
+    the duration of a with block. Processes on the same machine that lock the
+    same path take turns.
+    """
+    with open(path, 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def open_graph_file(path):
+    """
+    Maps a file written by write_graph_file and returns (header, graph,
+    pt_index), whose arrays read straight from the mapping. Raises ValueError
+    if the file isn't a graph file this machine can read.
+    """
+    with open(path, 'rb') as f:
+        # ctypes only wraps writable buffers, so the file is mapped copy on
+        # write. Nothing ever writes to it, so its pages stay shared.
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    if len(data) < _PREFIX.size:
+        raise ValueError("{} is too short to be a graph file".format(path))
+    magic, header_length = _PREFIX.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("{} is not a graph file".format(path))
+    pos = _PREFIX.size + header_length
+    header = json.loads(data[_PREFIX.size:pos].decode('utf-8'))
+    if header['byteorder'] != sys.byteorder:
+        raise ValueError("{} was written on a {} endian machine".format(
+            path, header['byteorder']))
+    pos += len(_padding(pos))
+
+    num_nodes, num_edges = header['num_nodes'], header['num_edges']
+    num_cells = header['num_cells']
+    arrays = []
+    for typecode, length in (('d', num_nodes), ('d', num_nodes),
+                             ('i', num_nodes), ('i', num_nodes + 1),
+                             ('i', num_edges), ('d', num_edges),
+                             ('q', num_cells), ('i', num_cells + 1),
+                             ('i', num_nodes)):
+        array_type = _CTYPES[typecode] * length
+        if pos + ctypes.sizeof(array_type) > len(data):
+            raise ValueError("{} is truncated".format(path))
+        arrays.append(array_type.from_buffer(data, pos))
+        pos += ctypes.sizeof(array_type)
+        pos += len(_padding(pos))
+
+    xs, ys, components, offsets, neighbors, weights, \
+        cell_keys, cell_offsets, cell_items = arrays
+    graph = CompactGraph(xs, ys, components, offsets, neighbors, weights)
+    pt_index = MappedPointIndex(header['cell_size'], cell_keys, cell_offsets,
+                                cell_items, xs, ys)
+    return header, graph, pt_index
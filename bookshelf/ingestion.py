@@ -0,0 +1,116 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Parsing and validation of bulk trajectory uploads. A whole upload is checked
+before anything is stored, so a bad trajectory rejects the request instead of
+leaving half of it written.
+
+Uploads are either JSON lines, one trajectory per line given as a list of
+{'lat': ..., 'lng': ...} points or as {'path': [...], 'drawn': true}, or a
+list of trajectories in the packed encoding of trajectory_encoding.
+"""
+
+import json
+import math
+import numbers
+import string
+
+from bookshelf import trajectory_encoding
+
+MAX_TRAJECTORIES_PER_UPLOAD = 10000
+MAX_POINTS_PER_TRAJECTORY = 10000
+MAX_UPLOAD_ID_LENGTH = 100
+_UPLOAD_ID_CHARS = frozenset(string.ascii_letters + string.digits + '-_.')
+
+
+def validate_trajectory(path, where):
+    """Returns the path as a list of {'lat', 'lng'} float dicts, or raises
+    ValueError naming where in the upload the bad trajectory was."""
+    if not isinstance(path, list) or not path:
+        raise ValueError(where + ": trajectory must be a non empty list")
+    if len(path) > MAX_POINTS_PER_TRAJECTORY:
+        raise ValueError(where + ": trajectory has more than " +
+                         str(MAX_POINTS_PER_TRAJECTORY) + " points")
+    out = []
+    for i, pt in enumerate(path):
+        try:
+            lat, lng = pt['lat'], pt['lng']
+        except (KeyError, TypeError):
+            raise ValueError(where + ": point " + str(i) +
+                             " needs a lat and a lng")
+        for value in (lat, lng):
+            if not isinstance(value, numbers.Real) or \
+                    isinstance(value, bool) or \
+                    math.isnan(value) or math.isinf(value):
+                raise ValueError(where + ": point " + str(i) +
+                                 " has a non numeric coordinate")
+        if not (-90.0 <= lat <= 90.0 and -180.0 <= lng <= 180.0):
+            raise ValueError(where + ": point " + str(i) + " is off the map")
+        out.append({'lat': float(lat), 'lng': float(lng)})
+    return out
+
+
+def validate_upload_id(upload_id):
+    """Returns an upload id a client picked to make retrying its upload
+    safe, or raises ValueError if it can't be used in a Datastore key."""
+    if not upload_id or len(upload_id) > MAX_UPLOAD_ID_LENGTH:
+        raise ValueError("upload id must be 1 to " +
+                         str(MAX_UPLOAD_ID_LENGTH) + " characters")
+    if not all(c in _UPLOAD_ID_CHARS for c in upload_id):
+        raise ValueError("upload id may only contain letters, digits, "
+                         "'-', '_' and '.'")
+    return upload_id
+
+
+def _check_count(num_trajectories):
+    if num_trajectories > MAX_TRAJECTORIES_PER_UPLOAD:
+        raise ValueError("uploads are limited to " +
+                         str(MAX_TRAJECTORIES_PER_UPLOAD) + " trajectories")
+
+
+def parse_json_lines(data, drawn_by_hand=False):
+    """Returns (path, drawn by hand) pairs for each line of the upload."""
+    out = []
+    for line_num, line in enumerate(data.splitlines(), 1):
+        if not line.strip():
+            continue
+        where = "line " + str(line_num)
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise ValueError(where + ": not valid JSON")
+        drawn = drawn_by_hand
+        if isinstance(record, dict):
+            drawn = bool(record.get('drawn', drawn_by_hand))
+            record = record.get('path')
+        out.append((validate_trajectory(record, where), drawn))
+        _check_count(len(out))
+    return out
+
+
+def parse_packed(data, drawn_by_hand=False):
+    """Like parse_json_lines, for a packed list of trajectories."""
+    if not trajectory_encoding.is_packed(data):
+        raise ValueError("upload is not in the packed encoding")
+    try:
+        trajectories = trajectory_encoding.decode(data)
+    except Exception:
+        raise ValueError("upload is not in the packed encoding")
+    if not isinstance(trajectories, list) or \
+            (trajectories and not isinstance(trajectories[0], list)):
+        raise ValueError("packed upload must be a list of trajectories")
+    _check_count(len(trajectories))
+    return [(validate_trajectory(path, "trajectory " + str(i)), drawn_by_hand)
+            for i, path in enumerate(trajectories)]
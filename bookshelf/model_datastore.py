@@ -12,10 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
 from flask import current_app
 from gcloud import datastore
 import json
+from multiprocessing.pool import ThreadPool
 from polypaths_planar_override import Point
+import random
+import threading
+import time
+from bookshelf import trajectory_encoding
+from bookshelf.write_buffer import WriteBehindBuffer
 
 builtin_list = list
 
@@ -30,6 +37,14 @@ PARTITION_TRAJ_ATTR_NAME = 'segments'
 RESULTS_TABLE_NAME = 'FilteredTrajectories'
 RESULTS_ATTR_NAME = 'trajectories'
 RESULTS_DEFAULT_ID = 3
+# Coarser copies of the filtered trajectories are stored in the same table,
+# one per level of detail, under named keys.
+RESULTS_SIMPLIFIED_KEY_PREFIX = 'simplified-'
+
+# Contraction hierarchies for routing, keyed by the max inter trajectory
+# distance of the point graph they were built over.
+ROUTING_HIERARCHY_TABLE = 'RoutingHierarchy'
+ROUTING_HIERARCHY_ATTR_NAME = 'hierarchy'
 
 NEIGHBOR_COUNTS_TABLE = 'NeighborCounts'
 NEIGHBOR_COUNTS_DEFAULT_ID = 1
@@ -39,14 +54,150 @@ RAW_TRAJECTORY_TABLE = 'RawTrajectoryTable'
 RAW_TRAJECTORY_TRAJ_ATTR_NAME = 'trajectory'
 RAW_TRAJECTORY_DRAWN_ATTR_NAME = 'drawn'
 RAW_TRAHECTORY_DEFAULT_ID = 1
+RAW_TRAJECTORY_PAGE_SIZE = 500
+
+LOCATION_UPDATE_TABLE = 'LocationUpdate'
+LOCATION_UPDATE_PAGE_SIZE = 1000
+
+PARTITION_CACHE_TABLE = 'PartitionCache'
+PARTITION_CACHE_ATTR_NAME = 'partition_indices'
+
+# Datastore caps how many entities a single lookup or commit may touch.
+MAX_KEYS_PER_GET = 1000
+MAX_ENTITIES_PER_PUT = 500
+
+RESULT_VERSIONS_TABLE = 'ResultVersions'
+RESULT_VERSION_ATTR_NAME = 'generation'
+
+# Raw trajectories get a new version with every upload, more often than a
+# single entity can be written (about once a second), so their version is
+# spread over this many entities. Each upload writes a random one, and the
+# version is the latest of them.
+RAW_TRAJECTORIES_VERSION_SHARDS = 16
+
+# Large results are split over several shard entities, each kept under the
+# Datastore entity size limit, plus a small manifest entity at the result's
+# usual key recording the generation and number of shards.
+RESULT_SHARD_KIND_SUFFIX = 'Shard'
+RESULT_SHARD_ATTR_NAME = 'items'
+RESULT_NUM_SHARDS_ATTR_NAME = 'num_shards'
+RESULT_SHARD_MAX_BYTES = 900 * 1024
+RESULT_SHARDS_PER_RPC = 8
+RESULT_SHARD_IO_THREADS = 8
+
+# How many levels of lists sit above the {'lat', 'lng'} points in each kind
+# of stored result, needed to pack them in the binary encoding.
+RESULTS_POINT_DEPTH = 2
+PARTITION_TRAJ_POINT_DEPTH = 2
+CLUSTERS_POINT_DEPTH = 3
+
+class ResultReplacedError(ValueError):
+    """Raised when a sharded result is replaced by a newer generation while
+    it's being read."""
+
+
+class ClientPool(object):
+    """
+    Hands out one datastore.Client per thread, created the first time the
+    thread asks for one and reused after that. Building a client sets up its
+    own HTTP connection and credentials, which costs more than most of the
+    requests made with it, but clients aren't thread safe, so they can't
+    simply be shared.
+    """
+
+    def __init__(self, dataset_id):
+        self.dataset_id = dataset_id
+        self.num_clients_created = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def get(self):
+        client = getattr(self._local, 'client', None)
+        if client == None:
+            client = datastore.Client(dataset_id=self.dataset_id)
+            self._local.client = client
+            with self._lock:
+                self.num_clients_created += 1
+        return client
+
+    def stats(self):
+        return {'dataset_id': self.dataset_id, \
+                'num_clients_created': self.num_clients_created}
+
+_client_pool = None
+_write_buffer = None
+
+# Threads for map_with_clients, kept around between calls so that their
+# clients are too.
+_io_thread_pools = {}
+_io_thread_pools_lock = threading.Lock()
+
 
 def init_app(app):
-    pass
+    global _client_pool, _write_buffer
+    _client_pool = ClientPool(app.config['DATASTORE_DATASET_ID'])
+
+    if _write_buffer != None:
+        _write_buffer.close()
+        _write_buffer = None
+    if app.config.get('WRITE_BEHIND_ENABLED'):
+        def _flush(batch):
+            with app.app_context():
+                store_new_trajectory_updates(batch)
+        _write_buffer = WriteBehindBuffer(_flush, \
+            max_batch_size=app.config.get('WRITE_BEHIND_MAX_BATCH_SIZE', MAX_ENTITIES_PER_PUT), \
+            flush_interval=app.config.get('WRITE_BEHIND_FLUSH_SECONDS', 1.0), \
+            max_pending=app.config.get('WRITE_BEHIND_MAX_PENDING', 10000))
+
+
+@atexit.register
+def _close_write_buffer():
+    """Writes whatever the current write buffer still holds before the
+    process exits."""
+    if _write_buffer != None:
+        _write_buffer.close()
 
 
 def get_client():
-    return datastore.Client(
-        dataset_id=current_app.config['DATASTORE_DATASET_ID'])
+    if _client_pool == None:
+        init_app(current_app)
+    return _client_pool.get()
+
+
+def get_client_pool_stats():
+    if _client_pool == None:
+        return None
+    return _client_pool.stats()
+
+
+def get_write_buffer_stats():
+    if _write_buffer == None:
+        return None
+    return _write_buffer.stats()
+
+
+def _get_io_thread_pool(num_threads):
+    with _io_thread_pools_lock:
+        pool = _io_thread_pools.get(num_threads)
+        if pool == None:
+            pool = ThreadPool(num_threads)
+            _io_thread_pools[num_threads] = pool
+        return pool
+
+
+def map_with_clients(func, args_list, num_threads):
+    """Calls func(client, args) for each args on a pool of threads and
+    returns the results in order, each thread using its own pooled client."""
+    if len(args_list) <= 1:
+        return [func(get_client(), args) for args in args_list]
+
+    if _client_pool == None:
+        init_app(current_app)
+    client_pool = _client_pool
+
+    def _func(args):
+        return func(client_pool.get(), args)
+    return _get_io_thread_pool(num_threads).map(_func, args_list)
 
 
 def from_datastore(entity):
@@ -76,35 +227,116 @@ def list(limit=10, cursor=None):
     entities = builtin_list(map(from_datastore, entities))
     return entities, cursor if len(entities) == limit else None
 
-def store_new_trajectory_update(new_trajectory, drawn_by_hand):
-    ds = get_client()
-    key = ds.key(RAW_TRAJECTORY_TABLE)
+def raw_trajectory_key_name(upload_id, index):
+    """Name of the index'th trajectory of the upload with the given id."""
+    return 'upload-{}-{}'.format(upload_id, index)
+
+def _raw_trajectory_entity(ds, new_trajectory, drawn_by_hand, key_name=None):
+    key = ds.key(RAW_TRAJECTORY_TABLE, key_name) if key_name != None \
+    else ds.key(RAW_TRAJECTORY_TABLE)
     entity = datastore.Entity(key=key, \
                               exclude_from_indexes=[RAW_TRAJECTORY_TRAJ_ATTR_NAME, \
                                                     RAW_TRAJECTORY_DRAWN_ATTR_NAME])
     entity.update({RAW_TRAJECTORY_TRAJ_ATTR_NAME: json.dumps(new_trajectory), \
                    RAW_TRAJECTORY_DRAWN_ATTR_NAME: drawn_by_hand})
-    ds.put(entity)
+    return entity
+
+def _raw_trajectories_version_key_ids():
+    # The unsharded key is where the version was written before sharding.
+    return [RAW_TRAHECTORY_DEFAULT_ID] + \
+        ['{}-{}'.format(RAW_TRAHECTORY_DEFAULT_ID, shard) \
+         for shard in range(RAW_TRAJECTORIES_VERSION_SHARDS)]
+
+def _raw_trajectories_version_entity(ds):
+    key_id = '{}-{}'.format(RAW_TRAHECTORY_DEFAULT_ID, \
+                            random.randrange(RAW_TRAJECTORIES_VERSION_SHARDS))
+    return _result_version_entity(ds, RAW_TRAJECTORY_TABLE, key_id, new_result_version())
+
+def get_raw_trajectories_version():
+    ds = get_client()
+    keys = [_result_version_key(ds, RAW_TRAJECTORY_TABLE, key_id) \
+            for key_id in _raw_trajectories_version_key_ids()]
+    versions = [entity[RESULT_VERSION_ATTR_NAME] for entity in ds.get_multi(keys)]
+    return max(versions) if versions else None
+
+def store_new_trajectory_update(new_trajectory, drawn_by_hand):
+    """Stores an uploaded trajectory, or queues it in the write behind
+    buffer when that's enabled."""
+    if _write_buffer != None:
+        _write_buffer.add((new_trajectory, drawn_by_hand))
+        return
+    ds = get_client()
+    ds.put_multi([_raw_trajectory_entity(ds, new_trajectory, drawn_by_hand), \
+                  _raw_trajectories_version_entity(ds)])
+
+def store_new_trajectory_updates(trajectories, upload_id=None):
+    """
+    Stores many (trajectory, drawn by hand) pairs, MAX_ENTITIES_PER_PUT per
+    request with several requests in flight, and then bumps the raw
+    trajectories' version once for all of them.
+    
+    With an upload_id, each trajectory is keyed by it and its place in the
+    upload, so if some of the requests fail, storing the same upload again
+    overwrites the ones that made it instead of duplicating them. Without
+    one, every trajectory stored is a new one, even if an identical one is
+    already there.
+    """
+    ds = get_client()
+    entities = [_raw_trajectory_entity(ds, traj, drawn, \
+                                       raw_trajectory_key_name(upload_id, i) \
+                                       if upload_id != None else None) \
+                for i, (traj, drawn) in enumerate(trajectories)]
+    map_with_clients(_put_entities, \
+                     [entities[i:i + MAX_ENTITIES_PER_PUT] \
+                      for i in range(0, len(entities), MAX_ENTITIES_PER_PUT)], \
+                     RESULT_SHARD_IO_THREADS)
+    ds.put(_raw_trajectories_version_entity(ds))
     
 def get_raw_trajectories():
+    return builtin_list(iter_raw_trajectories())
+
+def get_raw_trajectories_page(page_size=RAW_TRAJECTORY_PAGE_SIZE, cursor=None):
+    """Returns a page of decoded raw trajectories and the cursor of the next
+    page, or None after the last one."""
     ds = get_client()
     query = ds.query(kind=RAW_TRAJECTORY_TABLE)
-    out = []
-    for traj in map(from_datastore, query.fetch()):
-        out.append(json.loads(traj[RAW_TRAJECTORY_TRAJ_ATTR_NAME]))
-    return out
+    it = query.fetch(limit=page_size, start_cursor=cursor)
+    entities, more_results, cursor = it.next_page()
+    trajectories = [json.loads(e[RAW_TRAJECTORY_TRAJ_ATTR_NAME]) for e in entities]
+    return trajectories, cursor if len(entities) == page_size else None
+
+def iter_raw_trajectories(page_size=RAW_TRAJECTORY_PAGE_SIZE):
+    """Yields each stored raw trajectory, decoded, reading them from Datastore
+    one page at a time so only a page's worth is held in memory."""
+    ds = get_client()
+    query = ds.query(kind=RAW_TRAJECTORY_TABLE)
+    for traj in fetch_all_pages(query, page_size):
+        yield json.loads(traj[RAW_TRAJECTORY_TRAJ_ATTR_NAME])
+
+def fetch_all_pages(query, page_size):
+    """Runs a query to completion one page at a time, yielding entities as
+    each page arrives."""
+    cursor = None
+    while True:
+        it = query.fetch(limit=page_size, start_cursor=cursor)
+        entities, more_results, cursor = it.next_page()
+        for entity in entities:
+            yield entity
+        # more_results is False whenever a page stops at its limit, so like
+        # list() only a short page means the query is done.
+        if len(entities) < page_size or not cursor:
+            return
 
 def get_all_locations_from_source_id(source_id):
     out = []
     ds = get_client()
-    query = ds.query(kind='LocationUpdate')
+    query = ds.query(kind=LOCATION_UPDATE_TABLE)
     query.add_filter(property_name='sourceId', operator='=', value=source_id)
     for update in sorted(map(from_datastore, query.fetch()), key=lambda x:x['updateTime']):
         out.append({'lat': update['latitude'], 'lng': update['longitude']})
     return out
 
 def store_partitioned_trajectories(partitioned_line_segs, key_id=PARTITION_TRAJ_DEFAULT_ID):
-    ds = get_client()
     out = []
     if len(partitioned_line_segs) == 0:
         raise ValueError("length of partitioned line segs is " + \
@@ -113,11 +345,32 @@ def store_partitioned_trajectories(partitioned_line_segs, key_id=PARTITION_TRAJ_
     for segment in map(lambda t: t.line_segment, partitioned_line_segs):
         out.append([{'lat': segment.start.x, 'lng': segment.start.y}, \
                     {'lat': segment.end.x, 'lng': segment.end.y}])
-    key = ds.key(PARTITIONED_TRAJ_TABLE, key_id)
-    entity = datastore.Entity(key=key, exclude_from_indexes=[PARTITION_TRAJ_ATTR_NAME])
-    entity.update({PARTITION_TRAJ_ATTR_NAME: json.dumps(out)})
-    ds.put(entity)
+    store_sharded_result(PARTITIONED_TRAJ_TABLE, key_id, out, \
+                         point_depth=PARTITION_TRAJ_POINT_DEPTH)
     
+def get_cached_partitions(content_hashes):
+    """Looks up previously computed partition indices for trajectories, by
+    the content hash of each trajectory. Returns {content hash: indices} for
+    the hashes that were found."""
+    ds = get_client()
+    keys = map(lambda h: ds.key(PARTITION_CACHE_TABLE, h), content_hashes)
+    out = {}
+    for i in range(0, len(keys), MAX_KEYS_PER_GET):
+        for entity in ds.get_multi(keys[i:i + MAX_KEYS_PER_GET]):
+            out[entity.key.name] = json.loads(entity[PARTITION_CACHE_ATTR_NAME])
+    return out
+
+def store_cached_partitions(partitions_by_content_hash):
+    ds = get_client()
+    entities = []
+    for content_hash, partition_indices in partitions_by_content_hash.items():
+        entity = datastore.Entity(key=ds.key(PARTITION_CACHE_TABLE, content_hash), \
+                                  exclude_from_indexes=[PARTITION_CACHE_ATTR_NAME])
+        entity.update({PARTITION_CACHE_ATTR_NAME: json.dumps(partition_indices)})
+        entities.append(entity)
+    for i in range(0, len(entities), MAX_ENTITIES_PER_PUT):
+        ds.put_multi(entities[i:i + MAX_ENTITIES_PER_PUT])
+
 def filter_trajectories(trajectories):
     out = []
     for source_id in trajectories:
@@ -126,16 +379,11 @@ def filter_trajectories(trajectories):
             out.append(map(lambda x: Point(x['lat'], x['lng']), traj))
     return out
     
-def get_partitioned_trajectories(key_id=PARTITION_TRAJ_DEFAULT_ID):
-    ds = get_client()
-    key = ds.key(PARTITIONED_TRAJ_TABLE, key_id)
-    results = from_datastore(ds.get(key))
-    return json.loads(results[PARTITION_TRAJ_ATTR_NAME])
+def get_partitioned_trajectories(key_id=PARTITION_TRAJ_DEFAULT_ID, shard_indices=None):
+    return get_sharded_result(PARTITIONED_TRAJ_TABLE, key_id, PARTITION_TRAJ_ATTR_NAME, \
+                              shard_indices=shard_indices)[0]
 
 def store_clusters(clusters, key_id=CLUSTERS_DEFAULT_ID):
-    ds = get_client()
-    key = ds.key(CLUSTERS_TABLE, key_id)
-    entity = datastore.Entity(key=key, exclude_from_indexes=[CLUSTERS_ATTR_NAME])
     out = []
     if len(clusters) == 0:
         return
@@ -147,8 +395,7 @@ def store_clusters(clusters, key_id=CLUSTERS_DEFAULT_ID):
             in_cluster_list.append([{'lat': seg.start.x, 'lng': seg.start.y}, \
                                     {'lat': seg.end.x, 'lng': seg.end.y}])
         out.append(in_cluster_list)
-    entity.update({CLUSTERS_ATTR_NAME: json.dumps(out)})
-    ds.put(entity)
+    store_sharded_result(CLUSTERS_TABLE, key_id, out, point_depth=CLUSTERS_POINT_DEPTH)
     
 def store_line_segment_neighbor_counts(line_segments, key_id=NEIGHBOR_COUNTS_DEFAULT_ID):
     ds = get_client()
@@ -164,39 +411,292 @@ def get_line_segment_neighbor_counts(key_id=NEIGHBOR_COUNTS_DEFAULT_ID):
     results = from_datastore(ds.get(key))
     return json.loads(results[NEIGHBOR_COUNTS_ATTR_NAME])
     
-def get_clusters(key_id=CLUSTERS_DEFAULT_ID):
+def get_clusters(key_id=CLUSTERS_DEFAULT_ID, shard_indices=None):
+    return get_sharded_result(CLUSTERS_TABLE, key_id, CLUSTERS_ATTR_NAME, \
+                              shard_indices=shard_indices)[0]
+
+def new_result_version():
+    """Returns a generation number for a freshly written result. Generations
+    only ever grow, so readers can compare them to tell when a result they
+    cached has been replaced."""
+    return int(time.time() * 1000000)
+
+def _result_version_key(ds, table_name, key_id):
+    return ds.key(RESULT_VERSIONS_TABLE, '{}-{}'.format(table_name, key_id))
+
+def _result_version_entity(ds, table_name, key_id, version):
+    entity = datastore.Entity(key=_result_version_key(ds, table_name, key_id))
+    entity.update({RESULT_VERSION_ATTR_NAME: version})
+    return entity
+
+def get_result_version(table_name, key_id):
+    """Reads the generation of a stored result without downloading the
+    result itself. Returns None if the result has never been versioned."""
+    if table_name == RAW_TRAJECTORY_TABLE and key_id == RAW_TRAHECTORY_DEFAULT_ID:
+        return get_raw_trajectories_version()
     ds = get_client()
-    key = ds.key(CLUSTERS_TABLE, key_id)
-    results = from_datastore(ds.get(key))
-    return json.loads(results[CLUSTERS_ATTR_NAME])
+    entity = ds.get(_result_version_key(ds, table_name, key_id))
+    if not entity:
+        return None
+    return entity[RESULT_VERSION_ATTR_NAME]
+
+def _shard_key(ds, table_name, key_id, version, shard_index):
+    return ds.key(table_name + RESULT_SHARD_KIND_SUFFIX, \
+                  '{}-{}-{}'.format(key_id, version, shard_index))
+
+def _chunk_encoded_items(items, max_bytes):
+    """Splits items into JSON encoded lists of at most max_bytes each (a
+    single item bigger than that gets a chunk of its own). Returns a
+    (start, end, JSON) tuple for each chunk of items[start:end]."""
+    chunks = []
+    cur_parts, cur_size, cur_start = [], 2, 0
+    for i, item in enumerate(items):
+        encoded = json.dumps(item)
+        if cur_parts and cur_size + len(encoded) + 1 > max_bytes:
+            chunks.append((cur_start, i, '[' + ','.join(cur_parts) + ']'))
+            cur_parts, cur_size, cur_start = [], 2, i
+        cur_parts.append(encoded)
+        cur_size += len(encoded) + 1
+    if cur_parts or not chunks:
+        chunks.append((cur_start, len(items), '[' + ','.join(cur_parts) + ']'))
+    return chunks
+
+def _get_result_encoding():
+    return current_app.config.get('RESULT_ENCODING', 'json')
+
+def _put_entities(ds, entities):
+    ds.put_multi(entities)
+
+def _get_entities(ds, keys):
+    return ds.get_multi(keys)
+
+def store_sharded_result(table_name, key_id, items, point_depth=None):
+    """
+    Stores a list of JSON serializable items as a sharded result. The shards
+    of a new generation are all written, in parallel, before the manifest is
+    switched over to them, and the previous generation's shards are deleted
+    afterwards. Returns the new generation.
+    
+    When the app's RESULT_ENCODING is 'packed' and point_depth says how
+    deeply the items nest lists of points, shards are stored in the compact
+    binary form from trajectory_encoding instead of JSON.
+    """
+    ds = get_client()
+    packed = point_depth != None and _get_result_encoding() == 'packed'
+    version = new_result_version()
+    manifest_key = ds.key(table_name, key_id)
+    old_manifest = ds.get(manifest_key)
+    
+    shard_entities = []
+    for shard_index, (start, end, chunk) in \
+    enumerate(_chunk_encoded_items(items, RESULT_SHARD_MAX_BYTES)):
+        if packed:
+            chunk = trajectory_encoding.encode(items[start:end], point_depth)
+        entity = datastore.Entity(key=_shard_key(ds, table_name, key_id, version, shard_index), \
+                                  exclude_from_indexes=[RESULT_SHARD_ATTR_NAME])
+        entity.update({RESULT_SHARD_ATTR_NAME: chunk})
+        shard_entities.append(entity)
+    map_with_clients(_put_entities, \
+                     [shard_entities[i:i + RESULT_SHARDS_PER_RPC] \
+                      for i in range(0, len(shard_entities), RESULT_SHARDS_PER_RPC)], \
+                     RESULT_SHARD_IO_THREADS)
+    
+    manifest = datastore.Entity(key=manifest_key)
+    manifest.update({RESULT_VERSION_ATTR_NAME: version, \
+                     RESULT_NUM_SHARDS_ATTR_NAME: len(shard_entities)})
+    ds.put_multi([manifest, _result_version_entity(ds, table_name, key_id, version)])
+    
+    if old_manifest and RESULT_NUM_SHARDS_ATTR_NAME in old_manifest:
+        old_keys = [_shard_key(ds, table_name, key_id, \
+                               old_manifest[RESULT_VERSION_ATTR_NAME], i) \
+                    for i in range(old_manifest[RESULT_NUM_SHARDS_ATTR_NAME])]
+        for i in range(0, len(old_keys), MAX_ENTITIES_PER_PUT):
+            ds.delete_multi(old_keys[i:i + MAX_ENTITIES_PER_PUT])
+    return version
+
+def get_result_manifest(table_name, key_id):
+    """Returns (generation, number of shards) for a stored result."""
+    ds = get_client()
+    manifest = ds.get(ds.key(table_name, key_id))
+    if not manifest:
+        raise ValueError("no result stored for {} {}".format(table_name, key_id))
+    return manifest.get(RESULT_VERSION_ATTR_NAME), \
+        manifest.get(RESULT_NUM_SHARDS_ATTR_NAME, 1)
 
-def store_filtered_trajectories(filtered_trajectories, key_id=RESULTS_DEFAULT_ID):
+def get_sharded_result(table_name, key_id, legacy_attr_name, shard_indices=None):
+    """
+    Reads a result written by store_sharded_result, fetching its shards in
+    parallel, and returns (items, generation). With shard_indices only those
+    shards are fetched, in the order given. Results from before sharding,
+    stored whole under legacy_attr_name on the manifest's key, are still
+    read.
+    """
+    try:
+        return _read_sharded_result(table_name, key_id, legacy_attr_name, shard_indices)
+    except ResultReplacedError:
+        # The old generation's shards were deleted mid read, but by then the
+        # manifest already points at the new ones.
+        return _read_sharded_result(table_name, key_id, legacy_attr_name, shard_indices)
+
+def _read_sharded_result(table_name, key_id, legacy_attr_name, shard_indices):
+    items = []
+    version = None
+    for shard_items, version in iter_sharded_result(table_name, key_id, legacy_attr_name, \
+                                                    shard_indices=shard_indices):
+        items.extend(shard_items)
+    return items, version
+
+def iter_sharded_result(table_name, key_id, legacy_attr_name, shard_indices=None):
+    """Like get_sharded_result, but yields (shard items, generation) one shard
+    at a time, fetching RESULT_SHARDS_PER_RPC shards per request."""
     ds = get_client()
+    manifest = ds.get(ds.key(table_name, key_id))
+    if not manifest:
+        raise ValueError("no result stored for {} {}".format(table_name, key_id))
+    version = manifest.get(RESULT_VERSION_ATTR_NAME)
+    if legacy_attr_name in manifest:
+        yield trajectory_encoding.decode(manifest[legacy_attr_name]), version
+        return
+    
+    if shard_indices == None:
+        shard_indices = range(manifest[RESULT_NUM_SHARDS_ATTR_NAME])
+    keys = [_shard_key(ds, table_name, key_id, version, i) for i in shard_indices]
+    key_batches = [keys[i:i + RESULT_SHARDS_PER_RPC * RESULT_SHARD_IO_THREADS] \
+                   for i in range(0, len(keys), RESULT_SHARDS_PER_RPC * RESULT_SHARD_IO_THREADS)]
+    for batch in key_batches:
+        entities_by_name = {}
+        for entities in map_with_clients(_get_entities, \
+                                          [batch[i:i + RESULT_SHARDS_PER_RPC] \
+                                           for i in range(0, len(batch), RESULT_SHARDS_PER_RPC)], \
+                                          RESULT_SHARD_IO_THREADS):
+            for entity in entities:
+                entities_by_name[entity.key.name] = entity
+        for key in batch:
+            if key.name not in entities_by_name:
+                raise ResultReplacedError("shard {} of {} {} is gone".format(key.name, \
+                                                                             table_name, key_id))
+            yield trajectory_encoding.decode(entities_by_name[key.name][RESULT_SHARD_ATTR_NAME]), \
+                version
+
+def store_filtered_trajectories(filtered_trajectories, key_id=RESULTS_DEFAULT_ID):
     out = []
     for single_traj in filtered_trajectories:
         out.append(map(lambda p: {'lat':p.x, 'lng':p.y}, single_traj))
-    key = ds.key(RESULTS_TABLE_NAME, key_id)
-    entity = datastore.Entity(key=key, exclude_from_indexes=[RESULTS_ATTR_NAME])
-    entity.update({RESULTS_ATTR_NAME: json.dumps(out)})
-    ds.put(entity)
+    return store_sharded_result(RESULTS_TABLE_NAME, key_id, out, \
+                                point_depth=RESULTS_POINT_DEPTH)
     
-def get_filtered_trajectories(key_id=RESULTS_DEFAULT_ID):
-    ds = get_client()
-    key = ds.key(RESULTS_TABLE_NAME, key_id)
-    trajectories = from_datastore(ds.get(key))
-    return json.loads(trajectories[RESULTS_ATTR_NAME])
+def get_filtered_trajectories(key_id=RESULTS_DEFAULT_ID, shard_indices=None):
+    return get_sharded_result(RESULTS_TABLE_NAME, key_id, RESULTS_ATTR_NAME, \
+                              shard_indices=shard_indices)[0]
+
+def get_filtered_trajectories_with_version(key_id=RESULTS_DEFAULT_ID):
+    return get_sharded_result(RESULTS_TABLE_NAME, key_id, RESULTS_ATTR_NAME)
+
+def get_filtered_trajectories_version(key_id=RESULTS_DEFAULT_ID):
+    return get_result_version(RESULTS_TABLE_NAME, key_id)
+
+def filtered_trajectories_key_id(level):
+    """Key of the filtered trajectories at a level of detail, where level 0
+    is the full resolution result."""
+    if level == 0:
+        return RESULTS_DEFAULT_ID
+    return RESULTS_SIMPLIFIED_KEY_PREFIX + str(level)
+
+def _routing_hierarchy_key_id(max_inter_traj_distance):
+    return repr(float(max_inter_traj_distance))
+
+def store_routing_hierarchy(max_inter_traj_distance, filtered_version, hierarchy_items):
+    """Stores the items of a ContractionHierarchy, along with the version of
+    the filtered trajectories its point graph was built from."""
+    header = {'filtered_version': filtered_version, 'num_nodes': len(hierarchy_items)}
+    return store_sharded_result(ROUTING_HIERARCHY_TABLE, \
+                                _routing_hierarchy_key_id(max_inter_traj_distance), \
+                                [header] + hierarchy_items)
+
+def get_routing_hierarchy_version(max_inter_traj_distance):
+    return get_result_version(ROUTING_HIERARCHY_TABLE, \
+                              _routing_hierarchy_key_id(max_inter_traj_distance))
+
+def get_routing_hierarchy(max_inter_traj_distance):
+    """Returns (filtered trajectories version, hierarchy items), or (None,
+    None) if no hierarchy is stored for the distance."""
+    if get_routing_hierarchy_version(max_inter_traj_distance) == None:
+        return None, None
+    items, version = get_sharded_result(ROUTING_HIERARCHY_TABLE, \
+                                        _routing_hierarchy_key_id(max_inter_traj_distance), \
+                                        ROUTING_HIERARCHY_ATTR_NAME)
+    return items[0]['filtered_version'], items[1:]
 
 def get_all_location_updates():
-    out = {}
+    """Returns {source id: [[{'lat': ..., 'lng': ...}, ...]]} with each
+    source's updates in update time order.
+
+    Root updates (sourceId 0) identify the sources. All updates are read in
+    one paged scan and grouped by sourceId, rather than running a separate
+    query per source.
+    """
     ds = get_client()
-    query = ds.query(kind='LocationUpdate')
-    query.add_filter(property_name='sourceId', operator='=', value=0)
-    location_update_roots = query.fetch()
-    for update_root in map(from_datastore, location_update_roots):
-        out[update_root['id']] = \
-        [get_all_locations_from_source_id(source_id=update_root['id'])]
+    query = ds.query(kind=LOCATION_UPDATE_TABLE)
+    root_ids = []
+    updates_by_source = {}
+    for update in map(from_datastore, fetch_all_pages(query, LOCATION_UPDATE_PAGE_SIZE)):
+        source_id = update.get('sourceId')
+        if source_id == 0:
+            root_ids.append(update['id'])
+        else:
+            updates_by_source.setdefault(source_id, []).append(update)
+    
+    out = {}
+    for root_id in root_ids:
+        updates = sorted(updates_by_source.get(root_id, []), key=lambda x:x['updateTime'])
+        out[root_id] = [map(lambda u: {'lat': u['latitude'], 'lng': u['longitude']}, \
+                            updates)]
     return out
 
+def _location_updates_by_source_query(ds):
+    query = ds.query(kind=LOCATION_UPDATE_TABLE, order=['sourceId', 'updateTime'])
+    query.add_filter(property_name='sourceId', operator='>', value=0)
+    return query
+
+def iter_location_updates_by_source(page_size=LOCATION_UPDATE_PAGE_SIZE):
+    """
+    Yields (source id, [{'lat': ..., 'lng': ...}, ...]) for each source, in
+    update time order, with only one source's updates held at a time. Like
+    get_location_updates_page, this needs the index in index.yaml and doesn't
+    check sources against their root updates.
+    """
+    ds = get_client()
+    source_id, updates = None, []
+    for update in fetch_all_pages(_location_updates_by_source_query(ds), page_size):
+        if update['sourceId'] != source_id:
+            if updates:
+                yield source_id, updates
+            source_id, updates = update['sourceId'], []
+        updates.append({'lat': update['latitude'], 'lng': update['longitude']})
+    if updates:
+        yield source_id, updates
+
+def get_location_updates_page(page_size=LOCATION_UPDATE_PAGE_SIZE, cursor=None):
+    """
+    Returns a page of location updates as {source id: [[{'lat': ..., 'lng':
+    ...}, ...]]}, and the cursor of the next page or None after the last one.
+
+    Updates are scanned in source and then update time order, so each source
+    comes out whole and in order, except that the last source of a page may
+    carry on at the start of the next one. Unlike get_all_location_updates,
+    sources aren't checked against their root updates. The scan needs the
+    composite index in index.yaml.
+    """
+    ds = get_client()
+    it = _location_updates_by_source_query(ds).fetch(limit=page_size, start_cursor=cursor)
+    entities, more_results, cursor = it.next_page()
+    
+    out = {}
+    for update in entities:
+        out.setdefault(update['sourceId'], [[]])[0].append({'lat': update['latitude'], \
+                                                            'lng': update['longitude']})
+    return out, cursor if len(entities) == page_size else None
+
 def list_by_user(user_id, limit=10, cursor=None):
     ds = get_client()
     query = ds.query(
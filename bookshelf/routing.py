@@ -0,0 +1,200 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Shortest paths over the point graph built from filtered trajectories.
+
+Edges are weighted by the straight line distance between their points, so
+the straight line distance to the destination never overestimates what's
+left to go, and A* can use it to steer the search towards the destination
+instead of spreading out in every direction like Dijkstra does.
+"""
+
+from array import array
+from heapq import heappop, heappush
+import math
+
+
+class CompactGraph(object):
+    """
+    A point graph in flat arrays: coordinates and component id per node, and
+    the neighbors of node i with the lengths of the edges to them at
+    neighbors[offsets[i]:offsets[i + 1]] and
+    weights[offsets[i]:offsets[i + 1]].
+    Node indices are the same as in the point graph it was built from.
+    """
+
+    def __init__(self, xs, ys, components, offsets, neighbors, weights):
+        self.xs = xs
+        self.ys = ys
+        self.components = components
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.weights = weights
+        # Version of the filtered trajectories the graph was built from, and
+        # the max inter trajectory distance it was built with, if known.
+        self.version = None
+        self.max_inter_traj_distance = None
+
+    def __len__(self):
+        return len(self.xs)
+
+    @classmethod
+    def from_point_graph(cls, pt_graph):
+        xs, ys, components = array('d'), array('d'), array('i')
+        offsets, neighbors, weights = array('i', [0]), array('i'), array('d')
+        for pt_node in pt_graph:
+            x, y = pt_node.point.x, pt_node.point.y
+            xs.append(x)
+            ys.append(y)
+            components.append(pt_node.graph_component_id
+                              if pt_node.graph_component_id is not None
+                              else -1)
+            for neighbor_index in sorted(pt_node.neighbor_indices):
+                other = pt_graph[neighbor_index].point
+                neighbors.append(neighbor_index)
+                weights.append(math.sqrt((other.x - x) ** 2 +
+                                         (other.y - y) ** 2))
+            offsets.append(len(neighbors))
+        return cls(xs, ys, components, offsets, neighbors, weights)
+
+    def distance(self, a, b):
+        return math.sqrt((self.xs[a] - self.xs[b]) ** 2 +
+                         (self.ys[a] - self.ys[b]) ** 2)
+
+
+def prune_to_shared_components(graph, sources, targets):
+    """
+    Drops the sources and targets that aren't in a component with at least
+    one of the other side, since no path can leave a component.
+    """
+    components = graph.components
+    shared = set(components[s] for s in sources) & \
+        set(components[t] for t in targets)
+    return [s for s in sources if components[s] in shared], \
+        [t for t in targets if components[t] in shared]
+
+
+def _reconstruct(back_edges, end):
+    path = [end]
+    while back_edges[path[-1]] != -1:
+        path.append(back_edges[path[-1]])
+    path.reverse()
+    return path
+
+
+def astar(graph, sources, targets):
+    """
+    Returns (path as a list of node indices, length) of the shortest path
+    from any of the sources to any of the targets, or (None, None) if there
+    is none.
+
+    The heuristic is the distance to the bounding box of the targets, which
+    never overestimates the distance to the nearest one and costs the same
+    however many targets there are.
+    """
+    sources, targets = prune_to_shared_components(graph, sources, targets)
+    if not sources or not targets:
+        return None, None
+
+    xs, ys = graph.xs, graph.ys
+    offsets, neighbors, weights = graph.offsets, graph.neighbors, graph.weights
+    target_set = set(targets)
+    min_tx = min(xs[t] for t in targets)
+    max_tx = max(xs[t] for t in targets)
+    min_ty = min(ys[t] for t in targets)
+    max_ty = max(ys[t] for t in targets)
+
+    def heuristic(i):
+        x, y = xs[i], ys[i]
+        dx = min_tx - x if x < min_tx else (x - max_tx if x > max_tx else 0.0)
+        dy = min_ty - y if y < min_ty else (y - max_ty if y > max_ty else 0.0)
+        return math.sqrt(dx * dx + dy * dy)
+
+    distances = {}
+    back_edges = {}
+    heap = []
+    for s in sources:
+        distances[s] = 0.0
+        back_edges[s] = -1
+        heappush(heap, (heuristic(s), 0.0, s))
+
+    while heap:
+        _, dist, u = heappop(heap)
+        if dist > distances[u]:
+            continue
+        if u in target_set:
+            return _reconstruct(back_edges, u), dist
+        for k in range(offsets[u], offsets[u + 1]):
+            v = neighbors[k]
+            new_dist = dist + weights[k]
+            if v not in distances or new_dist < distances[v]:
+                distances[v] = new_dist
+                back_edges[v] = u
+                heappush(heap, (new_dist + heuristic(v), new_dist, v))
+    return None, None
+
+
+def one_to_many(graph, sources, target_groups, with_paths=False):
+    """
+    Returns (distances, paths) with, for each list of targets in
+    target_groups, the length of the shortest path from any of the sources to
+    any of those targets and, if with_paths is set, the path as a list of
+    node indices, from a single Dijkstra search. Entries for groups that
+    can't be reached are None, and paths is None without with_paths.
+    """
+    components = graph.components
+    source_components = set(components[s] for s in sources)
+    groups_at = {}
+    num_groups_left = 0
+    for group, targets in enumerate(target_groups):
+        reachable = [t for t in targets if components[t] in source_components]
+        for t in reachable:
+            groups_at.setdefault(t, []).append(group)
+        if reachable:
+            num_groups_left += 1
+
+    offsets, neighbors, weights = graph.offsets, graph.neighbors, graph.weights
+    distances = {}
+    back_edges = {}
+    heap = []
+    for s in sources:
+        distances[s] = 0.0
+        back_edges[s] = -1
+        heappush(heap, (0.0, s))
+
+    group_distances = [None] * len(target_groups)
+    group_ends = [None] * len(target_groups)
+    while heap and num_groups_left:
+        dist, u = heappop(heap)
+        if dist > distances[u]:
+            continue
+        for group in groups_at.get(u, ()):
+            if group_ends[group] is None:
+                group_distances[group] = dist
+                group_ends[group] = u
+                num_groups_left -= 1
+        for k in range(offsets[u], offsets[u + 1]):
+            v = neighbors[k]
+            new_dist = dist + weights[k]
+            if v not in distances or new_dist < distances[v]:
+                distances[v] = new_dist
+                back_edges[v] = u
+                heappush(heap, (new_dist, v))
+
+    if not with_paths:
+        return group_distances, None
+    return group_distances, [_reconstruct(back_edges, end)
+                             if end is not None else None
+                             for end in group_ends]
@@ -0,0 +1,73 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Douglas-Peucker simplification of filtered trajectories, used to store a few
+coarser copies of them for clients that don't need every point.
+"""
+
+import math
+
+# Tolerance in degrees for each level of detail. Level 0 is the full
+# resolution result, and each level after it is roughly ten times coarser,
+# going from about a meter to about a hundred meters.
+LEVEL_TOLERANCES = [0.0, 0.00001, 0.0001, 0.001]
+
+
+def num_levels():
+    return len(LEVEL_TOLERANCES)
+
+
+def distance_to_segment(pt, start, end):
+    dx, dy = end.x - start.x, end.y - start.y
+    length_sq = dx * dx + dy * dy
+    if length_sq == 0.0:
+        return math.sqrt((pt.x - start.x) ** 2 + (pt.y - start.y) ** 2)
+    t = ((pt.x - start.x) * dx + (pt.y - start.y) * dy) / length_sq
+    t = max(0.0, min(1.0, t))
+    return math.sqrt((pt.x - start.x - t * dx) ** 2 +
+                     (pt.y - start.y - t * dy) ** 2)
+
+
+def douglas_peucker(points, tolerance):
+    """
+    Returns the points of a trajectory that must be kept so that none of
+    the dropped ones are more than tolerance away from the simplified line.
+    The first and last points are always kept.
+    """
+    if len(points) <= 2 or tolerance <= 0.0:
+        return list(points)
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    # An explicit stack instead of recursion, since trajectories can be long
+    # enough to hit Python's recursion limit.
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        max_dist, max_index = 0.0, None
+        for i in range(first + 1, last):
+            dist = distance_to_segment(points[i], points[first], points[last])
+            if dist > max_dist:
+                max_dist, max_index = dist, i
+        if max_index is not None and max_dist > tolerance:
+            keep[max_index] = True
+            stack.append((first, max_index))
+            stack.append((max_index, last))
+    return [pt for pt, kept in zip(points, keep) if kept]
+
+
+def simplify_trajectories(trajectories, level):
+    tolerance = LEVEL_TOLERANCES[level]
+    return [douglas_peucker(traj, tolerance) for traj in trajectories]
@@ -0,0 +1,201 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+
+# Deeper than any web map goes, and keeps tile arithmetic in float range.
+MAX_TILE_ZOOM = 30
+
+
+class PointGridIndex(object):
+    """
+    Buckets points into a uniform grid of square cells, so that finding the
+    points near a location only looks at the few cells around it instead of
+    at every point.
+    """
+
+    def __init__(self, cell_size):
+        if cell_size <= 0.0:
+            raise ValueError("cell size must be positive but was " +
+                             str(cell_size))
+        self.cell_size = float(cell_size)
+        self.cells = {}
+        self.coords = {}
+
+    def __len__(self):
+        return len(self.coords)
+
+    def cell_of(self, x, y):
+        return (int(math.floor(x / self.cell_size)),
+                int(math.floor(y / self.cell_size)))
+
+    def insert(self, item, x, y):
+        self.cells.setdefault(self.cell_of(x, y), []).append(item)
+        self.coords[item] = (x, y)
+
+    def items_in_cells_near(self, x, y, radius):
+        """
+        Yields every item in the cells overlapping the square of side
+        2 * radius centered on (x, y). Callers still need to check distances.
+        """
+        min_cx, min_cy = self.cell_of(x - radius, y - radius)
+        max_cx, max_cy = self.cell_of(x + radius, y + radius)
+        num_cells = (max_cx - min_cx + 1) * (max_cy - min_cy + 1)
+
+        # A huge radius would visit more empty cells than there are points.
+        if num_cells > len(self.cells):
+            for items in self.cells.values():
+                for item in items:
+                    yield item
+            return
+
+        for cx in range(min_cx, max_cx + 1):
+            for cy in range(min_cy, max_cy + 1):
+                for item in self.cells.get((cx, cy), ()):
+                    yield item
+
+    def query_radius(self, x, y, radius, strict=False):
+        """
+        Returns the items within radius of (x, y). With strict set, items at
+        exactly radius are left out.
+        """
+        out = []
+        for item in self.items_in_cells_near(x, y, radius):
+            item_x, item_y = self.coords[item]
+            dist = math.sqrt((item_x - x) ** 2 + (item_y - y) ** 2)
+            if dist < radius or (not strict and dist == radius):
+                out.append(item)
+        return out
+
+
+def index_point_graph(pt_graph, cell_size):
+    """Builds a PointGridIndex over the node indices of a point graph."""
+    index = PointGridIndex(cell_size)
+    for pt_node in pt_graph:
+        index.insert(pt_node.index, pt_node.point.x, pt_node.point.y)
+    return index
+
+
+def get_grid_nearby_neighbors_func(pt_index, max_distance):
+    """
+    Grid backed replacement for get_find_other_nearby_neighbors_func, to be
+    passed to build_point_graph. Each new node is added to pt_index and only
+    connected to the earlier nodes within max_distance in neighboring cells,
+    instead of being compared against every node built so far.
+    """
+    def _func(node_index, pt_graph):
+        pt_node = pt_graph[node_index]
+        pt_index.insert(node_index, pt_node.point.x, pt_node.point.y)
+        for other_index in pt_index.query_radius(pt_node.point.x,
+                                                 pt_node.point.y,
+                                                 max_distance):
+            pt_node.add_neighbor(pt_graph[other_index])
+    return _func
+
+
+def segment_intersects_box(x1, y1, x2, y2, min_x, min_y, max_x, max_y):
+    """Liang-Barsky clipping test for a segment against a closed box."""
+    t0, t1 = 0.0, 1.0
+    dx, dy = x2 - x1, y2 - y1
+    for p, q in ((-dx, x1 - min_x), (dx, max_x - x1),
+                 (-dy, y1 - min_y), (dy, max_y - y1)):
+        if p == 0:
+            if q < 0:
+                return False
+        else:
+            t = float(q) / p
+            if p < 0:
+                t0 = max(t0, t)
+            else:
+                t1 = min(t1, t)
+            if t0 > t1:
+                return False
+    return True
+
+
+class SegmentGridIndex(object):
+    """
+    Buckets line segments into every grid cell their bounding box overlaps,
+    so that finding the segments crossing a box only looks at the cells the
+    box covers. Segments spanning more than max_cells_per_segment cells are
+    kept aside and checked on every query instead.
+    """
+
+    def __init__(self, cell_size, max_cells_per_segment=64):
+        self.grid = PointGridIndex(cell_size)
+        self.max_cells_per_segment = max_cells_per_segment
+        self.segments = {}
+        self.oversized = []
+
+    def __len__(self):
+        return len(self.segments)
+
+    def insert(self, item, x1, y1, x2, y2):
+        self.segments[item] = (x1, y1, x2, y2)
+        min_cx, min_cy = self.grid.cell_of(min(x1, x2), min(y1, y2))
+        max_cx, max_cy = self.grid.cell_of(max(x1, x2), max(y1, y2))
+        if (max_cx - min_cx + 1) * (max_cy - min_cy + 1) > \
+                self.max_cells_per_segment:
+            self.oversized.append(item)
+            return
+        for cx in range(min_cx, max_cx + 1):
+            for cy in range(min_cy, max_cy + 1):
+                self.grid.cells.setdefault((cx, cy), []).append(item)
+
+    def query_box(self, min_x, min_y, max_x, max_y):
+        """Returns the sorted items whose segments touch the box."""
+        min_cx, min_cy = self.grid.cell_of(min_x, min_y)
+        max_cx, max_cy = self.grid.cell_of(max_x, max_y)
+        if (max_cx - min_cx + 1) * (max_cy - min_cy + 1) > \
+                len(self.grid.cells):
+            candidates = set(self.segments)
+        else:
+            candidates = set(self.oversized)
+            for cx in range(min_cx, max_cx + 1):
+                for cy in range(min_cy, max_cy + 1):
+                    candidates.update(self.grid.cells.get((cx, cy), ()))
+
+        out = []
+        for item in candidates:
+            x1, y1, x2, y2 = self.segments[item]
+            if segment_intersects_box(x1, y1, x2, y2,
+                                      min_x, min_y, max_x, max_y):
+                out.append(item)
+        out.sort()
+        return out
+
+
+def tile_bounds(z, x, y):
+    """
+    Returns (min_lat, min_lng, max_lat, max_lng) of a slippy map tile, as
+    used by Google Maps and OpenStreetMap. Raises ValueError for tiles that
+    don't exist.
+    """
+    if not 0 <= z <= MAX_TILE_ZOOM:
+        raise ValueError("no zoom level {}".format(z))
+    num_tiles = 2 ** z
+    if not (0 <= x < num_tiles and 0 <= y < num_tiles):
+        raise ValueError("no tile {}/{}/{}".format(z, x, y))
+
+    def lat_of(tile_y):
+        return math.degrees(math.atan(math.sinh(
+            math.pi * (1 - 2.0 * tile_y / num_tiles))))
+
+    return (lat_of(y + 1), x * 360.0 / num_tiles - 180.0,
+            lat_of(y), (x + 1) * 360.0 / num_tiles - 180.0)
+
+
+def tile_pixel_size(z, tile_size=256):
+    """Width in degrees of longitude of one pixel of a tile at zoom z."""
+    return 360.0 / (tile_size * 2 ** z)
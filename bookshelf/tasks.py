@@ -12,30 +12,104 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from array import array
+import hashlib
 import logging
+import multiprocessing
+import os
+import random
+import struct
+import threading
+import time
 
 from bookshelf import get_model, storage
 from flask import current_app
 from gcloud import pubsub
 import psq
+from psq.task import STARTED, FINISHED, FAILED
 import requests
 import model_datastore
 from traclus_impl.geometry import LineSegment
 from traclus_impl.geometry import Point
 from bookshelf.model_datastore import store_partitioned_trajectories
-from traclus_impl.coordination import the_whole_enchilada
+from traclus_impl.coordination import \
+    get_all_trajectory_line_segments_iterable_from_all_points_iterable_caller, \
+    get_trajectory_line_segments_from_points_iterable, \
+    get_cluster_iterable_from_all_points_iterable_caller, \
+    get_representative_lines_from_trajectory_caller, \
+    representative_line_seg_iterable_from_all_points_iterable
+from traclus_impl.generic_dbscan import dbscan
+from traclus_impl.traclus_dbscan import TrajectoryLineSegmentFactory, \
+    TrajectoryClusterFactory
+from traclus_impl.trajectory_partitioning import call_partition_trajectory, \
+    get_line_segment_from_points
 import math
 from traclus_impl.parameter_estimation import TraclusSimulatedAnnealingState
 from traclus_impl.parameter_estimation import TraclusSimulatedAnnealer
 from traclus_impl.processed_trajectory_connecting import \
-get_find_other_nearby_neighbors_func, FilteredTrajectory,\
-    compute_graph_component_ids, find_shortest_connection
+FilteredTrajectory, compute_graph_component_ids, find_shortest_connection
 
 from traclus_impl.processed_trajectory_connecting import \
-build_point_graph
+build_point_graph, compute_shortest_path
+from bookshelf.spatial import PointGridIndex, get_grid_nearby_neighbors_func
+from bookshelf.caching import LRUCache
+from bookshelf import simplification
+from bookshelf import routing
+from bookshelf import graph_file
+from bookshelf.contraction import build_contraction_hierarchy, ContractionHierarchy
 
 COORDINATE_SCALER = 1.0
 
+# Cell size used for a point graph's spatial index when the graph wasn't
+# built with a positive max inter trajectory distance to size it by.
+DEFAULT_SPATIAL_INDEX_CELL_SIZE = 0.001
+
+# Built point graphs are kept per process, keyed by the version of the
+# filtered trajectories they were built from and the max inter trajectory
+# distance used to connect them. Only a handful of distances are kept around
+# so that arbitrary query parameters can't grow the cache without bound.
+# Trajectories stored before versioning can't say when they've changed, so
+# graphs of them are rebuilt after UNVERSIONED_POINT_GRAPH_TTL_SECONDS. Graphs
+# are built outside of _point_graph_cache_lock, with one build lock per key so
+# that threads wanting the same graph wait for one build instead of each
+# doing their own.
+POINT_GRAPH_CACHE_MAX_ENTRIES = 4
+UNVERSIONED_POINT_GRAPH_TTL_SECONDS = 60
+_point_graph_cache = {}
+_point_graph_cache_order = []
+_point_graph_cache_lock = threading.Lock()
+_point_graph_build_locks = {}
+
+# Route graphs mapped from files in ROUTE_GRAPH_FILE_DIR, keyed like the point
+# graph cache.
+_mapped_route_graph_cache = LRUCache(max_entries=POINT_GRAPH_CACHE_MAX_ENTRIES)
+_mapped_route_graph_lock = threading.Lock()
+
+# Contraction hierarchies loaded from Datastore, keyed like the point graph
+# cache. Hierarchies that aren't there are only remembered for a short while,
+# since the worker stores one some time after the trajectories it's for.
+ROUTING_HIERARCHY_CACHE_MAX_ENTRIES = 4
+ROUTING_HIERARCHY_RECHECK_SECONDS = 30
+_routing_hierarchy_cache = LRUCache(max_entries=ROUTING_HIERARCHY_CACHE_MAX_ENTRIES)
+_missing_routing_hierarchy_cache = LRUCache(max_entries=ROUTING_HIERARCHY_CACHE_MAX_ENTRIES, \
+                                            ttl=ROUTING_HIERARCHY_RECHECK_SECONDS)
+
+# Routes found, keyed by the graph they were found in and the points their
+# ends snapped to, so that requests between the same places don't search
+# again. Keys include the graph version, so entries for old graphs just age
+# out.
+ROUTE_CACHE_MAX_ENTRIES = 1024
+ROUTE_CACHE_TTL_SECONDS = 600
+_route_cache = LRUCache(max_entries=ROUTE_CACHE_MAX_ENTRIES, ttl=ROUTE_CACHE_TTL_SECONDS)
+
+# TRACLUS entropy for an epsilon, keyed by a fingerprint of the input
+# trajectories and the epsilon rounded to a few significant digits, so that
+# annealing runs over unchanged data don't recluster for epsilons they (or an
+# earlier run in this worker) have already tried.
+ENERGY_CACHE_MAX_ENTRIES = 10000
+ENERGY_CACHE_SIGNIFICANT_DIGITS = 4
+_energy_cache = LRUCache(max_entries=ENERGY_CACHE_MAX_ENTRIES)
+
 
 # [START get_books_queue]
 def get_books_queue():
@@ -54,13 +128,55 @@ def get_trajectory_filter_queue():
         project=current_app.config['PROJECT_ID'])
     
     return psq.Queue(
-        client, 'trajectory_filter', extra_context=current_app.app_context)
+        client, 'trajectory_filter', storage=get_trajectory_filter_storage(), \
+        extra_context=current_app.app_context)
 # [END get_books_queue]
 
+def get_trajectory_filter_storage():
+    """
+    Task storage for the trajectory filter queue, so that web requests can
+    look up the status and result of jobs handed to the worker.
+    """
+    storage = psq.DatastoreStorage(model_datastore.get_client())
+    storage.store_on_status = (STARTED, FINISHED, FAILED)
+    return storage
+
+def get_job_status(job_id):
+    """
+    Returns a JSON friendly summary of a job enqueued on the trajectory
+    filter queue. Jobs that haven't been picked up by the worker yet have no
+    stored task, and are reported as queued.
+    """
+    task = get_trajectory_filter_storage().get_task(job_id)
+    if not task:
+        return {'job_id': job_id, 'status': 'queued'}
+    
+    out = {'job_id': job_id, 'status': task.status}
+    if task.status == FINISHED:
+        out['result'] = task.result
+    elif task.status == FAILED:
+        out['error'] = str(task.result)
+    return out
+
 def construct_graph_from_processed_trajectories(filtered_trajectories, \
                                                 max_distance_between_connected_different_trajs):
+    return construct_indexed_graph_from_processed_trajectories(filtered_trajectories, \
+                                max_distance_between_connected_different_trajs)[0]
+
+def construct_indexed_graph_from_processed_trajectories(filtered_trajectories, \
+                                max_distance_between_connected_different_trajs):
+    """
+    Builds the point graph along with the spatial index used to connect its
+    trajectories. Points are bucketed into a grid with cells as wide as the
+    max connection distance, so each point is only compared against points in
+    adjacent cells rather than every other point.
+    """
+    cell_size = max_distance_between_connected_different_trajs \
+    if max_distance_between_connected_different_trajs > 0.0 \
+    else DEFAULT_SPATIAL_INDEX_CELL_SIZE
+    pt_index = PointGridIndex(cell_size)
     other_neighbors_func = \
-    get_find_other_nearby_neighbors_func(max_distance_between_connected_different_trajs)
+    get_grid_nearby_neighbors_func(pt_index, max_distance_between_connected_different_trajs)
     
     cur_index = 0
     graph_input = []
@@ -74,14 +190,337 @@ def construct_graph_from_processed_trajectories(filtered_trajectories, \
     pt_graph = build_point_graph(graph_input, other_neighbors_func)
     compute_graph_component_ids(pt_graph=pt_graph, \
                                 find_other_neighbors_func=dummy_find_other_neighbors_func)
-    return pt_graph
+    return pt_graph, pt_index
+
+def get_point_graph(max_inter_traj_distance):
+    """
+    Returns the point graph for the currently stored filtered trajectories,
+    along with a spatial index over its points, only rebuilding them when the
+    stored trajectories have changed since they were last built in this
+    process.
+    """
+    pt_graph, pt_index, route_graph = _get_cached_graphs(max_inter_traj_distance)
+    return pt_graph, pt_index
+
+def get_route_graph(max_inter_traj_distance):
+    """Like get_point_graph, but returns the routing.CompactGraph version of
+    the point graph along with the spatial index. With ROUTE_GRAPH_FILE_DIR
+    configured, both are mapped from a file shared by every process on the
+    machine instead, for ROUTE_GRAPH_FILE_MAX_INTER_TRAJ_DISTANCE only."""
+    graph_file_dir = current_app.config.get('ROUTE_GRAPH_FILE_DIR')
+    file_distance = current_app.config.get('ROUTE_GRAPH_FILE_MAX_INTER_TRAJ_DISTANCE')
+    if graph_file_dir != None and max_inter_traj_distance == file_distance:
+        return _get_mapped_route_graph(graph_file_dir, max_inter_traj_distance)
+    pt_graph, pt_index, route_graph = _get_cached_graphs(max_inter_traj_distance)
+    return route_graph, pt_index
+
+def _build_stored_point_graph(max_inter_traj_distance):
+    """Builds the point graph and spatial index of the stored filtered
+    trajectories, and returns them along with the trajectories' version."""
+    filtered_trajectories, version = \
+    model_datastore.get_filtered_trajectories_with_version()
+    pt_graph, pt_index = \
+    construct_indexed_graph_from_processed_trajectories(filtered_trajectories, \
+                                                        max_inter_traj_distance)
+    return pt_graph, pt_index, version
+
+def _get_point_graph_cache_entry(cache_key):
+    with _point_graph_cache_lock:
+        entry = _point_graph_cache.get(cache_key)
+    if entry == None:
+        return None
+    cached, built_at = entry
+    if cache_key[0] == None and \
+    time.time() - built_at > UNVERSIONED_POINT_GRAPH_TTL_SECONDS:
+        return None
+    return cached
+
+def _get_cached_graphs(max_inter_traj_distance):
+    version = model_datastore.get_filtered_trajectories_version()
+    cache_key = (version, max_inter_traj_distance)
+    cached = _get_point_graph_cache_entry(cache_key)
+    if cached != None:
+        return cached
+    
+    with _point_graph_cache_lock:
+        build_lock = _point_graph_build_locks.setdefault(cache_key, threading.Lock())
+    with build_lock:
+        # Another thread may have built it while this one waited.
+        cached = _get_point_graph_cache_entry(cache_key)
+        if cached != None:
+            return cached
+        
+        pt_graph, pt_index, version = _build_stored_point_graph(max_inter_traj_distance)
+        route_graph = routing.CompactGraph.from_point_graph(pt_graph)
+        route_graph.version = version
+        route_graph.max_inter_traj_distance = max_inter_traj_distance
+        cached = (pt_graph, pt_index, route_graph)
+        
+        with _point_graph_cache_lock:
+            _point_graph_build_locks.pop(cache_key, None)
+            cache_key = (version, max_inter_traj_distance)
+            for stale_key in filter(lambda k: k[0] != version, _point_graph_cache_order):
+                _point_graph_cache_order.remove(stale_key)
+                del _point_graph_cache[stale_key]
+            if cache_key not in _point_graph_cache:
+                _point_graph_cache_order.append(cache_key)
+            while len(_point_graph_cache_order) > POINT_GRAPH_CACHE_MAX_ENTRIES:
+                del _point_graph_cache[_point_graph_cache_order.pop(0)]
+            _point_graph_cache[cache_key] = (cached, time.time())
+        return cached
+
+def route_graph_file_path(graph_file_dir, max_inter_traj_distance):
+    return os.path.join(graph_file_dir, \
+                        'route-graph-' + repr(float(max_inter_traj_distance)) + '.bin')
+
+def _route_graph_file_lock(graph_file_dir, max_inter_traj_distance):
+    """Lock held by whichever process on the machine is writing a route graph
+    file, so that the others wait for its file instead of each building the
+    graph too."""
+    try:
+        os.makedirs(graph_file_dir)
+    except OSError:
+        if not os.path.isdir(graph_file_dir):
+            raise
+    return graph_file.file_lock(route_graph_file_path(graph_file_dir, \
+                                                      max_inter_traj_distance) + '.lock')
+
+def _write_route_graph_file(path, max_inter_traj_distance):
+    pt_graph, pt_index, version = _build_stored_point_graph(max_inter_traj_distance)
+    graph_file.write_graph_file(path, routing.CompactGraph.from_point_graph(pt_graph), \
+                                pt_index, {'version': version, \
+                                           'max_inter_traj_distance': float(max_inter_traj_distance)})
+
+def write_route_graph_file(graph_file_dir, max_inter_traj_distance):
+    """
+    Builds the route graph of the stored filtered trajectories and writes it,
+    with its spatial index, to a graph file in graph_file_dir. Returns the
+    file's path.
+    """
+    path = route_graph_file_path(graph_file_dir, max_inter_traj_distance)
+    with _route_graph_file_lock(graph_file_dir, max_inter_traj_distance):
+        _write_route_graph_file(path, max_inter_traj_distance)
+    return path
+
+def write_configured_route_graph_file():
+    """
+    Writes the graph file for ROUTE_GRAPH_FILE_MAX_INTER_TRAJ_DISTANCE if
+    ROUTE_GRAPH_FILE_DIR is configured, so that web processes sharing the
+    machine map it rather than each building the graph themselves.
+    """
+    graph_file_dir = current_app.config.get('ROUTE_GRAPH_FILE_DIR')
+    max_inter_traj_distance = current_app.config.get('ROUTE_GRAPH_FILE_MAX_INTER_TRAJ_DISTANCE')
+    if graph_file_dir == None or max_inter_traj_distance == None:
+        return
+    path = write_route_graph_file(graph_file_dir, max_inter_traj_distance)
+    logging.info("Wrote route graph file {}".format(path))
+
+def _open_route_graph_file(path, max_inter_traj_distance):
+    """Returns (version, route graph, spatial index) from a graph file, or
+    None if there's no usable one."""
+    try:
+        header, route_graph, pt_index = graph_file.open_graph_file(path)
+    except (EnvironmentError, ValueError):
+        return None
+    if header['max_inter_traj_distance'] != float(max_inter_traj_distance):
+        return None
+    route_graph.version = header['version']
+    route_graph.max_inter_traj_distance = max_inter_traj_distance
+    return header['version'], route_graph, pt_index
+
+def _get_mapped_route_graph(graph_file_dir, max_inter_traj_distance):
+    version = model_datastore.get_filtered_trajectories_version()
+    cache_key = (version, max_inter_traj_distance)
+    
+    with _mapped_route_graph_lock:
+        cached = _mapped_route_graph_cache.get(cache_key)
+        if cached != None:
+            return cached
+        
+        path = route_graph_file_path(graph_file_dir, max_inter_traj_distance)
+        opened = _open_route_graph_file(path, max_inter_traj_distance)
+        if opened == None or opened[0] != version:
+            # Another process may be writing the file for these trajectories
+            # already, so wait for it and look again before writing it here.
+            with _route_graph_file_lock(graph_file_dir, max_inter_traj_distance):
+                opened = _open_route_graph_file(path, max_inter_traj_distance)
+                if opened == None or opened[0] != version:
+                    _write_route_graph_file(path, max_inter_traj_distance)
+                    opened = _open_route_graph_file(path, max_inter_traj_distance)
+            if opened == None:
+                raise ValueError("could not map route graph file " + path)
+        
+        version, route_graph, pt_index = opened
+        # Dropping mappings of files that have been replaced lets their disk
+        # space go.
+        if any(key[0] != version for key, _ in _mapped_route_graph_cache.items()):
+            _mapped_route_graph_cache.clear()
+        cached = (route_graph, pt_index)
+        _mapped_route_graph_cache.set((version, max_inter_traj_distance), cached)
+        return cached
+
+def build_and_store_routing_hierarchy():
+    """
+    Builds a contraction hierarchy over the point graph of the stored filtered
+    trajectories, if ROUTING_HIERARCHY_MAX_INTER_TRAJ_DISTANCE is configured.
+    The trajectories are read back from Datastore so that the graph matches
+    the one the web app builds node for node.
+    """
+    max_inter_traj_distance = current_app.config.get('ROUTING_HIERARCHY_MAX_INTER_TRAJ_DISTANCE')
+    if max_inter_traj_distance == None:
+        return
+    
+    pt_graph, pt_index, version = _build_stored_point_graph(max_inter_traj_distance)
+    hierarchy = build_contraction_hierarchy(routing.CompactGraph.from_point_graph(pt_graph))
+    logging.info("Built a contraction hierarchy over {} points with {} upward edges".format( \
+        len(hierarchy), len(hierarchy.neighbors)))
+    model_datastore.store_routing_hierarchy(max_inter_traj_distance, version, \
+                                            hierarchy.to_items())
+
+def get_routing_hierarchy(route_graph, max_inter_traj_distance):
+    """
+    Returns the stored contraction hierarchy for a route graph from
+    get_route_graph, or None if there isn't one built from the same version
+    of the filtered trajectories.
+    """
+    cache_key = (route_graph.version, float(max_inter_traj_distance))
+    hierarchy = _routing_hierarchy_cache.get(cache_key)
+    if hierarchy != None:
+        return hierarchy
+    if route_graph.version == None or cache_key in _missing_routing_hierarchy_cache:
+        return None
+    
+    filtered_version, items = model_datastore.get_routing_hierarchy(max_inter_traj_distance)
+    if filtered_version != route_graph.version or len(items) != len(route_graph):
+        _missing_routing_hierarchy_cache.set(cache_key, True)
+        return None
+    hierarchy = ContractionHierarchy.from_items(items)
+    _routing_hierarchy_cache.set(cache_key, hierarchy)
+    return hierarchy
+
+def invalidate_point_graph_cache():
+    with _point_graph_cache_lock:
+        _point_graph_cache.clear()
+        del _point_graph_cache_order[:]
+    _mapped_route_graph_cache.clear()
+
+def squared_distance_between_nodes(a_index, b_index, pt_graph):
+    pt_a = pt_graph[a_index].point
+    pt_b = pt_graph[b_index].point
+    return math.pow(pt_a.x - pt_b.x, 2) + math.pow(pt_a.y - pt_b.y, 2)
+
+def find_shortest_connection_with_index(start_pt, end_pt, pt_graph, pt_index, \
+                                        max_dist_to_existing_pt):
+    """
+    Same as find_shortest_connection, but finds the graph points near the
+    start and end points with a spatial index rather than a scan of the
+    whole graph.
+    """
+    near_start_indices = pt_index.query_radius(start_pt.x, start_pt.y, \
+                                               max_dist_to_existing_pt, strict=True)
+    near_end_indices = pt_index.query_radius(end_pt.x, end_pt.y, \
+                                             max_dist_to_existing_pt, strict=True)
+    
+    shortest_connection = None
+    for start_index in near_start_indices:
+        for end_index in near_end_indices:
+            if pt_graph[start_index].graph_component_id != \
+            pt_graph[end_index].graph_component_id:
+                continue
+            temp_path, temp_dist = \
+            compute_shortest_path(start_node_index=start_index, \
+                                  end_node_index=end_index, \
+                                  pt_graph=pt_graph, \
+                                  pt_pt_distance_func=squared_distance_between_nodes)
+            if temp_path == None:
+                continue
+            if shortest_connection == None or temp_dist < shortest_connection[1]:
+                shortest_connection = (temp_path, temp_dist)
+                
+    if shortest_connection == None:
+        return None, None
+    
+    return map(lambda i: pt_graph[i].point, shortest_connection[0]), \
+        shortest_connection[1]
+
+def find_route_between_points(route_graph, pt_index, start_pt, end_pt, \
+                              max_dist_to_existing_pt, hierarchy=None):
+    """
+    Finds the shortest path from any graph point within
+    max_dist_to_existing_pt of start_pt to any within that distance of end_pt,
+    with a single A* search rather than one search per pair of those points,
+    or with a contraction hierarchy of the graph if one is given.
+    Returns the path as a list of {'lat': ..., 'lng': ...} and its length, or
+    (None, None). Results for graphs from get_route_graph are cached.
+    """
+    sources = pt_index.query_radius(start_pt.x, start_pt.y, \
+                                    max_dist_to_existing_pt, strict=True)
+    targets = pt_index.query_radius(end_pt.x, end_pt.y, \
+                                    max_dist_to_existing_pt, strict=True)
+    cache_key = None
+    if route_graph.version != None:
+        cache_key = (route_graph.version, route_graph.max_inter_traj_distance, \
+                     tuple(sorted(sources)), tuple(sorted(targets)))
+        cached = _route_cache.get(cache_key)
+        if cached != None:
+            return cached
+    
+    if hierarchy != None:
+        path, distance = hierarchy.query(sources, targets)
+    else:
+        path, distance = routing.astar(route_graph, sources, targets)
+    if path == None:
+        result = (None, None)
+    else:
+        result = (_route_points(route_graph, path), distance)
+    if cache_key != None:
+        _route_cache.set(cache_key, result)
+    return result
+
+def get_route_cache_stats():
+    return _route_cache.stats()
+
+def _route_points(route_graph, path):
+    return map(lambda i: {'lat': route_graph.xs[i], 'lng': route_graph.ys[i]}, path)
+
+def find_route_matrix(route_graph, pt_index, start_pts, end_pts, \
+                      max_dist_to_existing_pt, with_paths=False):
+    """
+    Finds the shortest routes from each of start_pts to each of end_pts,
+    snapping them to the graph like find_route_between_points, with one
+    search per start point. Returns (distances, paths) as lists with a row
+    per start point, holding None where there's no route. paths is None
+    unless with_paths is set.
+    """
+    def snap(pt):
+        return pt_index.query_radius(pt.x, pt.y, max_dist_to_existing_pt, strict=True)
+    
+    target_groups = map(snap, end_pts)
+    distances = []
+    paths = [] if with_paths else None
+    for start_pt in start_pts:
+        row_distances, row_paths = routing.one_to_many(route_graph, snap(start_pt), \
+                                                       target_groups, with_paths=with_paths)
+        distances.append(row_distances)
+        if with_paths:
+            paths.append(map(lambda path: _route_points(route_graph, path) \
+                             if path != None else None, row_paths))
+    return distances, paths
 
 def compute_shortest_path_between_points(pt_graph, start_pt, end_pt, \
-                                         max_dist_to_existing_pt):
-    shortest_path, shortest_distance = find_shortest_connection(start_pt=start_pt, \
-                                    end_pt=end_pt, \
-                                    pt_graph=pt_graph, \
-                                    max_dist_to_existing_pt=max_dist_to_existing_pt)
+                                         max_dist_to_existing_pt, pt_index=None):
+    if pt_index == None:
+        shortest_path, shortest_distance = find_shortest_connection(start_pt=start_pt, \
+                                        end_pt=end_pt, \
+                                        pt_graph=pt_graph, \
+                                        max_dist_to_existing_pt=max_dist_to_existing_pt)
+    else:
+        shortest_path, shortest_distance = \
+        find_shortest_connection_with_index(start_pt=start_pt, \
+                                            end_pt=end_pt, \
+                                            pt_graph=pt_graph, \
+                                            pt_index=pt_index, \
+                                            max_dist_to_existing_pt=max_dist_to_existing_pt)
     if shortest_path == None and shortest_distance == None:
         return None, None
     
@@ -93,116 +532,312 @@ def filter_trajectories():
     filtered_trajectories = \
     model_datastore.filter_trajectories(trajectories=unfiltered)
     model_datastore.store_filtered_trajectories(filtered_trajectories=filtered_trajectories)
+    invalidate_point_graph_cache()
+    store_simplified_trajectories(filtered_trajectories)
+    build_and_store_routing_hierarchy()
+    write_configured_route_graph_file()
     return
 
-def run_simulated_annealing_for_epsilon(initial_epsilon, num_steps, max_epsilon_jump):
-    all_raw_point_lists = get_normalized_datastore_trajectories()
-    initial_state = TraclusSimulatedAnnealingState(input_trajectories=all_raw_point_lists, \
-                                                epsilon=initial_epsilon)
-    traclus_sim_anneal = TraclusSimulatedAnnealer(initial_state=initial_state, \
-                                                      max_epsilon_step_change=max_epsilon_jump)
-    traclus_sim_anneal.updates = max(10, num_steps)
-    traclus_sim_anneal.steps = num_steps
-    best_state, best_energy = traclus_sim_anneal.anneal()
-    return best_state.get_epsilon()
+def quantize_epsilon(epsilon):
+    return float('%.*g' % (ENERGY_CACHE_SIGNIFICANT_DIGITS, epsilon))
 
-def create_line_seg(start, end):
-    return LineSegment.from_tuples(start, end)
+def trajectories_fingerprint(point_lists):
+    sha = hashlib.sha1()
+    for point_list in point_lists:
+        sha.update(trajectory_content_hash(point_list))
+    return sha.hexdigest()
 
-def remove_successive_points_at_same_spots(point_list):
-    p_iter = iter(point_list)
-    prev = p_iter.next()
-    out = [prev]
-    
-    for p in p_iter:
-        if prev.x == p.x and prev.y == p.y:
-            print "removing same point in sequential spot"
+class TracingTraclusAnnealer(TraclusSimulatedAnnealer):
+    """
+    Records every (epsilon, energy) pair the annealer evaluates, and skips
+    reclustering for epsilons whose quantized value is in known_energies.
+    Energies it had to compute are collected in new_energies.
+    """
+    def __init__(self, initial_state, max_epsilon_step_change, known_energies=None):
+        TraclusSimulatedAnnealer.__init__(self, initial_state=initial_state, \
+                                          max_epsilon_step_change=max_epsilon_step_change)
+        self.trace = []
+        self.known_energies = known_energies if known_energies != None else {}
+        self.new_energies = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        
+    def energy(self):
+        quantized_epsilon = quantize_epsilon(self.state.get_epsilon())
+        energy = self.known_energies.get(quantized_epsilon)
+        if energy == None:
+            self.cache_misses += 1
+            energy = TraclusSimulatedAnnealer.energy(self)
+            self.known_energies[quantized_epsilon] = energy
+            self.new_energies[quantized_epsilon] = energy
         else:
-            out.append(p)
-    return out
+            self.cache_hits += 1
+        self.trace.append([self.state.get_epsilon(), energy])
+        return energy
 
-def remove_points_too_close(point_list):
-    p_iter = iter(point_list)
-    prev = p_iter.next()
-    out = [prev]
+def run_annealing_chain(chain_args):
+    """
+    Runs one independent annealing chain. Takes a single tuple so it can be
+    mapped over a multiprocessing pool.
+    """
+    input_trajectories, initial_epsilon, num_steps, max_epsilon_jump, seed, \
+    known_energies = chain_args
+    random.seed(seed)
+    initial_state = TraclusSimulatedAnnealingState(input_trajectories=input_trajectories, \
+                                                   epsilon=initial_epsilon)
+    traclus_sim_anneal = TracingTraclusAnnealer(initial_state=initial_state, \
+                                                max_epsilon_step_change=max_epsilon_jump, \
+                                                known_energies=known_energies)
+    traclus_sim_anneal.updates = max(10, num_steps)
+    traclus_sim_anneal.steps = num_steps
+    best_state, best_energy = traclus_sim_anneal.anneal()
+    return {'best_epsilon': best_state.get_epsilon(), \
+            'best_energy': best_energy, \
+            'trace': traclus_sim_anneal.trace, \
+            'new_energies': traclus_sim_anneal.new_energies, \
+            'cache_hits': traclus_sim_anneal.cache_hits, \
+            'cache_misses': traclus_sim_anneal.cache_misses}
+
+def chain_start_epsilons(initial_epsilon, max_epsilon_jump, num_chains):
+    """
+    Starting epsilons for num_chains annealing chains: the first chain starts
+    at initial_epsilon and the others alternately above and below it, each
+    one max_epsilon_jump further out. A single move reaches max_epsilon_jump
+    either way, so neighboring chains start one move apart and together
+    cover the range around initial_epsilon without gaps. Starts that would
+    not be positive are skipped in favor of ones further above.
+    """
+    starts = [initial_epsilon]
+    offset = 1
+    while len(starts) < num_chains:
+        starts.append(initial_epsilon + offset * max_epsilon_jump)
+        below = initial_epsilon - offset * max_epsilon_jump
+        if len(starts) < num_chains and below > 0:
+            starts.append(below)
+        offset += 1
+    return starts
+
+def run_simulated_annealing_for_epsilon(initial_epsilon, num_steps, max_epsilon_jump, \
+                                        num_chains=1, num_rounds=1, share_best=False, \
+                                        seed=None):
+    """
+    Searches for the epsilon that minimizes TRACLUS's entropy with
+    num_chains independent annealing chains, run in a process pool when
+    there's more than one. The steps are split over num_rounds rounds. With
+    share_best set, every chain restarts from the best epsilon found so far
+    at the start of each round; otherwise each chain carries on from its own
+    best.
+    
+    Energies are memoized in a bounded cache that outlives the call, so
+    repeated tuning over the same trajectories gets cheaper; the result
+    reports how many evaluations it saved.
+    """
+    all_raw_point_lists = get_normalized_datastore_trajectories()
+    fingerprint = trajectories_fingerprint(all_raw_point_lists)
+    cache_hits, cache_misses = 0, 0
+    rand = random.Random(seed)
+    num_chains = max(1, num_chains)
+    num_rounds = max(1, min(num_rounds, num_steps))
+    
+    chains = []
+    for start_epsilon in chain_start_epsilons(initial_epsilon, max_epsilon_jump, num_chains):
+        chains.append({'initial_epsilon': start_epsilon, 'best_epsilon': start_epsilon, \
+                       'best_energy': None, 'trace': []})
     
-    for p in p_iter:
-        if prev.distance_to(p) > 0.0:
-            out.append(p)
-            prev = p
+    pool = None
+    if num_chains > 1:
+        pool = multiprocessing.Pool(processes=min(num_chains, multiprocessing.cpu_count()))
+    try:
+        best_epsilon, best_energy = initial_epsilon, None
+        for round_index in range(num_rounds):
+            round_steps = num_steps // num_rounds + \
+            (1 if round_index < num_steps % num_rounds else 0)
+            known_energies = dict((key[1], energy) for key, energy in _energy_cache.items() \
+                                  if key[0] == fingerprint)
+            chain_args = []
+            for chain in chains:
+                start_epsilon = best_epsilon if share_best and best_energy != None \
+                else chain['best_epsilon']
+                chain_args.append((all_raw_point_lists, start_epsilon, round_steps, \
+                                   max_epsilon_jump, rand.randint(0, 2 ** 31 - 1), \
+                                   dict(known_energies)))
             
-    return out
+            results = pool.map(run_annealing_chain, chain_args) if pool != None \
+            else map(run_annealing_chain, chain_args)
             
-def get_normalized_datastore_trajectories():
-    raw_trajectories = model_datastore.get_all_location_updates()
-        
-    print "HERE ARE THE RAW TRAJECTORIES: \n" + str(raw_trajectories)
-        
-    def dict_list_to_point_list(dict_list):
-        return map(lambda x: Point(x['lat'], x['lng']), dict_list)
-    
-    normal_traj_lists = model_datastore.get_raw_trajectories()
-        
-    print "\n\nHERE ARE THE NORMALIZED FORMAT TRAJECTORIES: \n" + str(normal_traj_lists)
-    print "\n LENGTH OF NORMAL TRAJ LIST IS " + str(len(normal_traj_lists))
+            for chain, result in zip(chains, results):
+                chain_epsilon, chain_energy = result['best_epsilon'], result['best_energy']
+                chain['trace'].extend(result['trace'])
+                if chain['best_energy'] == None or chain_energy < chain['best_energy']:
+                    chain['best_epsilon'], chain['best_energy'] = chain_epsilon, chain_energy
+                if best_energy == None or chain_energy < best_energy:
+                    best_epsilon, best_energy = chain_epsilon, chain_energy
+                for quantized_epsilon, energy in result['new_energies'].items():
+                    _energy_cache.set((fingerprint, quantized_epsilon), energy)
+                cache_hits += result['cache_hits']
+                cache_misses += result['cache_misses']
+    finally:
+        if pool != None:
+            pool.close()
+            pool.join()
     
-    all_raw_point_lists = []
-    for dict_list in normal_traj_lists:
-        print "here is what we're trying to go from dict list to point list on: " \
-         + str(dict_list)
-        point_list = dict_list_to_point_list(dict_list)
-        if len(point_list) < 2:
+    return {'best_epsilon': best_epsilon, 'best_energy': best_energy, 'chains': chains, \
+            'energy_cache': {'hits': cache_hits, 'misses': cache_misses, \
+                             'size': len(_energy_cache)}}
+
+def create_line_seg(start, end):
+    return LineSegment.from_tuples(start, end)
+
+def normalize_trajectory_coords(dict_list, scale=COORDINATE_SCALER):
+    """
+    Packs a trajectory of {'lat': ..., 'lng': ...} dicts into a flat array of
+    scaled lat, lng pairs, dropping any point at the same spot as the point
+    kept right before it. Working on one contiguous array of floats avoids
+    building several lists of Point objects per trajectory.
+    """
+    coords = array('d')
+    prev_x, prev_y = None, None
+    for d in dict_list:
+        x = d['lat'] * scale
+        y = d['lng'] * scale
+        if x == prev_x and y == prev_y:
             continue
-        traj_list = remove_successive_points_at_same_spots(point_list)
-        if len(traj_list) >= 2:
-            all_raw_point_lists.append(traj_list)
-        
-    if len(all_raw_point_lists) <= 1:
+        coords.append(x)
+        coords.append(y)
+        prev_x, prev_y = x, y
+    return coords
+
+def coords_to_point_list(coords):
+    return [Point(coords[i], coords[i + 1]) for i in xrange(0, len(coords), 2)]
+
+def iter_normalized_datastore_trajectory_coords():
+    """
+    Lazily yields the stored raw trajectories as flat coordinate arrays, see
+    normalize_trajectory_coords, leaving out trajectories that don't cover at
+    least two distinct spots. Raw trajectories are streamed from Datastore a
+    page at a time, so none of the intermediate forms of the whole data set
+    are ever held at once.
+    """
+    for dict_list in model_datastore.iter_raw_trajectories():
+        coords = normalize_trajectory_coords(dict_list)
+        if len(coords) >= 4:
+            yield coords
+
+def check_enough_trajectories(trajectories):
+    if len(trajectories) <= 1:
         raise ValueError("length of all raw point lists is " + \
-                         str(len(all_raw_point_lists)))
-        
-    def get_min_dist():
-        min_dist = 1000
-        for traj in all_raw_point_lists:
-            p_iter = iter(traj)
-            prev = p_iter.next()
-            for p in p_iter:
-                min_dist = min(min_dist, prev.distance_to(p))
-        return min_dist
+                         str(len(trajectories)))
+    return trajectories
+
+def get_normalized_datastore_trajectory_coords():
+    return check_enough_trajectories(list(iter_normalized_datastore_trajectory_coords()))
             
-    print "min dist is " + str(get_min_dist())
-        
-    def get_scaled_trajs(traj_list, scale):
-        def scale_coordinates(point_list):
-            return map(lambda p: Point(p.x * scale, p.y * scale), point_list)
-        return map(scale_coordinates, traj_list)
-        
-    all_raw_point_lists = get_scaled_trajs(all_raw_point_lists, COORDINATE_SCALER)
-    all_raw_point_lists = map(remove_points_too_close, all_raw_point_lists)
-    all_raw_point_lists = filter(lambda x: len(x) >= 2, all_raw_point_lists)
-    
-    return all_raw_point_lists
+def get_normalized_datastore_trajectories():
+    return check_enough_trajectories([coords_to_point_list(coords) for coords in \
+                                      iter_normalized_datastore_trajectory_coords()])
 
 
+def trajectory_content_hash(point_list):
+    coords = []
+    for p in point_list:
+        coords.append(p.x)
+        coords.append(p.y)
+    return hashlib.sha1(struct.pack('<%dd' % len(coords), *coords)).hexdigest()
+
+def get_cached_partitioning_func(cached_partitions, new_partitions):
+    """
+    Returns a drop in for call_partition_trajectory that reuses the partition
+    indices in cached_partitions for trajectories whose content hash is
+    there, and records the ones it has to compute in new_partitions.
+    """
+    def _func(trajectory_point_list):
+        content_hash = trajectory_content_hash(trajectory_point_list)
+        partition_indices = cached_partitions.get(content_hash)
+        if partition_indices == None:
+            partition_indices = \
+            call_partition_trajectory(trajectory_point_list=trajectory_point_list)
+            new_partitions[content_hash] = partition_indices
+        return partition_indices
+    return _func
+
+def run_traclus_with_partitioning_func(point_iterable_list, epsilon, min_neighbors, \
+                                       min_num_trajectories_in_cluster, min_vertical_lines, \
+                                       min_prev_dist, trajectory_partitioning_func, \
+                                       partitioned_points_hook, clusters_hook):
+    """
+    Same pipeline as traclus_impl's the_whole_enchilada, except that the
+    function used to partition each trajectory can be swapped out.
+    """
+    def _dbscan_caller(cluster_candidates):
+        return dbscan(cluster_candidates=cluster_candidates, epsilon=epsilon, \
+                      min_neighbors=min_neighbors, cluster_factory=TrajectoryClusterFactory())
+    all_traj_segs_caller = \
+    get_all_trajectory_line_segments_iterable_from_all_points_iterable_caller(get_line_segs_from_points_func=get_trajectory_line_segments_from_points_iterable, \
+                                                                              trajectory_line_segment_factory=TrajectoryLineSegmentFactory(), \
+                                                                              trajectory_partitioning_func=trajectory_partitioning_func, \
+                                                                              line_seg_from_points_func=get_line_segment_from_points, \
+                                                                              partitioned_points_hook=partitioned_points_hook)
+    cluster_caller = \
+    get_cluster_iterable_from_all_points_iterable_caller(get_all_traj_segs_from_all_points_caller=all_traj_segs_caller, \
+                                                         dbscan_caller=_dbscan_caller, \
+                                                         clusters_hook=clusters_hook)
+    representative_line_caller = \
+    get_representative_lines_from_trajectory_caller(min_vertical_lines=min_vertical_lines, \
+                                                    min_prev_dist=min_prev_dist)
+    return representative_line_seg_iterable_from_all_points_iterable(point_iterable_list, \
+                        get_cluster_iterable_from_all_points_iterable_caller=cluster_caller, \
+                        get_representative_line_seg_from_trajectory_caller=representative_line_caller, \
+                        min_num_trajectories_in_cluster=min_num_trajectories_in_cluster)
+
 def run_the_whole_enchilada(epsilon, min_neighbors, min_num_trajectories_in_cluster, \
                             min_vertical_lines, min_prev_dist): 
     all_raw_point_lists = get_normalized_datastore_trajectories()   
-    print "HERE ARE THE POINT LISTS WERE PASSING IN TO TRACLUS: " + str(all_raw_point_lists)
+    
+    # Partitioning only depends on a trajectory's own points, so trajectories
+    # that haven't changed since an earlier run reuse that run's partitions.
+    cached_partitions = model_datastore.get_cached_partitions( \
+        map(trajectory_content_hash, all_raw_point_lists))
+    new_partitions = {}
+    logging.info("Reusing partitions for {} of {} trajectories".format( \
+        len(cached_partitions), len(all_raw_point_lists)))
         
     print "ABOUT to run the whole enchilada with a min neighbors of " + str(min_neighbors)
-    result_trajectories = the_whole_enchilada(point_iterable_list=all_raw_point_lists, \
+    result_trajectories = run_traclus_with_partitioning_func(point_iterable_list=all_raw_point_lists, \
                         epsilon=epsilon, \
                         min_neighbors=min_neighbors, \
                         min_num_trajectories_in_cluster=min_num_trajectories_in_cluster, \
                         min_vertical_lines=min_vertical_lines, \
                         min_prev_dist=min_prev_dist, \
+                        trajectory_partitioning_func=get_cached_partitioning_func(cached_partitions, \
+                                                                                  new_partitions), \
                         partitioned_points_hook=model_datastore.store_partitioned_trajectories, \
                         clusters_hook=model_datastore.store_clusters)
     
+    if len(new_partitions) > 0:
+        model_datastore.store_cached_partitions(new_partitions)
+    
     if len(result_trajectories) == 0:
         raise ValueError("length of resulting trajectories is " + str(len(result_trajectories)))
     
     model_datastore.store_filtered_trajectories(filtered_trajectories=result_trajectories)
+    invalidate_point_graph_cache()
+    store_simplified_trajectories(result_trajectories)
+    build_and_store_routing_hierarchy()
+    write_configured_route_graph_file()
+    return {'num_filtered_trajectories': len(result_trajectories), \
+            'num_reused_partitions': len(cached_partitions)}
+
+def store_simplified_trajectories(filtered_trajectories):
+    """
+    Stores a simplified copy of the filtered trajectories for each coarser
+    level of detail, for /books/filtered?level=N.
+    """
+    for level in range(1, simplification.num_levels()):
+        simplified = simplification.simplify_trajectories(filtered_trajectories, level)
+        logging.info("Simplified trajectories to level {} with {} points".format( \
+            level, sum(map(len, simplified))))
+        model_datastore.store_filtered_trajectories(filtered_trajectories=simplified, \
+                                                    key_id=model_datastore.filtered_trajectories_key_id(level))
         
 # [START process_book]
 def process_book(book_id):
@@ -0,0 +1,160 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compact binary encoding for nested lists of {'lat': ..., 'lng': ...} points,
+as stored for filtered trajectories, partitioned segments and clusters.
+
+Coordinates are stored as fixed point integers in units of COORDINATE_UNIT,
+each one as the difference from the previous coordinate of the same axis,
+which keeps the numbers small and lets zlib squeeze them well. The nesting
+is described by the lengths of the lists at each level. Encoding is lossy
+to within half a COORDINATE_UNIT.
+
+Payloads start with MAGIC, so decode() can tell them apart from the JSON
+that was stored before and still read both.
+"""
+
+from array import array
+import json
+import struct
+import sys
+import zlib
+
+MAGIC = b'DRP1'
+COORDINATE_UNIT = 1e-7
+FLAG_COMPRESSED = 1
+
+_HEADER = struct.Struct('<4sBB')
+_LENGTH = struct.Struct('<I')
+_WRAP = 1 << 32
+_MAX_INT32 = (1 << 31) - 1
+_MIN_INT32 = -(1 << 31)
+
+
+def _to_bytes(arr):
+    if sys.byteorder == 'big':
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes() if hasattr(arr, 'tobytes') else arr.tostring()
+
+
+def _from_bytes(typecode, data):
+    arr = array(typecode)
+    if hasattr(arr, 'frombytes'):
+        arr.frombytes(data)
+    else:
+        arr.fromstring(data)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
+
+
+def _fixed_point(value):
+    fixed = int(round(value / COORDINATE_UNIT))
+    if abs(fixed) > _MAX_INT32:
+        raise ValueError("coordinate {} is too large to pack".format(value))
+    return fixed
+
+
+def lengths_itemsize():
+    return array('I').itemsize
+
+
+def is_packed(data):
+    return isinstance(data, bytes) and data[:len(MAGIC)] == MAGIC
+
+
+def encode(nested, depth, compress=True):
+    """
+    Packs nested lists of points. depth is the number of list levels above
+    the points: 1 for a single trajectory, 2 for a list of trajectories or
+    segments, 3 for a list of clusters of segments.
+    """
+    if depth < 1:
+        raise ValueError("depth must be at least 1 but was " + str(depth))
+
+    lengths = array('I', [len(nested)])
+    level = [nested]
+    for _ in range(depth - 1):
+        level = [child for parent in level for child in parent]
+        lengths.extend(len(child) for child in level)
+
+    deltas = array('I')
+    prev_lat, prev_lng = 0, 0
+    for point_list in level:
+        for point in point_list:
+            lat, lng = _fixed_point(point['lat']), _fixed_point(point['lng'])
+            # Differences are stored modulo 2 ** 32 so that any pair of
+            # int32 values has one, however far apart they are.
+            deltas.append((lat - prev_lat) % _WRAP)
+            deltas.append((lng - prev_lng) % _WRAP)
+            prev_lat, prev_lng = lat, lng
+
+    body = b''.join([_LENGTH.pack(len(lengths)), _to_bytes(lengths),
+                     _to_bytes(deltas)])
+    flags = 0
+    if compress:
+        body = zlib.compress(body)
+        flags |= FLAG_COMPRESSED
+    return _HEADER.pack(MAGIC, flags, depth) + body
+
+
+def decode(data):
+    """Reverses encode(), or json.loads legacy JSON payloads."""
+    if not is_packed(data):
+        return json.loads(data)
+
+    _, flags, depth = _HEADER.unpack_from(data)
+    body = data[_HEADER.size:]
+    if flags & FLAG_COMPRESSED:
+        body = zlib.decompress(body)
+
+    num_lengths = _LENGTH.unpack_from(body)[0]
+    lengths_end = _LENGTH.size + lengths_itemsize() * num_lengths
+    lengths = _from_bytes('I', body[_LENGTH.size:lengths_end])
+    # Read back as signed, the stored differences are the actual ones unless
+    # they wrapped around, which the range checks below undo.
+    deltas = _from_bytes('i', body[lengths_end:])
+
+    points = []
+    lat, lng = 0, 0
+    unit = COORDINATE_UNIT
+    for i in range(0, len(deltas), 2):
+        lat += deltas[i]
+        lng += deltas[i + 1]
+        if not _MIN_INT32 <= lat <= _MAX_INT32:
+            lat += _WRAP if lat < 0 else -_WRAP
+        if not _MIN_INT32 <= lng <= _MAX_INT32:
+            lng += _WRAP if lng < 0 else -_WRAP
+        points.append({'lat': lat * unit, 'lng': lng * unit})
+
+    # lengths holds the number of children of every list, level by level
+    # starting from the outermost one.
+    counts_per_level = [lengths[:1]]
+    pos = 1
+    for _ in range(depth - 1):
+        num_lists = sum(counts_per_level[-1])
+        counts_per_level.append(lengths[pos:pos + num_lists])
+        pos += num_lists
+
+    children = points
+    for counts in reversed(counts_per_level):
+        parents = []
+        pos = 0
+        for n in counts:
+            parents.append(children[pos:pos + n])
+            pos += n
+        children = parents
+    return children[0]
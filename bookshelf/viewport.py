@@ -0,0 +1,100 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Picks out the parts of stored filtered trajectories and clusters that fall
+inside a map viewport, optionally thinned out to the viewport's resolution.
+Points are {'lat': ..., 'lng': ...} dicts as stored, indexed with lat as x.
+"""
+
+import math
+
+from bookshelf.spatial import SegmentGridIndex
+
+
+def index_trajectory_segments(trajectories, cell_size):
+    """Indexes the segment from point i to i + 1 of trajectory t as (t, i)."""
+    index = SegmentGridIndex(cell_size)
+    for traj_id, traj in enumerate(trajectories):
+        for i in range(len(traj) - 1):
+            a, b = traj[i], traj[i + 1]
+            index.insert((traj_id, i), a['lat'], a['lng'], b['lat'], b['lng'])
+    return index
+
+
+def index_cluster_segments(clusters, cell_size):
+    """Indexes segment i of cluster c as (c, i)."""
+    index = SegmentGridIndex(cell_size)
+    for cluster_id, cluster in enumerate(clusters):
+        for i, seg in enumerate(cluster):
+            a, b = seg[0], seg[-1]
+            index.insert((cluster_id, i), a['lat'], a['lng'],
+                         b['lat'], b['lng'])
+    return index
+
+
+def _far_enough(a, b, tolerance):
+    return math.sqrt((a['lat'] - b['lat']) ** 2 +
+                     (a['lng'] - b['lng']) ** 2) >= tolerance
+
+
+def decimate(points, tolerance):
+    """
+    Drops points closer than tolerance to the last point kept, always
+    keeping the first and last ones.
+    """
+    if not tolerance or len(points) <= 2:
+        return points
+    out = [points[0]]
+    for pt in points[1:-1]:
+        if _far_enough(pt, out[-1], tolerance):
+            out.append(pt)
+    out.append(points[-1])
+    return out
+
+
+def trajectories_in_box(trajectories, index, box, tolerance=None):
+    """
+    Returns the pieces of the trajectories that cross box, given as
+    (min_lat, min_lng, max_lat, max_lng). Each piece is a run of consecutive
+    crossing segments, as {'trajectory_id': ..., 'points': [...]}.
+    """
+    # [trajectory id, first segment, one past the last segment] of each run.
+    runs = []
+    for traj_id, i in index.query_box(*box):
+        if runs and runs[-1][0] == traj_id and runs[-1][2] == i:
+            runs[-1][2] = i + 1
+        else:
+            runs.append([traj_id, i, i + 1])
+    return [{'trajectory_id': traj_id,
+             'points': decimate(trajectories[traj_id][start:end + 1],
+                                tolerance)}
+            for traj_id, start, end in runs]
+
+
+def clusters_in_box(clusters, index, box, tolerance=None):
+    """
+    Returns the segments of each cluster that cross box, as
+    {'cluster_id': ..., 'segments': [...]}, leaving out clusters with none.
+    With a tolerance, segments shorter than it are left out too.
+    """
+    out = []
+    for cluster_id, i in index.query_box(*box):
+        seg = clusters[cluster_id][i]
+        if tolerance and not _far_enough(seg[0], seg[-1], tolerance):
+            continue
+        if not out or out[-1]['cluster_id'] != cluster_id:
+            out.append({'cluster_id': cluster_id, 'segments': []})
+        out[-1]['segments'].append(seg)
+    return out
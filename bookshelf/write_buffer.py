@@ -0,0 +1,133 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import Queue
+import threading
+import time
+
+_CLOSE = object()
+_TIMED_OUT = object()
+
+
+class _FlushRequest(object):
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class WriteBehindBuffer(object):
+    """
+    Accepts items right away and hands them to flush_func in batches from a
+    background thread, once max_batch_size items are waiting or the oldest
+    one has waited flush_interval seconds. At most max_pending items are held,
+    and adding to a full buffer blocks, which slows writers down to the pace
+    flush_func keeps up with. A batch that keeps failing after max_retries
+    retries is logged and dropped.
+    """
+
+    def __init__(self, flush_func, max_batch_size=500, flush_interval=1.0,
+                 max_pending=10000, max_retries=3):
+        self.flush_func = flush_func
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.num_flushed = 0
+        self.num_batches = 0
+        self.num_dropped = 0
+        self._queue = Queue.Queue(max_pending)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='write-behind')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, item, timeout=None):
+        """
+        Queues an item, waiting up to timeout seconds for room if the buffer
+        is full (forever if timeout is None). Returns whether it was queued.
+        """
+        if self._closed:
+            raise ValueError("write behind buffer is closed")
+        try:
+            self._queue.put(item, timeout=timeout)
+        except Queue.Full:
+            return False
+        return True
+
+    def flush(self, timeout=None):
+        """Writes everything added so far, and waits for it to be written."""
+        request = _FlushRequest()
+        self._queue.put(request)
+        return request.done.wait(timeout)
+
+    def close(self, timeout=None):
+        """Writes everything added so far and stops the background thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_CLOSE)
+        self._thread.join(timeout)
+
+    def stats(self):
+        return {'pending': self._queue.qsize(),
+                'flushed': self.num_flushed,
+                'batches': self.num_batches,
+                'dropped': self.num_dropped}
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            try:
+                if deadline is None:
+                    item = self._queue.get()
+                else:
+                    item = self._queue.get(
+                        timeout=max(0.0, deadline - time.time()))
+            except Queue.Empty:
+                item = _TIMED_OUT
+
+            if item is _CLOSE:
+                self._write(batch)
+                return
+            if isinstance(item, _FlushRequest):
+                self._write(batch)
+                batch, deadline = [], None
+                item.done.set()
+                continue
+            if item is not _TIMED_OUT:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.time() + self.flush_interval
+
+            if len(batch) >= self.max_batch_size or \
+                    (batch and time.time() >= deadline):
+                self._write(batch)
+                batch, deadline = [], None
+
+    def _write(self, batch):
+        if not batch:
+            return
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.flush_func(batch)
+                self.num_flushed += len(batch)
+                self.num_batches += 1
+                return
+            except Exception:
+                logging.exception("Writing %d buffered items failed on "
+                                  "attempt %d", len(batch), attempt + 1)
+                if attempt < self.max_retries:
+                    time.sleep(min(0.1 * 2 ** attempt, 5.0))
+        logging.error("Dropping %d buffered items", len(batch))
+        self.num_dropped += len(batch)
@@ -35,6 +35,51 @@ PROJECT_ID = 'darkroast-1085'
 # Cloud Datastore dataset id, this is the same as your project id.
 DATASTORE_DATASET_ID = PROJECT_ID
 
+# How filtered trajectories, clusters and partitioned segments are stored in
+# Datastore: 'json', or 'packed' for a compact binary encoding that is several
+# times smaller and faster to read, but rounds coordinates to 1e-7. Results
+# stored either way can always be read back.
+RESULT_ENCODING = 'json'
+
+# With write behind enabled, uploaded trajectories are queued in memory and
+# written to Datastore in batches from a background thread, flushing once
+# WRITE_BEHIND_MAX_BATCH_SIZE are waiting or after WRITE_BEHIND_FLUSH_SECONDS.
+# Uploads respond sooner, but trajectories queued when a process is killed
+# without a clean shutdown are lost.
+WRITE_BEHIND_ENABLED = False
+WRITE_BEHIND_MAX_BATCH_SIZE = 500
+WRITE_BEHIND_FLUSH_SECONDS = 1.0
+WRITE_BEHIND_MAX_PENDING = 10000
+
+# When set, the worker builds a contraction hierarchy over the point graph
+# for this max inter trajectory distance every time it stores new filtered
+# trajectories, and route queries for that distance use it instead of a full
+# search. /books/get_directions uses 0.001. Building takes a while on large
+# graphs, so it's off by default.
+ROUTING_HIERARCHY_MAX_INTER_TRAJ_DISTANCE = None
+
+# When set, the route graph for ROUTE_GRAPH_FILE_MAX_INTER_TRAJ_DISTANCE is
+# kept in a file in this directory that every process on a machine maps into
+# memory, instead of each gunicorn worker building and holding its own copy.
+# The first process that needs the graph for new filtered trajectories writes
+# the file while the others wait for it. A worker on the same machine writes
+# it as soon as it stores new filtered trajectories, so web processes don't
+# have to build it at all. Graphs for other distances are still built per
+# process.
+ROUTE_GRAPH_FILE_DIR = None
+ROUTE_GRAPH_FILE_MAX_INTER_TRAJ_DISTANCE = 0.001
+
+# The max inter trajectory distances route requests can ask for. Each one
+# needs its own point graph, built from all of the filtered trajectories, so
+# requests for any other distance are turned away.
+ROUTE_MAX_INTER_TRAJ_DISTANCES = [0.001]
+
+# Most annealing chains and rounds a /books/simulated_annealing job can ask
+# for. Every chain runs TRACLUS once per step, so these bound how much work
+# one request can hand the worker.
+MAX_ANNEALING_CHAINS = 8
+MAX_ANNEALING_ROUNDS = 10
+
 # SQLAlchemy configuration
 # Replace user, pass, host, and database with the respective values of your
 # Cloud SQL instance.
@@ -0,0 +1,137 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+An in memory stand-in for gcloud.datastore.Client, enough of one for the
+model_datastore tests to run without a real Datastore.
+"""
+
+import copy
+import itertools
+
+from bookshelf import model_datastore
+from gcloud.datastore.key import Key
+import mock
+
+
+class FakeIterator(object):
+
+    def __init__(self, entities, limit, start_cursor):
+        self.entities = entities
+        self.limit = limit
+        self.start = int(start_cursor or 0)
+
+    def next_page(self):
+        end = len(self.entities)
+        if self.limit is not None:
+            end = min(end, self.start + self.limit)
+        page = [copy.deepcopy(e) for e in self.entities[self.start:end]]
+        # Like the real backend, a query that stops at its limit reports
+        # MORE_RESULTS_AFTER_LIMIT, which gcloud 0.8 turns into False, and
+        # still returns a cursor.
+        more_results = self.limit is None and end < len(self.entities)
+        return page, more_results, str(end)
+
+    def __iter__(self):
+        return iter(self.next_page()[0])
+
+
+class FakeQuery(object):
+
+    def __init__(self, client, kind, order=(), filters=()):
+        self.client = client
+        self.kind = kind
+        self.order = list(order)
+        self.filters = list(filters)
+
+    def add_filter(self, property_name, operator, value):
+        self.filters.append((property_name, operator, value))
+
+    def fetch(self, limit=None, start_cursor=None):
+        self.client.calls['fetch'] += 1
+        entities = [e for path, e in sorted(self.client.store.items())
+                    if path[0] == self.kind]
+        for name, operator, value in self.filters:
+            if operator == '=':
+                entities = [e for e in entities if e.get(name) == value]
+            elif operator == '>':
+                entities = [e for e in entities if e.get(name) > value]
+            else:
+                raise ValueError("unsupported operator " + operator)
+        for name in reversed(self.order):
+            entities.sort(key=lambda e: e.get(name.lstrip('-')),
+                          reverse=name.startswith('-'))
+        return FakeIterator(entities, limit, start_cursor)
+
+
+class FakeClient(object):
+    """Every client shares the store and call counts of the class it was
+    made from, like clients of one real dataset do."""
+
+    store = None
+    calls = None
+    ids = None
+
+    def __init__(self, dataset_id=None, **kwargs):
+        self.dataset_id = dataset_id
+
+    def key(self, *path_args, **kwargs):
+        return Key(*path_args, dataset_id='fake')
+
+    def _complete(self, entity):
+        if entity.key.is_partial:
+            entity.key = entity.key.completed_key(next(self.ids))
+
+    def get(self, key):
+        self.calls['get'] += 1
+        return copy.deepcopy(self.store.get(key.flat_path))
+
+    def get_multi(self, keys):
+        self.calls['get_multi'] += 1
+        return [copy.deepcopy(self.store[key.flat_path]) for key in keys
+                if key.flat_path in self.store]
+
+    def put(self, entity):
+        self.put_multi([entity])
+
+    def put_multi(self, entities):
+        self.calls['put'] += 1
+        for entity in entities:
+            self._complete(entity)
+            self.store[entity.key.flat_path] = copy.deepcopy(entity)
+
+    def delete(self, key):
+        self.delete_multi([key])
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.store.pop(key.flat_path, None)
+
+    def query(self, kind=None, order=(), filters=()):
+        return FakeQuery(self, kind, order, filters)
+
+
+def patch_datastore():
+    """
+    Returns a mock patcher that points model_datastore at a fresh, empty
+    fake Datastore, and the fake client class, whose store and calls
+    attributes the test can look at.
+    """
+    client_class = type('FakeClient', (FakeClient,), {
+        'store': {},
+        'calls': {'get': 0, 'get_multi': 0, 'put': 0, 'fetch': 0},
+        'ids': itertools.count(1)})
+    model_datastore._client_pool = model_datastore.ClientPool('fake')
+    return mock.patch.object(model_datastore.datastore, 'Client',
+                             client_class), client_class
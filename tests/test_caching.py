@@ -0,0 +1,62 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from bookshelf.caching import LRUCache
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def testEvictsLeastRecentlyUsed(self):
+        cache = LRUCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        cache.set('c', 3)
+
+        assert 'b' not in cache
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+        assert cache.evictions == 1
+
+    def testExpiresEntriesAfterTtl(self):
+        now = [100.0]
+        cache = LRUCache(max_entries=10, ttl=5, clock=lambda: now[0])
+        cache.set('a', 1)
+
+        now[0] = 104.0
+        assert cache.get('a') == 1
+        now[0] = 106.0
+        assert cache.get('a') is None
+        assert len(cache) == 0
+
+    def testCountsHitsAndMisses(self):
+        cache = LRUCache(max_entries=10)
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('a')
+        cache.get('b')
+
+        stats = cache.stats()
+        assert stats['hits'] == 2
+        assert stats['misses'] == 1
+        assert abs(stats['hit_rate'] - 2.0 / 3) < 1e-9
+
+    def testItemsDoesNotCountAsLookups(self):
+        cache = LRUCache(max_entries=10)
+        cache.set('a', 1)
+
+        assert cache.items() == [('a', 1)]
+        assert cache.hits == 0 and cache.misses == 0
@@ -0,0 +1,57 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import random
+import unittest
+
+from bookshelf.contraction import build_contraction_hierarchy, \
+    ContractionHierarchy
+from bookshelf.routing import astar
+from test_routing import random_route_graph
+
+
+class ContractionHierarchyTest(unittest.TestCase):
+
+    def testQueriesMatchAStar(self):
+        rand = random.Random(13)
+        graph = random_route_graph(rand)
+        hierarchy = build_contraction_hierarchy(graph)
+        edges = set()
+        for u in range(len(graph)):
+            for k in range(graph.offsets[u], graph.offsets[u + 1]):
+                edges.add((u, graph.neighbors[k]))
+
+        for _ in range(100):
+            sources = rand.sample(range(len(graph)), 2)
+            targets = rand.sample(range(len(graph)), 2)
+            expected_path, expected_dist = astar(graph, sources, targets)
+            path, dist = hierarchy.query(sources, targets)
+            if expected_path is None:
+                assert path is None
+                continue
+            assert abs(dist - expected_dist) < 1e-9
+            assert path[0] in sources and path[-1] in targets
+            assert all(edge in edges for edge in zip(path, path[1:]))
+            length = sum(graph.distance(a, b) for a, b in zip(path, path[1:]))
+            assert abs(length - dist) < 1e-9
+
+    def testSurvivesSerialization(self):
+        graph = random_route_graph(random.Random(2), num_trajectories=10)
+        hierarchy = build_contraction_hierarchy(graph)
+        restored = ContractionHierarchy.from_items(
+            json.loads(json.dumps(hierarchy.to_items())))
+
+        assert restored.query([0], [len(graph) - 1]) == \
+            hierarchy.query([0], [len(graph) - 1])
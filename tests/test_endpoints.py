@@ -0,0 +1,308 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import unittest
+
+import bookshelf
+from bookshelf import crud, model_datastore, simplification, tasks
+from bookshelf.caching import LRUCache
+import config
+from fake_datastore import patch_datastore
+import mock
+from traclus_impl.geometry import Point
+
+
+class EndpointTest(unittest.TestCase):
+    """Runs the app's endpoints against a fake Datastore."""
+
+    def setUp(self):
+        patcher, self.client_class = patch_datastore()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.app = bookshelf.create_app(config, testing=True)
+        self.client = self.app.test_client()
+        crud._result_version_cache.clear()
+        crud._response_cache.clear()
+
+
+class ResultVersionTest(EndpointTest):
+
+    def testCachesMissingVersions(self):
+        with self.app.app_context():
+            assert crud.get_result_version('Results', 1) is None
+            num_gets = self.client_class.calls['get']
+            assert crud.get_result_version('Results', 1) is None
+            assert self.client_class.calls['get'] == num_gets
+
+
+class ViewportTest(EndpointTest):
+
+    def setUp(self):
+        super(ViewportTest, self).setUp()
+        with self.app.app_context():
+            model_datastore.store_filtered_trajectories(
+                [[Point(0.001 * i, 0.001 * i) for i in range(10)]])
+
+    def testBadLevels(self):
+        for level in ('-1', str(simplification.num_levels()), 'abc'):
+            rv = self.client.get('/books/filtered?level=' + level)
+            assert rv.status_code == 400, level
+            assert 'error' in json.loads(rv.data)
+
+        rv = self.client.get('/books/filtered?level=1')
+        assert rv.status_code == 200
+        assert len(json.loads(rv.data)['trajectories']) == 1
+
+    def testEmptyBoxAndTile(self):
+        rv = self.client.get('/books/filtered/bbox?min_lat=5&min_lng=5'
+                             '&max_lat=6&max_lng=6')
+        assert rv.status_code == 200
+        assert json.loads(rv.data) == {'trajectories': []}
+
+        rv = self.client.get('/books/filtered/tiles/10/0/0')
+        assert rv.status_code == 200
+        assert json.loads(rv.data) == {'trajectories': []}
+
+    def testBadBoxesAndTiles(self):
+        assert self.client.get('/books/filtered/bbox?min_lat=0').status_code \
+            == 400
+        assert self.client.get('/books/clusters/bbox?min_lat=0&min_lng=0'
+                               '&max_lat=x&max_lng=1').status_code == 400
+        assert self.client.get('/books/filtered/tiles/1/2/0').status_code == \
+            404
+        assert self.client.get('/books/clusters/tiles/99/0/0').status_code \
+            == 404
+
+
+class JobStatusTest(EndpointTest):
+
+    def testPollsReusePooledClient(self):
+        for _ in range(3):
+            rv = self.client.get('/books/jobs/abc')
+            assert rv.status_code == 200
+            assert json.loads(rv.data) == {'job_id': 'abc',
+                                           'status': 'queued'}
+        assert model_datastore.get_client_pool_stats()[
+            'num_clients_created'] == 1
+
+
+class PageArgsTest(EndpointTest):
+
+    def testPageSizeBounds(self):
+        for path in ('/books/raw_trajectories', '/books/locations'):
+            for page_size in ('0', '-5', str(crud.MAX_PAGE_SIZE + 1), 'ten',
+                              '2.5', ''):
+                rv = self.client.get(path + '?page_size=' + page_size)
+                assert rv.status_code == 400, (path, page_size)
+                assert 'error' in json.loads(rv.data)
+
+            for page_size in ('1', str(crud.MAX_PAGE_SIZE)):
+                rv = self.client.get(path + '?page_size=' + page_size)
+                assert rv.status_code == 200, (path, page_size)
+                assert json.loads(rv.data)['next_page_token'] is None
+
+    def testPageTokenAloneUsesDefaultPageSize(self):
+        with self.app.app_context():
+            model_datastore.store_new_trajectory_updates(
+                [([{'lat': i, 'lng': 0.0}], False) for i in range(3)])
+        with self.app.test_request_context('/?page_token=abc'):
+            assert crud.get_page_args(7) == (7, 'abc')
+        with self.app.test_request_context('/'):
+            assert crud.get_page_args(7) is None
+
+        rv = self.client.get('/books/raw_trajectories?page_size=2')
+        page = json.loads(rv.data)
+        assert len(page['trajectories']) == 2
+        rv = self.client.get('/books/raw_trajectories?page_token=' +
+                             page['next_page_token'])
+        assert len(json.loads(rv.data)['trajectories']) == 1
+
+
+class ShardedResultResponseTest(EndpointTest):
+
+    def setUp(self):
+        super(ShardedResultResponseTest, self).setUp()
+        for name, value in (('RESULT_SHARD_MAX_BYTES', 200),
+                            ('RESULT_SHARDS_PER_RPC', 1)):
+            patcher = mock.patch.object(model_datastore, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.items = [[{'lat': i * 0.5, 'lng': -i * 0.25}] * 4
+                      for i in range(10)]
+        self.new_items = self.items[::-1]
+        with self.app.app_context():
+            model_datastore.store_sharded_result('Clusters', 1, self.items)
+
+    def replaceAfterFirstRead(self):
+        get_entities = model_datastore._get_entities
+        replaced = []
+
+        def get_and_replace(ds, keys):
+            entities = get_entities(ds, keys)
+            if not replaced:
+                replaced.append(True)
+                model_datastore.store_sharded_result('Clusters', 1,
+                                                     self.new_items)
+            return entities
+        return mock.patch.object(model_datastore, '_get_entities',
+                                 get_and_replace)
+
+    def testReplacedWhileReadingIsReadAgain(self):
+        with self.replaceAfterFirstRead():
+            rv = self.client.get('/books/clusters')
+            assert rv.status_code == 200
+            assert json.loads(rv.data) == {'clusters': self.new_items}
+
+        self.new_items = self.items
+        with self.replaceAfterFirstRead():
+            rv = self.client.get('/books/clusters?format=ndjson')
+            assert rv.status_code == 200
+            assert map(json.loads, rv.data.splitlines()) == self.items
+
+    def testReplacedAfterStreamingStartedIsCutOff(self):
+        with mock.patch.object(crud, 'RESPONSE_CACHE_MAX_BODY_BYTES', 10), \
+                self.replaceAfterFirstRead():
+            rv = self.client.get('/books/clusters')
+            self.assertRaises(model_datastore.ResultReplacedError,
+                              lambda: rv.data)
+
+
+class StatsTest(EndpointTest):
+
+    def testReportsCacheStats(self):
+        with mock.patch.object(tasks, '_route_cache',
+                               LRUCache(max_entries=4)) as route_cache:
+            route_cache.set('route', 1)
+            route_cache.get('route')
+            route_cache.get('other')
+            rv = self.client.get('/books/stats')
+        assert rv.status_code == 200
+        stats = json.loads(rv.data)
+        assert stats['route_cache']['hits'] == 1
+        assert stats['route_cache']['misses'] == 1
+        assert stats['route_cache']['size'] == 1
+        assert stats['client_pool']['num_clients_created'] == 0
+        assert stats['write_buffer'] is None
+        assert 'hit_rate' in stats['response_cache']
+
+
+class RouteMatrixTest(EndpointTest):
+
+    def setUp(self):
+        super(RouteMatrixTest, self).setUp()
+        tasks.invalidate_point_graph_cache()
+        self.addCleanup(tasks.invalidate_point_graph_cache)
+        with self.app.app_context():
+            model_datastore.store_filtered_trajectories(
+                [[Point(0.0, 0.001 * i) for i in range(5)]])
+        self.body = {'start_pts': [{'lat': 0.0, 'lng': 0.0}],
+                     'end_pts': [{'lat': 0.0, 'lng': 0.004},
+                                 {'lat': 5.0, 'lng': 5.0}],
+                     'max_inter_traj_distance': 0.001,
+                     'max_dist_to_existing_pt': 0.0001}
+
+    def post(self, **changes):
+        body = dict(self.body, **changes)
+        return self.client.post('/books/route_matrix', data=json.dumps(body))
+
+    def testWithPaths(self):
+        rv = self.post(with_paths=True)
+        assert rv.status_code == 200
+        result = json.loads(rv.data)
+        assert abs(result['distances'][0][0] - 0.004) < 1e-12
+        assert result['distances'][0][1] is None
+        assert [pt['lng'] for pt in result['paths'][0][0]] == \
+            [0.001 * i for i in range(5)]
+        assert result['paths'][0][1] is None
+
+        assert 'paths' not in json.loads(self.post().data)
+
+    def testBadArgs(self):
+        for changes in ({'max_inter_traj_distance': 0.002},
+                        {'max_inter_traj_distance': 'x'},
+                        {'max_dist_to_existing_pt': 0},
+                        {'max_dist_to_existing_pt': -1},
+                        {'max_dist_to_existing_pt':
+                         crud.MAX_DIST_TO_EXISTING_PT * 2},
+                        {'start_pts': [{'lat': 0}]},
+                        {'end_pts': [{'lat': 0.0, 'lng': 0.0}] *
+                         (crud.MAX_ROUTE_MATRIX_POINTS + 1)}):
+            rv = self.post(**changes)
+            assert rv.status_code == 400, changes
+            assert 'error' in json.loads(rv.data)
+
+        rv = self.client.get('/books/build_graph_and_find_path'
+                             '?start_pt={"lat":0,"lng":0}'
+                             '&end_pt={"lat":0,"lng":0.004}'
+                             '&max_inter_traj_distance=1'
+                             '&max_dist_to_existing_pt=0.0001')
+        assert rv.status_code == 400
+
+
+class SimulatedAnnealingTest(EndpointTest):
+
+    def setUp(self):
+        super(SimulatedAnnealingTest, self).setUp()
+        patcher = mock.patch.object(tasks, 'get_trajectory_filter_queue')
+        self.queue = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.queue.enqueue.return_value.task_id = 'job'
+
+    def get(self, extra_args):
+        return self.client.get('/books/simulated_annealing?epsilon=0.1'
+                               '&num_steps=10&max_epsilon_jump=0.05' +
+                               extra_args)
+
+    def testBadArgs(self):
+        for extra_args in ('&num_chains=0', '&num_chains=x',
+                           '&num_chains=%d' %
+                           (config.MAX_ANNEALING_CHAINS + 1),
+                           '&num_rounds=-1', '&num_rounds=1.5',
+                           '&num_rounds=%d' %
+                           (config.MAX_ANNEALING_ROUNDS + 1)):
+            rv = self.get(extra_args)
+            assert rv.status_code == 400, extra_args
+            assert 'error' in json.loads(rv.data)
+        assert self.client.get('/books/simulated_annealing?epsilon=0.1'
+                               ).status_code == 400
+        assert not self.queue.enqueue.called
+
+    def testEnqueuesJob(self):
+        rv = self.get('&num_chains=%d&num_rounds=2' %
+                      config.MAX_ANNEALING_CHAINS)
+        assert json.loads(rv.data) == {'job_id': 'job'}
+        kwargs = self.queue.enqueue.call_args[1]
+        assert kwargs['num_chains'] == config.MAX_ANNEALING_CHAINS
+        assert kwargs['num_rounds'] == 2
+
+
+class UploadTrajectoriesTest(EndpointTest):
+
+    def upload(self, query=''):
+        return self.client.post('/books/upload_trajectories' + query,
+                                data='[{"lat": 1, "lng": 2}]\n' * 2)
+
+    def testUploadIdMakesRetriesSafe(self):
+        for _ in range(2):
+            rv = self.upload('?upload_id=batch-1')
+            assert json.loads(rv.data) == {'num_trajectories': 2}
+        with self.app.app_context():
+            assert len(model_datastore.get_raw_trajectories()) == 2
+
+            self.upload()
+            assert len(model_datastore.get_raw_trajectories()) == 4
+
+        assert self.upload('?upload_id=a/b').status_code == 400
+        assert self.upload('?upload_id=').status_code == 400
@@ -0,0 +1,86 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import random
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import unittest
+
+from bookshelf.graph_file import file_lock, open_graph_file, \
+    write_graph_file
+from bookshelf.routing import astar
+from bookshelf.spatial import PointGridIndex
+from test_routing import random_route_graph
+
+
+class GraphFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'graph.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testRoundTrip(self):
+        rand = random.Random(13)
+        graph = random_route_graph(rand)
+        pt_index = PointGridIndex(0.003)
+        for i in range(len(graph)):
+            pt_index.insert(i, graph.xs[i], graph.ys[i])
+        write_graph_file(self.path, graph, pt_index, {'version': 7})
+
+        header, mapped, mapped_index = open_graph_file(self.path)
+        assert header['version'] == 7
+        for name in ('xs', 'ys', 'components', 'offsets', 'neighbors',
+                     'weights'):
+            assert list(getattr(mapped, name)) == list(getattr(graph, name))
+
+        for _ in range(50):
+            x, y = rand.uniform(0, 0.05), rand.uniform(0, 0.05)
+            radius = rand.choice([0.001, 0.005, 1.0])
+            assert sorted(mapped_index.query_radius(x, y, radius)) == \
+                sorted(pt_index.query_radius(x, y, radius))
+            sources = rand.sample(range(len(graph)), 3)
+            targets = rand.sample(range(len(graph)), 3)
+            assert astar(mapped, sources, targets) == \
+                astar(graph, sources, targets)
+
+        assert stat.S_IMODE(os.stat(self.path).st_mode) == 0o644
+        assert os.listdir(self.directory) == ['graph.bin']
+
+    def testRejectsOtherFiles(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a graph file')
+        self.assertRaises(ValueError, open_graph_file, self.path)
+
+    def testFileLockTakesTurns(self):
+        lock_path = self.path + '.lock'
+        events = []
+
+        def take_lock():
+            with file_lock(lock_path):
+                events.append('second')
+
+        with file_lock(lock_path):
+            thread = threading.Thread(target=take_lock)
+            thread.start()
+            time.sleep(0.05)
+            events.append('first')
+        thread.join()
+        assert events == ['first', 'second']
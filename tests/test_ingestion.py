@@ -0,0 +1,57 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from bookshelf import ingestion, trajectory_encoding
+
+
+class IngestionTest(unittest.TestCase):
+
+    def testParsesJsonLines(self):
+        data = '[{"lat": 1, "lng": 2}]\n\n' \
+            '{"path": [{"lat": 3, "lng": 4, "extra": 0}], "drawn": true}\n'
+        assert ingestion.parse_json_lines(data) == [
+            ([{'lat': 1.0, 'lng': 2.0}], False),
+            ([{'lat': 3.0, 'lng': 4.0}], True)]
+
+    def testRejectionNamesTheBadLine(self):
+        data = '[{"lat": 1, "lng": 2}]\n[{"lat": 1, "lng": "x"}]\n'
+        try:
+            ingestion.parse_json_lines(data)
+            assert False
+        except ValueError as e:
+            assert str(e).startswith('line 2:')
+
+        for bad in ('[]', '[{"lat": 1}]', '[{"lat": 91, "lng": 0}]',
+                    '[{"lat": true, "lng": 0}]', '{"drawn": true}', 'nope'):
+            self.assertRaises(ValueError, ingestion.parse_json_lines, bad)
+
+    def testParsesPacked(self):
+        packed = trajectory_encoding.encode(
+            [[{'lat': 1.5, 'lng': 2.5}], [{'lat': -3, 'lng': 4}]], 2)
+        parsed = ingestion.parse_packed(packed, drawn_by_hand=True)
+
+        assert [drawn for _, drawn in parsed] == [True, True]
+        assert abs(parsed[1][0][0]['lat'] + 3) < 1e-6
+        self.assertRaises(ValueError, ingestion.parse_packed, b'[]')
+        self.assertRaises(ValueError, ingestion.parse_packed,
+                          trajectory_encoding.encode([{'lat': 1, 'lng': 2}],
+                                                     1))
+
+    def testUploadIds(self):
+        assert ingestion.validate_upload_id('batch-7_a.b') == 'batch-7_a.b'
+        for bad in ('', 'a' * (ingestion.MAX_UPLOAD_ID_LENGTH + 1),
+                    'a/b', 'a b', u'\xe9'):
+            self.assertRaises(ValueError, ingestion.validate_upload_id, bad)
@@ -0,0 +1,249 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import atexit
+import unittest
+
+from bookshelf import model_datastore
+from fake_datastore import patch_datastore
+from flask import Flask
+from gcloud import datastore
+import mock
+
+
+class ModelDatastoreTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher, self.client_class = patch_datastore()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = model_datastore.get_client()
+
+    def putLocationUpdate(self, update_id, source_id, update_time, lat, lng):
+        entity = datastore.Entity(
+            key=self.client.key(model_datastore.LOCATION_UPDATE_TABLE,
+                                update_id))
+        entity.update({'sourceId': source_id, 'updateTime': update_time,
+                       'latitude': lat, 'longitude': lng})
+        self.client.put(entity)
+
+
+class FetchAllPagesTest(ModelDatastoreTest):
+
+    def setUp(self):
+        super(FetchAllPagesTest, self).setUp()
+        # Two sources of 7 updates each, over several full pages.
+        for source_id in (1, 2):
+            self.putLocationUpdate(source_id, 0, 0, 0.0, 0.0)
+            for i in range(7):
+                self.putLocationUpdate(100 * source_id + i, source_id, 7 - i,
+                                       float(source_id), float(i))
+
+    def testReadsEveryPage(self):
+        query = self.client.query(kind=model_datastore.LOCATION_UPDATE_TABLE)
+        entities = list(model_datastore.fetch_all_pages(query, 4))
+
+        assert len(entities) == 16
+        assert self.client_class.calls['fetch'] == 5
+
+    def testGetAllLocationUpdatesReadsEveryPage(self):
+        with mock.patch.object(model_datastore, 'LOCATION_UPDATE_PAGE_SIZE',
+                               3):
+            updates = model_datastore.get_all_location_updates()
+
+        assert sorted(updates) == [1, 2]
+        assert [p['lng'] for p in updates[2][0]] == [6.0, 5.0, 4.0, 3.0, 2.0,
+                                                     1.0, 0.0]
+
+    def testIterLocationUpdatesBySourceReadsEveryPage(self):
+        by_source = list(model_datastore.iter_location_updates_by_source(
+            page_size=3))
+
+        assert [source_id for source_id, _ in by_source] == [1, 2]
+        assert all(len(points) == 7 for _, points in by_source)
+
+
+class RawTrajectoriesTest(ModelDatastoreTest):
+
+    def testIterRawTrajectoriesReadsEveryPage(self):
+        trajectories = [[{'lat': i, 'lng': j} for j in range(3)]
+                        for i in range(11)]
+        model_datastore.store_new_trajectory_updates(
+            [(traj, False) for traj in trajectories])
+
+        read = list(model_datastore.iter_raw_trajectories(page_size=5))
+        assert sorted(read) == sorted(trajectories)
+        assert self.client_class.calls['fetch'] == 3
+
+    def testRetriedUploadStoresEachTrajectoryOnce(self):
+        trajectories = [([{'lat': i, 'lng': 0.0}], i % 2 == 0)
+                        for i in range(5)]
+        put_entities = model_datastore._put_entities
+        calls = []
+
+        def fail_second_put(ds, entities):
+            calls.append(entities)
+            if len(calls) == 2:
+                raise IOError("connection reset")
+            put_entities(ds, entities)
+
+        with mock.patch.object(model_datastore, 'MAX_ENTITIES_PER_PUT', 2), \
+                mock.patch.object(model_datastore, '_put_entities',
+                                  fail_second_put):
+            self.assertRaises(IOError,
+                              model_datastore.store_new_trajectory_updates,
+                              trajectories, upload_id='a')
+        model_datastore.store_new_trajectory_updates(trajectories,
+                                                     upload_id='a')
+
+        read = list(model_datastore.iter_raw_trajectories())
+        assert sorted(read) == sorted(traj for traj, _ in trajectories)
+
+    def testSeparateUploadsOfTheSameTrajectoryAreKept(self):
+        trajectories = [([{'lat': 1.0, 'lng': 0.0}], False)] * 2
+        model_datastore.store_new_trajectory_updates(trajectories,
+                                                     upload_id='a')
+        model_datastore.store_new_trajectory_updates(trajectories,
+                                                     upload_id='b')
+        model_datastore.store_new_trajectory_updates(trajectories)
+        for _ in range(2):
+            model_datastore.store_new_trajectory_update(
+                [{'lat': 1.0, 'lng': 0.0}], True)
+
+        assert len(list(model_datastore.iter_raw_trajectories())) == 8
+
+
+class ShardedResultTest(ModelDatastoreTest):
+
+    def setUp(self):
+        super(ShardedResultTest, self).setUp()
+        # Small shards, read one per request, so a few items span several.
+        for name, value in (('RESULT_SHARD_MAX_BYTES', 200),
+                            ('RESULT_SHARDS_PER_RPC', 1),
+                            ('RESULT_SHARD_IO_THREADS', 2)):
+            patcher = mock.patch.object(model_datastore, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.items = [[{'lat': i * 0.5, 'lng': -i * 0.25}] * 4
+                      for i in range(10)]
+
+    def numShardsStored(self):
+        return len([path for path in self.client_class.store
+                    if path[0] == 'Results' +
+                    model_datastore.RESULT_SHARD_KIND_SUFFIX])
+
+    def testMultiShardRoundTrip(self):
+        version = model_datastore.store_sharded_result('Results', 1,
+                                                       self.items)
+
+        assert model_datastore.get_result_manifest('Results', 1)[1] > 2
+        assert model_datastore.get_sharded_result('Results', 1, 'legacy') == \
+            (self.items, version)
+        some, _ = model_datastore.get_sharded_result('Results', 1, 'legacy',
+                                                     shard_indices=[1, 0])
+        assert some and all(item in self.items for item in some)
+
+    def testPackedRoundTripAndOldShardsDeleted(self):
+        app = Flask(__name__)
+        app.config['RESULT_ENCODING'] = 'packed'
+        with app.app_context():
+            model_datastore.store_sharded_result('Results', 1, self.items,
+                                                 point_depth=2)
+            num_shards = self.numShardsStored()
+            model_datastore.store_sharded_result('Results', 1,
+                                                 self.items[:3],
+                                                 point_depth=2)
+        items, _ = model_datastore.get_sharded_result('Results', 1, 'legacy')
+
+        assert len(items) == 3
+        for got, expected in zip(items, self.items):
+            assert all(abs(a['lat'] - b['lat']) < 1e-6 for a, b in
+                       zip(got, expected))
+        assert self.numShardsStored() < num_shards
+
+    def testRetriesWhenReplacedDuringRead(self):
+        model_datastore.store_sharded_result('Results', 1, self.items)
+        new_items = self.items[::-1]
+        get_entities = model_datastore._get_entities
+        replaced = []
+
+        def get_and_replace(ds, keys):
+            entities = get_entities(ds, keys)
+            if not replaced:
+                replaced.append(True)
+                model_datastore.store_sharded_result('Results', 1, new_items)
+            return entities
+
+        with mock.patch.object(model_datastore, '_get_entities',
+                               get_and_replace):
+            items, version = model_datastore.get_sharded_result(
+                'Results', 1, 'legacy')
+
+        assert items == new_items
+        assert version == model_datastore.get_result_version('Results', 1)
+
+    def testIterRaisesWhenReplacedDuringRead(self):
+        model_datastore.store_sharded_result('Results', 1, self.items)
+        shards = model_datastore.iter_sharded_result('Results', 1, 'legacy')
+        next(shards)
+        model_datastore.store_sharded_result('Results', 1, self.items)
+
+        self.assertRaises(model_datastore.ResultReplacedError, list, shards)
+
+
+class RawTrajectoriesVersionTest(ModelDatastoreTest):
+
+    def testUploadsSpreadVersionOverShards(self):
+        assert model_datastore.get_raw_trajectories_version() is None
+        for i in range(40):
+            model_datastore.store_new_trajectory_update(
+                [{'lat': i, 'lng': 0}], drawn_by_hand=False)
+
+        version_paths = [path for path in self.client_class.store
+                         if path[0] == model_datastore.RESULT_VERSIONS_TABLE]
+        assert len(version_paths) > 1
+        latest = max(self.client_class.store[path]['generation']
+                     for path in version_paths)
+        assert model_datastore.get_result_version(
+            model_datastore.RAW_TRAJECTORY_TABLE,
+            model_datastore.RAW_TRAHECTORY_DEFAULT_ID) == latest
+
+    def testReadsVersionWrittenBeforeSharding(self):
+        self.client.put(model_datastore._result_version_entity(
+            self.client, model_datastore.RAW_TRAJECTORY_TABLE,
+            model_datastore.RAW_TRAHECTORY_DEFAULT_ID, 5))
+
+        assert model_datastore.get_raw_trajectories_version() == 5
+
+
+class WriteBufferTest(ModelDatastoreTest):
+
+    def testReinitClosesOldBufferWithoutPilingUpExitHandlers(self):
+        app = Flask(__name__)
+        app.config.update(DATASTORE_DATASET_ID='fake',
+                          WRITE_BEHIND_ENABLED=True)
+        patcher = mock.patch.object(model_datastore, '_write_buffer', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(model_datastore._close_write_buffer)
+        num_exit_handlers = len(atexit._exithandlers)
+        model_datastore.init_app(app)
+        first = model_datastore._write_buffer
+        model_datastore.init_app(app)
+        second = model_datastore._write_buffer
+
+        assert first._closed and not second._closed
+        assert len(atexit._exithandlers) == num_exit_handlers
+        model_datastore._close_write_buffer()
+        assert second._closed
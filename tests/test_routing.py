@@ -0,0 +1,117 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from heapq import heappop, heappush
+import random
+import unittest
+
+from bookshelf.routing import astar, CompactGraph, one_to_many
+from bookshelf.spatial import get_grid_nearby_neighbors_func, PointGridIndex
+from traclus_impl.geometry import Point
+from traclus_impl.processed_trajectory_connecting import \
+    build_point_graph, compute_graph_component_ids, FilteredTrajectory
+
+
+def random_route_graph(rand, num_trajectories=40, points_per_traj=20):
+    trajectories = []
+    for traj_id in range(num_trajectories):
+        x, y = rand.uniform(0, 0.05), rand.uniform(0, 0.05)
+        traj = []
+        for _ in range(points_per_traj):
+            x += rand.uniform(-0.002, 0.002)
+            y += rand.uniform(-0.002, 0.002)
+            traj.append(Point(x, y))
+        trajectories.append(FilteredTrajectory(traj, traj_id))
+    pt_graph = build_point_graph(
+        trajectories,
+        get_grid_nearby_neighbors_func(PointGridIndex(0.003), 0.003))
+    compute_graph_component_ids(pt_graph, lambda pt_node, pt_graph: [])
+    return CompactGraph.from_point_graph(pt_graph)
+
+
+def dijkstra_distance(graph, sources, targets):
+    distances = {}
+    heap = [(0.0, s) for s in sources]
+    while heap:
+        dist, u = heappop(heap)
+        if u in distances:
+            continue
+        distances[u] = dist
+        if u in targets:
+            return dist
+        for k in range(graph.offsets[u], graph.offsets[u + 1]):
+            heappush(heap, (dist + graph.weights[k], graph.neighbors[k]))
+    return None
+
+
+class AStarTest(unittest.TestCase):
+
+    def testMatchesDijkstra(self):
+        rand = random.Random(11)
+        graph = random_route_graph(rand)
+        num_found = 0
+        for _ in range(50):
+            sources = rand.sample(range(len(graph)), 3)
+            targets = rand.sample(range(len(graph)), 3)
+            path, dist = astar(graph, sources, targets)
+            expected = dijkstra_distance(graph, sources, set(targets))
+            if expected is None:
+                assert path is None and dist is None
+                continue
+            num_found += 1
+            assert abs(dist - expected) < 1e-12
+            assert path[0] in sources and path[-1] in targets
+            length = sum(graph.distance(a, b) for a, b in zip(path, path[1:]))
+            assert abs(length - dist) < 1e-12
+        assert num_found > 0
+
+    def testNoPathBetweenComponents(self):
+        pt_graph = build_point_graph(
+            [FilteredTrajectory([Point(0, 0), Point(1, 0)], 0),
+             FilteredTrajectory([Point(5, 5), Point(6, 5)], 1)])
+        compute_graph_component_ids(pt_graph, lambda pt_node, pt_graph: [])
+        graph = CompactGraph.from_point_graph(pt_graph)
+
+        assert astar(graph, [0], [3]) == (None, None)
+        assert astar(graph, [0, 2], [1]) == ([0, 1], 1.0)
+
+
+class OneToManyTest(unittest.TestCase):
+
+    def testMatchesDijkstraPerGroup(self):
+        rand = random.Random(12)
+        graph = random_route_graph(rand)
+        for _ in range(10):
+            sources = rand.sample(range(len(graph)), 2)
+            target_groups = [rand.sample(range(len(graph)), 3)
+                             for _ in range(5)]
+            distances, paths = one_to_many(graph, sources, target_groups,
+                                           with_paths=True)
+            for targets, dist, path in zip(target_groups, distances, paths):
+                expected = dijkstra_distance(graph, sources, set(targets))
+                if expected is None:
+                    assert dist is None and path is None
+                    continue
+                assert abs(dist - expected) < 1e-12
+                assert path[0] in sources and path[-1] in targets
+
+    def testWithoutPaths(self):
+        pt_graph = build_point_graph(
+            [FilteredTrajectory([Point(0, 0), Point(1, 0)], 0),
+             FilteredTrajectory([Point(5, 5), Point(6, 5)], 1)])
+        compute_graph_component_ids(pt_graph, lambda pt_node, pt_graph: [])
+        graph = CompactGraph.from_point_graph(pt_graph)
+
+        assert one_to_many(graph, [0], [[1], [3], [], [0]]) == \
+            ([1.0, None, None, 0.0], None)
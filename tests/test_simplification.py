@@ -0,0 +1,48 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import unittest
+
+from bookshelf.simplification import distance_to_segment, douglas_peucker
+from traclus_impl.geometry import Point
+
+
+class DouglasPeuckerTest(unittest.TestCase):
+
+    def testDropsPointsWithinTolerance(self):
+        points = [Point(0, 0), Point(1, 0.05), Point(2, -0.05), Point(3, 0),
+                  Point(3, 1)]
+        simplified = douglas_peucker(points, 0.1)
+        assert [(p.x, p.y) for p in simplified] == [(0, 0), (3, 0), (3, 1)]
+
+    def testDroppedPointsStayWithinTolerance(self):
+        rand = random.Random(5)
+        points = [Point(i * 0.01, rand.uniform(-0.02, 0.02))
+                  for i in range(2000)]
+        simplified = douglas_peucker(points, 0.01)
+
+        assert len(simplified) < len(points)
+        kept_ids = set(map(id, simplified))
+        seg = 0
+        for pt in points:
+            if id(pt) in kept_ids and pt is not simplified[-1]:
+                seg = simplified.index(pt)
+                continue
+            assert distance_to_segment(pt, simplified[seg],
+                                       simplified[seg + 1]) <= 0.01 + 1e-12
+
+    def testZeroToleranceKeepsEverything(self):
+        points = [Point(0, 0), Point(1, 0), Point(2, 0)]
+        assert douglas_peucker(points, 0.0) == points
@@ -0,0 +1,93 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import unittest
+
+from bookshelf.spatial import PointGridIndex, segment_intersects_box, \
+    SegmentGridIndex, tile_bounds
+
+
+class PointGridIndexTest(unittest.TestCase):
+
+    def testQueryRadiusMatchesScan(self):
+        rand = random.Random(7)
+        index = PointGridIndex(cell_size=0.01)
+        points = {}
+        for i in range(500):
+            x, y = rand.uniform(-0.1, 0.1), rand.uniform(-0.1, 0.1)
+            index.insert(i, x, y)
+            points[i] = (x, y)
+
+        for radius in (0.0001, 0.005, 0.03, 1.0):
+            expected = sorted(
+                i for i, (x, y) in points.items()
+                if ((x - 0.01) ** 2 + (y + 0.02) ** 2) ** 0.5 <= radius)
+            assert sorted(index.query_radius(0.01, -0.02, radius)) == \
+                expected
+
+    def testStrictLeavesOutPointsOnTheRadius(self):
+        index = PointGridIndex(cell_size=1.0)
+        index.insert('a', 3.0, 4.0)
+
+        assert index.query_radius(0.0, 0.0, 5.0) == ['a']
+        assert index.query_radius(0.0, 0.0, 5.0, strict=True) == []
+
+    def testNegativeCoordinatesLandInTheirOwnCells(self):
+        index = PointGridIndex(cell_size=1.0)
+        index.insert('a', -0.5, -0.5)
+        index.insert('b', 0.5, 0.5)
+
+        assert index.cell_of(-0.5, -0.5) == (-1, -1)
+        assert index.query_radius(-0.6, -0.6, 0.2) == ['a']
+
+    def testRejectsNonPositiveCellSize(self):
+        self.assertRaises(ValueError, PointGridIndex, 0.0)
+
+
+class SegmentGridIndexTest(unittest.TestCase):
+
+    def testQueryBoxMatchesScan(self):
+        rand = random.Random(3)
+        index = SegmentGridIndex(cell_size=0.01, max_cells_per_segment=4)
+        segments = {}
+        for i in range(300):
+            x, y = rand.uniform(-0.1, 0.1), rand.uniform(-0.1, 0.1)
+            length = 0.2 if i % 50 == 0 else 0.01
+            seg = (x, y, x + rand.uniform(-length, length),
+                   y + rand.uniform(-length, length))
+            index.insert(i, *seg)
+            segments[i] = seg
+
+        for box in ((-0.02, -0.03, 0.01, 0.0), (0.0, 0.0, 0.0001, 0.0001),
+                    (-1.0, -1.0, 1.0, 1.0)):
+            expected = sorted(i for i, seg in segments.items()
+                              if segment_intersects_box(*(seg + box)))
+            assert index.query_box(*box) == expected
+        assert index.oversized
+
+    def testSegmentCrossingBoxWithoutEndpointsInside(self):
+        assert segment_intersects_box(-1, 0.5, 2, 0.5, 0, 0, 1, 1)
+        assert not segment_intersects_box(-1, 0, 0, 2, 0.5, 0, 1, 1)
+
+    def testTileBounds(self):
+        min_lat, min_lng, max_lat, max_lng = tile_bounds(0, 0, 0)
+        assert (min_lng, max_lng) == (-180.0, 180.0)
+        assert abs(max_lat - 85.0511) < 1e-4 and abs(min_lat + 85.0511) < 1e-4
+
+        min_lat, min_lng, max_lat, max_lng = tile_bounds(1, 1, 0)
+        assert (min_lat, min_lng, max_lng) == (0.0, 0.0, 180.0)
+        self.assertRaises(ValueError, tile_bounds, 1, 2, 0)
+        self.assertRaises(ValueError, tile_bounds, 31, 0, 0)
+        self.assertRaises(ValueError, tile_bounds, 5000, 0, 0)
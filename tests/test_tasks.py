@@ -0,0 +1,254 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from bookshelf import model_datastore, routing, simplification, tasks
+from bookshelf.caching import LRUCache
+from fake_datastore import patch_datastore
+from flask import Flask
+import mock
+from traclus_impl.geometry import Point
+from traclus_impl.parameter_estimation import TraclusSimulatedAnnealer
+
+
+def stub_energy(annealer):
+    # Lowest at epsilon 3, with a dip at 1 for chains to get stuck in.
+    epsilon = annealer.state.get_epsilon()
+    return min((epsilon - 3) ** 2, 0.5 + (epsilon - 1) ** 2)
+
+
+class AnnealingTest(unittest.TestCase):
+
+    def setUp(self):
+        tasks._energy_cache.clear()
+        patchers = [
+            mock.patch.object(TraclusSimulatedAnnealer, 'energy', stub_energy),
+            mock.patch.object(tasks, 'get_normalized_datastore_trajectories',
+                              return_value=[[Point(0, 0), Point(1, 1)]])]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def testChainStartsSpreadAroundInitialEpsilon(self):
+        assert tasks.chain_start_epsilons(1.0, 0.25, 5) == \
+            [1.0, 1.25, 0.75, 1.5, 0.5]
+        assert tasks.chain_start_epsilons(0.1, 0.25, 3) == [0.1, 0.35, 0.6]
+        assert tasks.chain_start_epsilons(1.0, 0.25, 1) == [1.0]
+
+    def testParallelChainsReturnBestAcrossChains(self):
+        result = tasks.run_simulated_annealing_for_epsilon(
+            initial_epsilon=1.0, num_steps=30, max_epsilon_jump=0.5,
+            num_chains=3, num_rounds=2, seed=5)
+
+        chains = result['chains']
+        assert len(chains) == 3
+        assert [c['initial_epsilon'] for c in chains] == [1.0, 1.5, 0.5]
+        all_energies = [energy for chain in chains
+                        for _, energy in chain['trace']]
+        assert result['best_energy'] == min(all_energies)
+        assert result['best_energy'] == \
+            min(chain['best_energy'] for chain in chains)
+        assert stub_energy(mock.Mock(**{
+            'state.get_epsilon.return_value': result['best_epsilon']})) == \
+            result['best_energy']
+
+
+class FilterTrajectoriesTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher, _ = patch_datastore()
+        patchers = [
+            patcher,
+            mock.patch.object(model_datastore, 'get_all_location_updates',
+                              return_value={1: [[
+                                  {'lat': 0.0, 'lng': 0.0},
+                                  {'lat': 0.5, 'lng': 0.000001},
+                                  {'lat': 1.0, 'lng': 0.0}]]}),
+            mock.patch.object(tasks, 'build_and_store_routing_hierarchy'),
+            mock.patch.object(tasks, 'write_configured_route_graph_file')]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        context = Flask(__name__).app_context()
+        context.push()
+        self.addCleanup(context.pop)
+
+    def testStoresEverySimplifiedLevel(self):
+        tasks.filter_trajectories()
+
+        assert len(model_datastore.get_filtered_trajectories()[0]) == 3
+        for level in range(1, simplification.num_levels()):
+            key_id = model_datastore.filtered_trajectories_key_id(level)
+            simplified = model_datastore.get_filtered_trajectories(key_id)
+            assert len(simplified) == 1
+            assert len(simplified[0]) == 2
+
+
+class RouteCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = [0.0]
+        cache = LRUCache(max_entries=4, ttl=60, clock=lambda: self.now[0])
+        patcher = mock.patch.object(tasks, '_route_cache', cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        trajectory = [{'lat': float(i), 'lng': 0.0} for i in range(4)]
+        pt_graph, self.pt_index = \
+            tasks.construct_indexed_graph_from_processed_trajectories(
+                [trajectory], 0.5)
+        self.route_graph = routing.CompactGraph.from_point_graph(pt_graph)
+        self.route_graph.version = 1
+
+    def findRoute(self):
+        return tasks.find_route_between_points(
+            self.route_graph, self.pt_index, Point(0.1, 0.0),
+            Point(2.9, 0.0), max_dist_to_existing_pt=0.5)
+
+    def testHitsMissesAndExpiry(self):
+        with mock.patch.object(routing, 'astar',
+                               wraps=routing.astar) as astar:
+            path, distance = self.findRoute()
+            assert distance == 3.0
+            assert len(path) == 4
+            assert self.findRoute() == (path, distance)
+            assert astar.call_count == 1
+            assert tasks.get_route_cache_stats()['hits'] == 1
+
+            # A rebuilt graph has a new version, so it searches again.
+            self.route_graph.version = 2
+            assert self.findRoute() == (path, distance)
+            assert astar.call_count == 2
+
+            self.now[0] += 61
+            assert self.findRoute() == (path, distance)
+            assert astar.call_count == 3
+
+        stats = tasks.get_route_cache_stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 3
+
+
+class RouteGraphFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        patcher, _ = patch_datastore()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        app = Flask(__name__)
+        app.config.update(ROUTE_GRAPH_FILE_DIR=self.directory,
+                          ROUTE_GRAPH_FILE_MAX_INTER_TRAJ_DISTANCE=0.001)
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        for cache in (tasks._mapped_route_graph_cache,
+                      tasks._route_cache):
+            cache.clear()
+        tasks.invalidate_point_graph_cache()
+        self.addCleanup(tasks.invalidate_point_graph_cache)
+        self.storeTrajectories(0.0)
+
+    def storeTrajectories(self, lat):
+        model_datastore.store_filtered_trajectories(
+            [[Point(lat, 0.001 * i) for i in range(5)]])
+
+    def testMapsFileWrittenByWorker(self):
+        tasks.write_configured_route_graph_file()
+        with mock.patch.object(tasks, '_build_stored_point_graph',
+                               wraps=tasks._build_stored_point_graph) as build:
+            route_graph, pt_index = tasks.get_route_graph(0.001)
+            assert build.call_count == 0
+            assert len(route_graph) == 5
+            assert route_graph.version == \
+                model_datastore.get_filtered_trajectories_version()
+
+            self.storeTrajectories(1.0)
+            route_graph, pt_index = tasks.get_route_graph(0.001)
+            assert build.call_count == 1
+            assert route_graph.xs[0] == 1.0
+
+    def testOnlyConfiguredDistanceIsMapped(self):
+        route_graph, pt_index = tasks.get_route_graph(0.002)
+        assert len(route_graph) == 5
+        assert os.listdir(self.directory) == []
+
+        tasks.get_route_graph(0.001)
+        assert sorted(os.listdir(self.directory)) == \
+            ['route-graph-0.001.bin', 'route-graph-0.001.bin.lock']
+
+
+class PointGraphCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        tasks.invalidate_point_graph_cache()
+        self.addCleanup(tasks.invalidate_point_graph_cache)
+        self.version = None
+        self.now = 1000.0
+        self.num_builds = 0
+        patchers = [
+            mock.patch.object(model_datastore,
+                              'get_filtered_trajectories_version',
+                              lambda: self.version),
+            mock.patch.object(tasks, '_build_stored_point_graph',
+                              self.buildPointGraph),
+            mock.patch.object(tasks, 'time',
+                              mock.Mock(time=lambda: self.now))]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def buildPointGraph(self, max_inter_traj_distance):
+        self.num_builds += 1
+        # Long enough for other threads to pile up behind the build.
+        time.sleep(0.05)
+        trajectory = [{'lat': float(i), 'lng': 0.0} for i in range(3)]
+        pt_graph, pt_index = \
+            tasks.construct_indexed_graph_from_processed_trajectories(
+                [trajectory], max_inter_traj_distance)
+        return pt_graph, pt_index, self.version
+
+    def testUnversionedGraphsExpire(self):
+        tasks.get_point_graph(0.5)
+        self.now += tasks.UNVERSIONED_POINT_GRAPH_TTL_SECONDS
+        tasks.get_point_graph(0.5)
+        assert self.num_builds == 1
+
+        self.now += 1
+        tasks.get_point_graph(0.5)
+        assert self.num_builds == 2
+
+        self.version = 7
+        tasks.get_point_graph(0.5)
+        self.now += 10 * tasks.UNVERSIONED_POINT_GRAPH_TTL_SECONDS
+        tasks.get_point_graph(0.5)
+        assert self.num_builds == 3
+
+    def testConcurrentRequestsBuildOnce(self):
+        self.version = 3
+        threads = [threading.Thread(target=tasks.get_point_graph,
+                                    args=(0.5,)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert self.num_builds == 1
+        assert tasks._point_graph_build_locks == {}
@@ -0,0 +1,78 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import random
+import unittest
+
+from bookshelf import trajectory_encoding
+
+
+def random_trajectory(rand, num_points):
+    return [{'lat': rand.uniform(-90, 90), 'lng': rand.uniform(-180, 180)}
+            for _ in range(num_points)]
+
+
+class TrajectoryEncodingTest(unittest.TestCase):
+
+    def assertPointsClose(self, expected, actual):
+        if isinstance(expected, dict):
+            assert abs(expected['lat'] - actual['lat']) <= 1e-7
+            assert abs(expected['lng'] - actual['lng']) <= 1e-7
+            return
+        assert len(expected) == len(actual)
+        for e, a in zip(expected, actual):
+            self.assertPointsClose(e, a)
+
+    def testRoundTripsTrajectories(self):
+        rand = random.Random(1)
+        trajectories = [random_trajectory(rand, rand.randint(0, 30))
+                        for _ in range(20)]
+
+        for compress in (True, False):
+            data = trajectory_encoding.encode(trajectories, 2,
+                                              compress=compress)
+            assert trajectory_encoding.is_packed(data)
+            self.assertPointsClose(trajectories,
+                                   trajectory_encoding.decode(data))
+
+    def testRoundTripsClusters(self):
+        rand = random.Random(2)
+        clusters = [[random_trajectory(rand, 2)
+                     for _ in range(rand.randint(0, 5))]
+                    for _ in range(10)]
+
+        data = trajectory_encoding.encode(clusters, 3)
+        self.assertPointsClose(clusters, trajectory_encoding.decode(data))
+
+    def testRoundTripsJumpsAcrossTheWholeRange(self):
+        trajectory = [{'lat': -214.7, 'lng': 214.7},
+                      {'lat': 214.7, 'lng': -214.7},
+                      {'lat': -214.7, 'lng': 214.7}]
+
+        data = trajectory_encoding.encode(trajectory, 1)
+        self.assertPointsClose(trajectory, trajectory_encoding.decode(data))
+
+    def testEmpty(self):
+        assert trajectory_encoding.decode(
+            trajectory_encoding.encode([], 2)) == []
+
+    def testReadsLegacyJson(self):
+        trajectories = [[{'lat': 1.5, 'lng': -2.25}]]
+        assert trajectory_encoding.decode(json.dumps(trajectories)) == \
+            trajectories
+
+    def testRejectsCoordinatesOutOfRange(self):
+        self.assertRaises(ValueError, trajectory_encoding.encode,
+                          [[{'lat': 1000.0, 'lng': 0.0}]], 2)
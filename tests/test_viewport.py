@@ -0,0 +1,62 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from bookshelf import viewport
+
+
+def pt(lat, lng):
+    return {'lat': lat, 'lng': lng}
+
+
+class ViewportTest(unittest.TestCase):
+
+    def testTrajectoryPiecesAreRunsOfCrossingSegments(self):
+        trajectories = [[pt(0, 0), pt(1, 0), pt(5, 0), pt(6, 0), pt(1.5, 0.5)],
+                        [pt(10, 10), pt(11, 11)]]
+        index = viewport.index_trajectory_segments(trajectories, 1.0)
+
+        pieces = viewport.trajectories_in_box(trajectories, index,
+                                              (0.5, -0.5, 2.0, 0.6))
+        assert pieces == [
+            {'trajectory_id': 0, 'points': [pt(0, 0), pt(1, 0), pt(5, 0)]},
+            {'trajectory_id': 0, 'points': [pt(6, 0), pt(1.5, 0.5)]}]
+
+    def testNothingInBox(self):
+        trajectories = [[pt(0, 0), pt(1, 0)]]
+        index = viewport.index_trajectory_segments(trajectories, 1.0)
+
+        assert viewport.trajectories_in_box(trajectories, index,
+                                            (5, 5, 6, 6)) == []
+        empty_index = viewport.index_trajectory_segments([], 1.0)
+        assert viewport.trajectories_in_box([], empty_index,
+                                            (0, 0, 1, 1)) == []
+
+    def testDecimateKeepsEndpoints(self):
+        points = [pt(0, 0), pt(0.1, 0), pt(0.2, 0), pt(1.0, 0), pt(1.05, 0)]
+        assert viewport.decimate(points, 0.5) == \
+            [pt(0, 0), pt(1.0, 0), pt(1.05, 0)]
+        assert viewport.decimate(points, None) == points
+
+    def testClustersInBoxDropsShortSegments(self):
+        clusters = [[[pt(0, 0), pt(1, 1)], [pt(0.5, 0.5), pt(0.51, 0.5)]],
+                    [[pt(5, 5), pt(6, 6)]]]
+        index = viewport.index_cluster_segments(clusters, 1.0)
+
+        assert viewport.clusters_in_box(clusters, index, (0, 0, 1, 1)) == \
+            [{'cluster_id': 0, 'segments': clusters[0]}]
+        assert viewport.clusters_in_box(clusters, index, (0, 0, 1, 1),
+                                        tolerance=0.1) == \
+            [{'cluster_id': 0, 'segments': clusters[0][:1]}]
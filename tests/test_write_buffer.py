@@ -0,0 +1,74 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import unittest
+
+from bookshelf.write_buffer import WriteBehindBuffer
+
+
+class WriteBehindBufferTest(unittest.TestCase):
+
+    def testFlushesFullBatches(self):
+        batches = []
+        buf = WriteBehindBuffer(batches.append, max_batch_size=3,
+                                flush_interval=60)
+        for i in range(7):
+            buf.add(i)
+        buf.close()
+
+        assert batches == [[0, 1, 2], [3, 4, 5], [6]]
+        assert buf.stats()['flushed'] == 7
+
+    def testFlushesAfterInterval(self):
+        flushed = threading.Event()
+        buf = WriteBehindBuffer(lambda batch: flushed.set(),
+                                max_batch_size=100, flush_interval=0.01)
+        buf.add('a')
+
+        assert flushed.wait(5)
+        buf.close()
+
+    def testAddTimesOutWhenFull(self):
+        release = threading.Event()
+        batches = []
+
+        def slow_flush(batch):
+            release.wait(5)
+            batches.append(batch)
+        buf = WriteBehindBuffer(slow_flush, max_batch_size=1,
+                                flush_interval=60, max_pending=1)
+        buf.add('a')
+        # The background thread may still be picking up 'a', so give it a
+        # moment before the buffer is full for sure.
+        buf.add('b', timeout=1)
+        assert not buf.add('c', timeout=0.01)
+
+        release.set()
+        buf.close()
+        assert batches == [['a'], ['b']]
+
+    def testRetriesThenDrops(self):
+        calls = []
+
+        def failing_flush(batch):
+            calls.append(batch)
+            raise IOError("datastore is down")
+        buf = WriteBehindBuffer(failing_flush, max_retries=1)
+        buf.add('a')
+        assert buf.flush(5)
+
+        assert calls == [['a'], ['a']]
+        assert buf.stats()['dropped'] == 1
+        buf.close()